@@ -0,0 +1,371 @@
+"""
+Benchmarks for the game loop.
+
+Games are played start to finish through the plugin's commands, with a stub
+bot, an in-memory SQLite db and a twisted Clock standing in for the reactor,
+so nothing touches the network and time only passes when the bench says so.
+Each scenario reports per command latency percentiles, rounds per second, db
+queries per round and the peak memory of the process.
+
+    python -m cah.bench
+    python -m cah.bench --players 3,8,16 --cards 1000,50000 --rounds 500
+
+Results can be saved and compared against later, failing if any command's
+median latency has got worse by more than the tolerance:
+
+    python -m cah.bench --save before.json
+    python -m cah.bench --compare before.json --tolerance 0.25
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+
+import sqlalchemy
+from sqlalchemy import event, orm
+from twisted.internet import task
+
+from . import cah as plugin_module
+from .models import SQLAlchemyBase, CardTable
+
+
+DB = namedtuple('DB', ['engine', 'session'])
+
+# Game methods that are timed on their own, as well as the commands.
+HOT_PATHS = ('reset', 'give_point', 'show_answers', 'prep_play', 'deal')
+
+
+class FakeReactor(task.Clock):
+    """ A Clock with just enough reactor to set the plugin up """
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.triggers = []
+
+    def addSystemEventTrigger(self, phase, event, f, *args, **kwargs):
+        self.triggers.append((f, args, kwargs))
+
+    def shutdown(self):
+        for f, args, kwargs in self.triggers:
+            f(*args, **kwargs)
+
+
+class FakeBot(object):
+    """ Counts what would have been sent, instead of sending it """
+
+    nickname = 'cahbot'
+
+    def __init__(self):
+        self.lines = 0
+
+    def reply(self, comm, message, **kwargs):
+        self.lines += 1
+
+    def notice(self, user, message):
+        self.lines += 1
+
+    def msg(self, target, message, length=None):
+        self.lines += 1
+
+
+class FakeLoader(object):
+    def __init__(self, config):
+        engine = sqlalchemy.create_engine('sqlite://')
+        self.db = DB(engine, orm.sessionmaker(bind=engine)())
+        self.config = {'cah': config}
+
+
+class Timings(object):
+    """ Seconds taken by each call of each thing being timed """
+
+    def __init__(self):
+        self.times = defaultdict(list)
+
+    def add(self, name, seconds):
+        self.times[name].append(seconds)
+
+    def wrap(self, name, f):
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.add(name, time.time() - start)
+        return timed
+
+    def summary(self):
+        """ {name: [calls, p50, p90, p99, max]}, in milliseconds """
+        summary = {}
+        for name, times in self.times.iteritems():
+            times = sorted(times)
+            summary[name] = [len(times)] + [
+                percentile(times, p) * 1000 for p in (0.5, 0.9, 0.99, 1.0)]
+        return summary
+
+
+def percentile(times, p):
+    return times[int(round(p * (len(times) - 1)))]
+
+
+def peak_memory():
+    """ Peak resident memory of the process so far, in MB. """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes.
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak / 1024.0
+
+
+@contextmanager
+def quiet():
+    """ Hide the commands' debugging prints, which would drown out reports """
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def comm(user, message, channel):
+    return {'user': user, 'channel': channel, 'message': message,
+            'raw_message': message, 'raw_user': user, 'mask': '',
+            'target': channel, 'pm': False, 'directed': True}
+
+
+class Bench(object):
+    """
+    A plugin set up with `whites` and `blacks` cards and `players` players in
+    each of `channels` channels, ready to play rounds.
+    """
+
+    def __init__(self, players, whites, blacks, channels=1, timings=None,
+                 seed=None):
+        self.timings = timings or Timings()
+        self.tmp = tempfile.mkdtemp(prefix='cah-bench-')
+        self.reactor = FakeReactor()
+        self.bot = FakeBot()
+        self.queries = 0
+        self.rounds = 0
+
+        loader = FakeLoader({
+            'sync-cards': False,
+            'cache-dir': self.tmp,
+            # The outbox's rate limits would only measure the fake clock.
+            'send-rate': 1e9,
+            'send-burst': 1e9,
+            'send-total-rate': 1e9,
+            'send-total-burst': 1e9,
+            'seed': seed,
+        })
+        self.db = loader.db
+        self.fill_cards(whites, blacks)
+
+        @event.listens_for(self.db.engine, 'before_cursor_execute')
+        def count(conn, cursor, statement, parameters, context, many):
+            self.queries += 1
+
+        self.real_reactor = plugin_module.reactor
+        plugin_module.reactor = self.reactor
+        self.saved = {}
+        for name in HOT_PATHS:
+            f = getattr(plugin_module.Game, name)
+            self.saved[name] = f
+            setattr(plugin_module.Game, name,
+                    self.timings.wrap('Game.' + name, f.im_func))
+
+        self.plugin = plugin_module.CardsAgainstHumanity()
+        self.plugin.setup(loader)
+
+        self.channels = ['#bench{0}'.format(i) for i in xrange(channels)]
+        self.players = dict((channel, ['p{0}_{1}'.format(i, n)
+                                       for n in xrange(players)])
+                            for i, channel in enumerate(self.channels))
+        for channel in self.channels:
+            for player in self.players[channel]:
+                self.say(player, 'join', channel)
+
+    def fill_cards(self, whites, blacks):
+        SQLAlchemyBase.metadata.create_all(self.db.engine)
+        formatter = plugin_module.CardsAgainstHumanity()
+        rows = [{'desc': u'White card number {0}'.format(i),
+                 'color': 'white', 'official': True} for i in xrange(whites)]
+        for i in xrange(blacks):
+            # A few prompts take two cards, like the real deck.
+            blanks = ' and __________' if i % 5 == 0 else ''
+            text = 'Black card {0} is __________{1}.'.format(i, blanks)
+            rows.append({'desc': formatter.init_black(text).decode('utf-8'),
+                         'color': 'black', 'official': True})
+        self.db.session.execute(CardTable.__table__.insert(), rows)
+        self.db.session.commit()
+
+    def close(self):
+        self.reactor.shutdown()
+        plugin_module.reactor = self.real_reactor
+        for name, f in self.saved.iteritems():
+            setattr(plugin_module.Game, name, f)
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def say(self, user, message, channel):
+        name = message.split(' ', 1)[0]
+        start = time.time()
+        self.plugin.message(self.bot, comm(user, message, channel))
+        # Let the outbox send what the command said.
+        self.reactor.advance(0)
+        self.timings.add(name, time.time() - start)
+
+    def play_round(self, channel):
+        game = self.plugin.games[channel]
+        if game.state != 'play':
+            return False
+
+        cards = ' '.join(str(i + 1) for i in xrange(game.blanks()))
+        for player in list(game.avail_players):
+            self.say(player, 'play ' + cards, channel)
+
+        if game.state == 'winner':
+            dealer = game.dealer
+            winner = random.randint(1, len(game.answers))
+            self.say(dealer, 'winner {0}'.format(winner), channel)
+            self.rounds += 1
+
+        # Give the background timers and score flushes a chance to run.
+        self.reactor.advance(1)
+        return True
+
+    def redraw(self, channel):
+        """ Whoever has a point to spend trades in a card. """
+        game = self.plugin.games[channel]
+        for player in list(game.players):
+            if game.get_score(player) > 0:
+                self.say(player, 'redraw 1', channel)
+                return
+
+    def kick(self, channel):
+        """ Everyone votes someone out, who then joins again. """
+        game = self.plugin.games[channel]
+        target = random.choice([p for p in game.players if p != game.dealer])
+        for player in list(game.players):
+            if player != target and target in game.players:
+                self.say(player, 'kick ' + target, channel)
+        self.say(target, 'join', channel)
+
+    def run(self, rounds, redraw_every=3, kick_every=10):
+        start = time.time()
+        queries = self.queries
+        for i in xrange(rounds):
+            for channel in self.channels:
+                if i % redraw_every == 0:
+                    self.redraw(channel)
+                if kick_every and i % kick_every == kick_every - 1:
+                    self.kick(channel)
+                self.play_round(channel)
+        elapsed = time.time() - start
+        return {
+            'rounds': self.rounds,
+            'rounds_per_sec': self.rounds / elapsed if elapsed else 0,
+            'queries_per_round': ((self.queries - queries) /
+                                  float(self.rounds or 1)),
+            'lines_per_round': self.bot.lines / float(self.rounds or 1),
+            'peak_mb': peak_memory(),
+        }
+
+
+def run_scenario(players, cards, rounds, channels, seed):
+    random.seed(seed)
+    timings = Timings()
+    with quiet():
+        bench = Bench(players, cards, max(cards // 5, 1), channels, timings,
+                      seed)
+        try:
+            result = bench.run(rounds)
+        finally:
+            bench.close()
+    result['timings'] = timings.summary()
+    return result
+
+
+def report(key, result):
+    print ("{0}: {rounds} rounds, {rounds_per_sec:.1f} rounds/s, "
+           "{queries_per_round:.2f} queries/round, "
+           "{lines_per_round:.1f} lines/round, "
+           "peak {peak_mb:.1f} MB".format(key, **result))
+    print "    {0:<18} {1:>7} {2:>9} {3:>9} {4:>9} {5:>9}".format(
+        'ms', 'calls', 'p50', 'p90', 'p99', 'max')
+    for name, row in sorted(result['timings'].items()):
+        print "    {0:<18} {1:>7} {2:>9.3f} {3:>9.3f} {4:>9.3f} {5:>9.3f}".format(
+            name, *row)
+
+
+def compare(results, baseline, tolerance):
+    """ Returns a line for each median that got slower than allowed. """
+    regressions = []
+    for key, result in sorted(results.items()):
+        before = baseline.get(key)
+        if before is None:
+            continue
+        for name, row in sorted(result['timings'].items()):
+            old = before['timings'].get(name)
+            # Anything under a microsecond is just noise.
+            if old is None or old[1] < 0.001:
+                continue
+            if row[1] > old[1] * (1 + tolerance):
+                regressions.append(
+                    "{0} {1}: p50 {2:.3f}ms, was {3:.3f}ms".format(
+                        key, name, row[1], old[1]))
+    return regressions
+
+
+def ints(text):
+    return [int(n) for n in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the game loop.")
+    parser.add_argument('--players', type=ints, default=[3, 8, 16],
+                        help="players per game, comma separated")
+    parser.add_argument('--cards', type=ints, default=[500, 5000, 50000],
+                        help="white cards in the deck, comma separated")
+    parser.add_argument('--rounds', type=int, default=200,
+                        help="rounds to play in each channel")
+    parser.add_argument('--channels', type=int, default=1,
+                        help="games to play side by side")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help="write the results to a json file")
+    parser.add_argument('--compare',
+                        help="json file of earlier results to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="how much slower a median may get, as a fraction")
+    args = parser.parse_args()
+
+    results = {}
+    for cards in args.cards:
+        for players in args.players:
+            key = '{0} players/{1} cards'.format(players, cards)
+            results[key] = run_scenario(players, cards, args.rounds,
+                                        args.channels, args.seed)
+            report(key, results[key])
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print "Slower: " + line
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
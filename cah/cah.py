@@ -1,99 +1,106 @@
+import json
+import os
 import time
 import random
 import re
-import urllib2
 from collections import defaultdict
 
 from hamper.interfaces import ChatCommandPlugin, Command
 from hamper.utils import ude
-from sqlalchemy import Column, Integer, String, Boolean, desc
-from sqlalchemy.ext.declarative import declarative_base
-from twisted.internet import reactor
-
-
-SQLAlchemyBase = declarative_base()
-
-
-class CardsAgainstHumanity(ChatCommandPlugin):
-    """ Play the classic card game Cards Against Humanity """
-
-    name = 'cah'
-
-    priority = 1
-
-    NUM_CARDS = 8
-    TIME_ALLOWED = 180 # 3 minutes.
-    TIMES_TO_CHECK = 3 # Check 3 times for now.
-
-    long_desc = ('!j or !join - Joins the game.\n'
-                 '!leave - Leaves the game.\n'
-                 '!p or !play <card #> - Plays a card. May play more than one.\n'
-                 '!winner <answer #> - Chooses a winner for a given prompt.'
-                 '!mystatus - Shows information about yourself.')
-
-    player_queue = []
-    dealer_queue = []
-
-    black_discard = []
-    white_discard = []
-
-    state = "join"
-
-    players = defaultdict(list)
-    prompt = ""
-    dealer = ""
-
-    #it is inefficient to build this list everytime we need it.
-    avail_players = []
-    answers = defaultdict(list)
-    kick_votes = defaultdict(list)
-
-    already_in = "[*] {0}, you are already a part of the game!"
-    not_in = "[*] {0}, you are not a part of the game!"
-
-    def setup(self, loader):
-        super(CardsAgainstHumanity, self).setup(loader)
-        self.db = loader.db
-        SQLAlchemyBase.metadata.create_all(self.db.engine)
-
-        flush = True
-        ct = self.db.session.query(CardTable)
-
-        # Update db if it's empty.
-        if ct.count() == 0 or flush:
-            self.flush_db()
-
-        whites = ct.filter_by(color="white").all()
-        blacks = ct.filter_by(color="black").all()
-        self.whites = [white.desc for white in whites]
-        self.blacks = [black.desc for black in blacks]
-
-        random.seed()
-
-        random.shuffle(self.whites) # Erry' day I'm shufflin'!
-        random.shuffle(self.blacks)
+from twisted.internet import defer, reactor, task, threads
+
+from . import importer
+from .dbpool import DBPool
+from .dbstore import DBStore
+from .deck import CardStore, Deck, Template, BLANK, BASE, CUSTOM, pack_name
+from .history import History, ago
+from .journal import Journal
+from .leaderboard import Leaderboard
+from .metrics import Metrics
+from .models import (SQLAlchemyBase, CardTable, SessionTable, RoundTable,
+                     add_missing_columns)
+from .ordered import OrderedSet
+from .outbox import Outbox
+from .pack import PackFile, PackStore
+from .profiler import Profiler
+from .scores import ScoreLedger
+from .search import CardIndex
+from .shards import Leases, IdBlock
+from .sync import CardSync, write_changes
+from .timers import TimerWheel
+
+
+class Game(object):
+    """ A single game of Cards Against Humanity, played in one channel """
+
+    __slots__ = ('plugin', 'channel', 'state', 'players', 'player_queue',
+                 'dealer_queue', 'prompt', 'dealer', 'avail_players',
+                 'answers', 'kick_votes', 'packs', 'whites', 'blacks',
+                 'session', 'timers', 'hands', 'audience', 'votes', 'tally',
+                 'shown')
+
+    def __init__(self, plugin, channel):
+        self.plugin = plugin
+        self.channel = channel
+
+        self.state = "join"
+
+        # Players come and go a lot in big channels, so everything about
+        # them is a dict or set.
+        self.players = defaultdict(list)
+        self.player_queue = OrderedSet()
+        self.dealer_queue = OrderedSet()
+        self.prompt = None
+        self.dealer = ""
+
+        # Whoever's answering this round, in the order answers are shown.
+        self.avail_players = OrderedSet()
+        self.answers = defaultdict(list)
+        self.kick_votes = defaultdict(set)
+        # Once the answers are shown, who gave each one by its number (from
+        # 0). Anyone who leaves has theirs withdrawn, and it's left None so
+        # the others keep their numbers.
+        self.shown = []
+
+        # In audience mode there's no dealer: everyone answers, and anyone in
+        # the channel can vote. {voter: answer}, and votes for each answer.
+        self.audience = channel in plugin.audience
+        self.votes = {}
+        self.tally = []
+
+        # The packs the game plays with, or None for all of them. Every game
+        # gets its own decks of ids into the plugin's card store.
+        packs = plugin.config['packs']
+        self.packs = set(packs) if packs else None
+        self.build_decks()
+
+        # The id scores are kept under, while a game is being played.
+        self.session = None
+
+        self.timers = TimerWheel(reactor)
+
+        # {player: (hand, {intro: lines})}, rendered hands to send.
+        self.hands = {}
 
     def remove_player(self, bot, comm, player):
         # Return cards to discard
-        self.white_discard += self.players[player]
+        self.discard(self.whites, self.players[player])
 
         # Remove player
         del(self.players[player])
+        self.hands.pop(player, None)
         if player in self.kick_votes:
             del(self.kick_votes[player])
 
-        if player in self.player_queue:
-            self.player_queue.remove(player)
-
-        while player in self.dealer_queue:
-            self.dealer_queue.remove(player)
+        self.player_queue.discard(player)
+        self.dealer_queue.discard(player)
 
         if self.state == "play":
             if player in self.avail_players:
                 if player in self.answers:
-                    self.white_discard += self.answers[player]
+                    self.discard(self.whites, self.answers[player])
                     del(self.answers[player])
-                self.avail_players.remove(player)
+                self.avail_players.discard(player)
             elif player == self.dealer:
                 bot.reply(comm, "[*] Game restarting... dealer left.")
                 self.reset(bot, comm)
@@ -104,107 +111,166 @@ class CardsAgainstHumanity(ChatCommandPlugin):
                 self.reset(bot, comm)
             # Check to see if all cards are now submitted.
             elif len(self.answers) == len(self.avail_players):
-                bot.reply(comm, "[*] All players cards are turned in.")
-                random.shuffle(self.avail_players)
-                self.show_answers(bot, comm)
-                self.change_state(bot, comm, 'winner')
+                bot.reply(comm, "[*] All players cards are turned in.",
+                          urgent=True)
+                self.start_judging(bot, comm)
 
         elif self.state == "winner":
+            answer = self.votes.pop(player, None)
+            if answer is not None:
+                self.tally[answer] -= 1
+            if player in self.avail_players:
+                self.withdraw(player)
+
             if player == self.dealer:
                 bot.reply(comm, "[*] Game restarting... Dealer left.")
                 self.reset(bot, comm)
+            elif len(self.players) < 3:
+                bot.reply(comm, "[*] There are less than 3 players playing "
+                            "now. Waiting for more players...")
+                self.reset(bot, comm)
+            elif not self.answers:
+                bot.reply(comm, "[*] There are no answers left to pick from.")
+                self.reset(bot, comm)
+            elif self.audience and all(p in self.votes for p in self.players):
+                self.close_votes(bot, comm)
 
         bot.reply(comm, self.current_players())
+        self.plugin.journal.touch(self)
+
+    def withdraw(self, player):
+        """ Take a shown answer back, along with any votes for it """
+        answer = self.shown.index(player)
+        self.shown[answer] = None
+        self.tally[answer] = 0
+        for voter in [v for v, a in self.votes.iteritems() if a == answer]:
+            del(self.votes[voter])
+        self.discard(self.whites, self.answers.pop(player))
+        self.avail_players.discard(player)
 
     def give_point(self, user):
-        player_str = self.get_player_str()
-        winner = self.db.session.query(CAHTable).filter_by(game=player_str,
-                                                      user=user).first()
-        try:
-            winner.score += 1
-        except AttributeError:
-            self.db.session.add(CAHTable(user, player_str, score=1))
-
-        for player in self.players:
-            if not self.db.session.query(CAHTable).filter_by(game=player_str, user=player).first():
-                self.db.session.add(CAHTable(user=player, game=player_str))
-
-        self.db.session.commit()
+        self.plugin.scores.add(self.session, user, 1, self.players)
+        self.plugin.leaderboard.add(self.channel, user, 1)
 
     def take_point(self, user):
-        player_str = self.get_player_str()
-        winner = self.db.session.query(CAHTable).filter_by(game=player_str,
-                                                      user=user).first()
-        if not winner or winner.score <= 0:
+        if self.plugin.scores.get(self.session, user) <= 0:
             return False
 
-        winner.score -= 1
-        for player in self.players:
-            if not self.db.session.query(CAHTable).filter_by(game=player_str, user=player).first():
-                self.db.session.add(CAHTable(user=player, game=player_str))
-
-        self.db.session.commit()
+        self.plugin.scores.add(self.session, user, -1, self.players)
+        self.plugin.leaderboard.add(self.channel, user, -1)
         return True
 
+    def hand_indices(self, user, text):
+        """
+        The card numbers in `text`, in order, if they're all different and
+        in `user`'s hand, otherwise None.
+        """
+        try:
+            indices = [int(i) for i in text.split()]
+        except ValueError:
+            return None
+        hand = len(self.players[user])
+        if (not indices or len(set(indices)) != len(indices) or
+                not all(1 <= i <= hand for i in indices)):
+            return None
+        return indices
+
     def deal(self, user):
-        while len(self.players[user]) < self.NUM_CARDS:
-            self.players[user].append(self.whites.pop(0))
+        while len(self.players[user]) < self.plugin.NUM_CARDS:
+            self.players[user].append(self.whites.draw())
+        self.read_ahead()
+        self.plugin.journal.touch(self)
 
     def reset(self, bot, comm):
         # Fill black discard
-        self.black_discard.append(self.prompt)
+        if self.prompt is not None:
+            self.discard(self.blacks, [self.prompt])
+            self.prompt = None
 
-        # Fill white discard
+        # Fill white discard. The decks take discards back in as they go.
         for p in self.avail_players:
-            for c in self.answers[p]:
-                self.white_discard.append(c)
+            self.discard(self.whites, self.answers[p])
 
         self.answers.clear()
         self.kick_votes.clear()
 
-        # Put discards back in deck
-        if len(self.black_discard) > len(self.blacks) * 2:
-            self.blacks += self.black_discard
-            random.shuffle(self.blacks)
-            self.black_discards = []
-
-        if len(self.white_discard) > len(self.whites) * 2:
-            self.whites += self.white_discard
-            random.shuffle(self.whites)
-            self.white_discards = []
-
-        # Fill up dealer_queue
-        for p in self.players:
-            if p not in self.player_queue:
-                self.player_queue += [p]
-
+        # Everyone queued joins, and everyone's hand is topped up.
         for p in self.player_queue:
             if p not in self.players:
                 bot.reply(comm, '{0} has joined the game!'.format(p))
+                self.deal(p)
+        self.player_queue.clear()
+        for p in self.players:
             self.deal(p)
-        del(self.player_queue[:])
 
         if len(self.players) > 2:
             self.prep_play(bot, comm)
         else:
             self.change_state(bot, comm, 'join')
 
-    def start_afk_watcher(self, bot, comm, prompt, state, player, count=1):
-        if (state == self.state and prompt == self.prompt
-                and count < self.TIMES_TO_CHECK
-                and player not in self.answers):
+    def start_afk_watcher(self, bot, comm, count=1):
+        """
+        Check on everyone the round is waiting for, all in one go. They get
+        reminded the first few times, then kicked.
+        """
+        state = self.state
+        prompt = self.prompt
+        waiting = self.waiting_on()
+
+        if self.audience:
+            return self.watch_audience(bot, comm, count)
+
+        if count < self.plugin.TIMES_TO_CHECK:
             say_for_state = {
                 'play': 'Please play a card.',
                 'winner': 'Please pick a winner.',
             }
-            bot.notice(player, say_for_state.get(state, 'Do something!'))
-            reactor.callLater(self.TIME_ALLOWED/self.TIMES_TO_CHECK,
-                              self.start_afk_watcher,
-                              bot, comm, prompt, state, player,
-                              count=count + 1)
-        elif self.should_kick(player, prompt, state):
-            bot.reply(comm, '{0} has been kicked for taking too long.'.format(player))
-            self.remove_player(bot, comm, player)
+            for player in waiting:
+                bot.notice(player, say_for_state.get(state, 'Do something!'),
+                           urgent=True)
+            self.watch_afk(bot, comm, count + 1)
+        else:
+            for player in waiting:
+                # Kicking someone can end the round, so check each time.
+                if self.should_kick(player, prompt, state):
+                    bot.reply(comm, '{0} has been kicked for taking too long.'.format(player),
+                              urgent=True)
+                    self.remove_player(bot, comm, player)
+
+    def watch_audience(self, bot, comm, count):
+        """
+        Nobody's kicked in audience mode. Once time's up, the round goes on
+        with whatever answers or votes are in.
+        """
+        if count < self.plugin.TIMES_TO_CHECK:
+            if self.state == 'play':
+                bot.reply(comm, "[*] {0} of {1} answers are in.".format(
+                    len(self.answers), len(self.avail_players)))
+            else:
+                bot.reply(comm, "[*] {0} votes so far.".format(len(self.votes)))
+            return self.watch_afk(bot, comm, count + 1)
+
+        if self.state == 'winner':
+            self.close_votes(bot, comm)
+        elif len(self.answers) >= 2:
+            bot.reply(comm, "[*] Time's up!", urgent=True)
+            self.start_judging(bot, comm)
+        else:
+            bot.reply(comm, "[*] Not enough answers came in, dealing again.")
+            self.reset(bot, comm)
+
+    def watch_afk(self, bot, comm, count=1):
+        watcher = self.plugin.profiler.wrap(self.start_afk_watcher,
+                                            counted=False)
+        self.timers.schedule(self.plugin.TIME_ALLOWED/self.plugin.TIMES_TO_CHECK,
+                             watcher, bot, comm, count=count)
+
+    def waiting_on(self):
+        if self.state == 'play':
+            return [p for p in self.avail_players if p not in self.answers]
+        elif self.state == 'winner' and not self.audience:
+            return [self.dealer]
+        return []
 
     def should_kick(self, player, prompt, state):
         still_playing = self.players.get(player)
@@ -228,28 +294,41 @@ class CardsAgainstHumanity(ChatCommandPlugin):
 
     def change_state(self, bot, comm, state):
         self.state = state
-        interval = self.TIME_ALLOWED/self.TIMES_TO_CHECK
-        if state == 'play':
-            for player in filter(lambda x: x != self.dealer, self.players):
-                reactor.callLater(interval, self.start_afk_watcher,
-                                  bot, comm, str(self.prompt), str(self.state),
-                                  str(player))
-        elif state == 'winner':
-            reactor.callLater(interval, self.start_afk_watcher,
-                              bot, comm, str(self.prompt), str(self.state),
-                              str(self.dealer))
-
-    def prep_play(self, bot, comm):
-        if not self.dealer_queue:
-            self.dealer_queue += self.players
+        self.plugin.journal.touch(self)
+        if state == 'join' and self.session is not None:
+            # Not enough players, so whoever plays next is a new game.
+            self.plugin.scores.close(self.session)
+            self.session = None
 
-        self.dealer = self.dealer_queue.pop(0)
-        self.prompt = self.blacks.pop(0)
-        self.avail_players = [p for p in self.players if p != self.dealer]
+        # Whatever the last state was waiting for doesn't matter any more.
+        self.timers.cancel_all()
+        if state in ('play', 'winner'):
+            self.watch_afk(bot, comm)
 
-        bot.reply(comm, "[*] {0} reads: {1}".format(self.dealer, self.prompt))
+    def prep_play(self, bot, comm):
+        if self.session is None:
+            self.session = self.plugin.scores.new_session(
+                self.channel, self.plugin.term(self.channel))
+
+        # Changes to audience mode wait for a new round.
+        self.audience = self.channel in self.plugin.audience
+        if self.audience:
+            self.dealer = ""
+            self.avail_players = OrderedSet(self.players)
+        else:
+            if not self.dealer_queue:
+                self.dealer_queue.update(self.players)
+            self.dealer = self.dealer_queue.pop()
+            self.avail_players = OrderedSet(p for p in self.players
+                                            if p != self.dealer)
+        self.prompt = self.blacks.draw()
+
+        bot.reply(comm, "[*] {0} reads: {1}".format(
+                      self.dealer or "The audience", self.prompt_text()),
+                  urgent=True)
         bot.reply(comm, "[*] Type: \"!play <card #>\" to fill blanks. Multiple "
-                        "cards are played with \"!play <card #> <card #>\".")
+                        "cards are played with \"!play <card #> <card #>\".",
+                  urgent=True)
 
         for p in self.players:
             self.deal(p)
@@ -260,66 +339,704 @@ class CardsAgainstHumanity(ChatCommandPlugin):
 
         self.change_state(bot, comm, 'play')
 
+    def start_judging(self, bot, comm):
+        """ Show the answers, in a random order, and start picking one """
+        self.avail_players = OrderedSet(p for p in self.avail_players
+                                        if p in self.answers)
+        self.avail_players.shuffle()
+        self.shown = list(self.avail_players)
+        self.votes.clear()
+        self.tally = [0] * len(self.shown)
+        self.show_answers(bot, comm)
+        self.change_state(bot, comm, 'winner')
+
+    def vote(self, voter, answer):
+        """ Count a vote for an answer (from 0), replacing any earlier one """
+        old = self.votes.get(voter)
+        if old is not None:
+            self.tally[old] -= 1
+        self.votes[voter] = answer
+        self.tally[answer] += 1
+        self.plugin.journal.touch(self)
+
+    def close_votes(self, bot, comm):
+        """ The answer with the most votes wins. Ties go to the first shown. """
+        if not any(self.tally):
+            bot.reply(comm, "[*] Nobody voted, so nobody wins this round.")
+            return self.reset(bot, comm)
+        best = max(xrange(len(self.tally)), key=self.tally.__getitem__)
+        winner = self.shown[best]
+        bot.reply(comm, "[*] {0}, you won this round with {1} vote{2}! "
+                  "Congrats!".format(winner, self.tally[best],
+                                     (self.tally[best] > 1) * 's'),
+                  urgent=True)
+        self.win(bot, comm, winner)
+
+    def win(self, bot, comm, winner):
+        self.record_round(winner)
+        self.give_point(winner)
+        self.show_top_scores(bot, comm)
+        self.reset(bot, comm)
+
+    def deck(self, color):
+        return self.whites if color == 'white' else self.blacks
+
+    def build_decks(self):
+        """ Fresh decks of the game's packs, less the cards in play """
+        cards = self.plugin.cards
+        self.whites = Deck(cards.pack_ranges('white', self.packs))
+        self.blacks = Deck(cards.pack_ranges('black', self.packs))
+        for held in (self.players, self.answers):
+            for hand in held.itervalues():
+                for card in hand:
+                    self.whites.remove(card)
+        if self.prompt is not None:
+            self.blacks.remove(self.prompt)
+        self.read_ahead()
+
+    def read_ahead(self):
+        """
+        Pick the cards the next round will draw, and start reading their
+        texts, so they don't have to be read on the spot when they're shown.
+        """
+        # Everyone might play three cards, and someone new join.
+        whites = len(self.players) * 3 + self.plugin.NUM_CARDS
+        self.plugin.cards.prefetch(self.whites.peek(whites) +
+                                   self.blacks.peek(1))
 
-    def colorize(self, txt):
-        if txt == '_' * 10:
-            # Returns the light cyan color code
-            return "\x0311" + txt + "\x03"
-        # Returns the light green color code
-        return "\x0309" + txt + "\x03"
+    def plays(self, pack):
+        return self.packs is None or pack in self.packs
 
-    def get_player_str(self):
-        return ' '.join(sorted(self.players.keys(), key=lambda x: x))
+    def discard(self, deck, cards):
+        """
+        Put `cards` in `deck`'s discards, leaving out any from packs the game
+        has stopped playing with since they were dealt.
+        """
+        if self.packs is not None:
+            pack = self.plugin.cards.pack
+            cards = [card for card in cards if self.plays(pack(card))]
+        deck.discard_all(cards)
+
+    def has_cards(self):
+        return all(len(deck) or len(deck.discards)
+                   for deck in (self.whites, self.blacks))
+
+    def dump(self):
+        """ Everything needed to pick the game up again after a restart """
+        if not self.players and not self.player_queue:
+            return {'channel': self.channel, 'gone': True}
+
+        # Card ids can change between restarts, so cards go by their text.
+        texts = self.plugin.cards
+        texts.fetch([c for held in (self.players, self.answers)
+                     for cards in held.itervalues() for c in cards])
+        def hands(held):
+            return dict((p, [texts[c] for c in cards])
+                        for p, cards in held.iteritems())
+
+        return {
+            'channel': self.channel,
+            'state': self.state,
+            'players': hands(self.players),
+            'answers': hands(self.answers),
+            'player_queue': list(self.player_queue),
+            'dealer_queue': list(self.dealer_queue),
+            'dealer': self.dealer,
+            'avail_players': list(self.avail_players),
+            'prompt': self.prompt_text() if self.prompt is not None else None,
+            'session': self.session,
+            # Handed over with the game when another process takes it.
+            'scores': dict(self.plugin.scores.scores(self.session)),
+            'packs': sorted(self.packs) if self.packs is not None else None,
+            'audience': self.audience,
+            'audience-next': self.channel in self.plugin.audience,
+            'votes': self.votes,
+            'shown': self.shown,
+        }
+
+    def restore(self, record):
+        """ Pick up where a dumped game left off. """
+        cards = self.plugin.cards
+        def ids(texts, color):
+            found = (cards.find(text, color) for text in texts)
+            # Cards deleted since are just gone.
+            return [c for c in found if c is not None]
+
+        for player, hand in record['players'].iteritems():
+            self.players[player] = ids(hand, 'white')
+        for player, hand in record['answers'].iteritems():
+            self.answers[player] = ids(hand, 'white')
+        self.player_queue = OrderedSet(record['player_queue'])
+        self.dealer_queue = OrderedSet(record['dealer_queue'])
+        self.dealer = record['dealer']
+        self.avail_players = OrderedSet(record['avail_players'])
+        self.session = record['session']
+        self.state = record['state']
+        self.audience = record.get('audience', False)
+        if record.get('audience-next', self.audience):
+            self.plugin.audience.add(self.channel)
+        else:
+            self.plugin.audience.discard(self.channel)
+        if self.state == 'winner':
+            self.shown = record.get('shown', list(self.avail_players))
+            self.votes = record.get('votes', {})
+            self.tally = [0] * len(self.shown)
+            for answer in self.votes.itervalues():
+                self.tally[answer] += 1
+        if record['prompt'] is not None:
+            self.prompt = cards.find(record['prompt'], 'black')
+        packs = record.get('packs', self.packs)
+        self.packs = set(packs) if packs is not None else None
+
+        # The decks are everything that isn't in someone's hand.
+        self.build_decks()
+
+        if self.state in ('play', 'winner') and self.prompt is None:
+            # The prompt's gone from the db, so the round starts over.
+            for player, hand in self.answers.iteritems():
+                self.players[player] += hand
+            self.answers.clear()
+            self.prompt = self.blacks.draw()
+            self.state = 'play'
+
+    def resume(self, bot, comm):
+        """ Restart the timers of a restored game. """
+        if self.state in ('play', 'winner'):
+            self.watch_afk(bot, comm)
+
+    def prompt_text(self):
+        if self.prompt is None:
+            return ""
+        return self.plugin.cards[self.prompt]
+
+    def blanks(self):
+        if self.prompt is None:
+            return 0
+        return self.plugin.cards.blanks(self.prompt)
+
+    def hand_lines(self, name, intro="Your hand is: "):
+        """
+        A player's numbered hand, split into lines that fit on IRC. Hands are
+        only rendered again once their cards change.
+        """
+        hand = tuple(self.players[name])
+        cached = self.hands.get(name)
+        if cached is None or cached[0] != hand:
+            cached = self.hands[name] = (hand, {})
+        lines = cached[1].get(intro)
+        if lines is None:
+            lines = cached[1][intro] = self.render_hand(hand, intro)
+        return lines
+
+    def render_hand(self, hand, intro):
+        cards = self.plugin.cards
+        limit = self.plugin.config['line-bytes']
+
+        cards.fetch(hand)
+        lines = []
+        line = intro + '['
+        empty = True
+        for i, card in enumerate(hand):
+            text = cards[card]
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            piece = '{0}: {1}'.format(i + 1, text)
+            # Lines are measured in bytes, leaving room for the closing ].
+            if not empty and len(line) + 2 + len(piece) + 1 > limit:
+                lines.append(line)
+                line = piece
+            else:
+                line += piece if empty else '. ' + piece
+            empty = False
+        lines.append(line + ']')
+        return lines
+
+    def record_round(self, winner):
+        """ Archive the round that's just been won """
+        cards = self.plugin.cards
+        answers = [(p, [cards[c] for c in self.answers[p]])
+                   for p in self.avail_players]
+        self.plugin.history.add(self.channel, self.session, self.prompt_text(),
+                                answers, winner)
 
     def show_top_scores(self, bot, comm, current_players=True):
         if current_players:
-            player_str = self.get_player_str()
-            print player_str
-            top = self.db.session.query(CAHTable).filter_by(game=player_str).order_by(
-                    CAHTable.score.desc()).all()
+            top = self.plugin.scores.scores(self.session)[:5]
         else:
-            top = self.db.session.query(CAHTable).order_by(
-                        CAHTable.score.desc().all())
+            top = self.plugin.leaderboard.top(5)
 
         scores_str = '{:^14} {:^14}\n____________________________'
         bot.reply(comm, scores_str.format('User', 'Score'))
-        scores_str = '{:^14}|{:^14}'
-        num_top = 5 if len(top) > 4 else len(top)
-        scores = '\n'.join([scores_str.format(top[x].user, str(top[x].score))
-                            for x in xrange(num_top)])
+        # Nicks are unicode, once they've been through the scores.
+        scores_str = u'{:^14}|{:^14}'
+        scores = u'\n'.join([scores_str.format(user, str(score))
+                            for user, score in top])
         bot.reply(comm, scores)
 
     def get_score(self, player):
-        player_str = self.get_player_str()
-        player_obj = (self.db.session.query(CAHTable)
-                        .filter_by(game=player_str)
-                        .filter_by(user=player)
-                        .first())
+        return self.plugin.scores.get(self.session, player)
+
+    def show_hand(self, bot, name):
+        print "Showing hand for: " + name
+        for line in self.hand_lines(name):
+            bot.notice(name, line, urgent=True)
+
+    def show_answers(self, bot, comm):
+        texts = self.plugin.cards
+        prompt = texts.template(self.prompt)
+        texts.fetch([c for player in self.avail_players
+                     for c in self.answers[player]])
+        for i, player in enumerate(self.shown):
+            if player is None:
+                continue
+            cards = prompt.fill([texts[c] for c in self.answers[player]])
+            text = ("[*] [Answer #{0}]: {1}".format(i + 1, cards))
+            bot.reply(comm, text, urgent=True)
+
+        if self.audience:
+            bot.reply(comm, "[*] Vote for the best answer with "
+                      "\"!vote <answer #>\".", urgent=True)
+        else:
+            bot.reply(comm, "[*] {0}, please choose a winner with "
+                        "\"!winner <answer #>\".".format(self.dealer), urgent=True)
+
+
+    def current_players(self):
+        players = ', '.join(p for p in self.players) + '.'
+        return "[*] Current players: " + players
+
+    def queued_players(self):
+        players = ', '.join(p for p in self.player_queue) + '.'
+        return "[*] Queued Players: " + players
+
+
+class CardsAgainstHumanity(ChatCommandPlugin):
+    """ Play the classic card game Cards Against Humanity """
+
+    name = 'cah'
+
+    priority = 1
+
+    NUM_CARDS = 8
+    TIME_ALLOWED = 180 # 3 minutes.
+    TIMES_TO_CHECK = 3 # Check 3 times for now.
+
+    long_desc = ('!j or !join - Joins the game.\n'
+                 '!leave - Leaves the game.\n'
+                 '!p or !play <card #> - Plays a card. May play more than one.\n'
+                 '!winner <answer #> - Chooses a winner for a given prompt.'
+                 '!mystatus - Shows information about yourself.')
 
-        if player_obj:
-            return player_obj.score
-        return 0
+    already_in = "[*] {0}, you are already a part of the game!"
+    not_in = "[*] {0}, you are not a part of the game!"
 
-    def flush_db(self):
+    def setup(self, loader):
+        self.config = loader.config.get('cah', {})
+        defaults = {
+            'cards-url': "http://web.engr.oregonstate.edu/~johnsdea/",
+            'cache-dir': os.path.expanduser('~/.cache/cah'),
+            'sync-cards': True,
+            'card-pack': None,
+            'card-cache': None,
+            'packs': None,
+            'audience-channels': [],
+            'score-spool': None,
+            'db-threads': None,
+            'send-rate': 0.5,
+            'send-burst': 5,
+            'send-total-rate': 1.0,
+            'send-total-burst': 10,
+            'line-bytes': 400,
+            'metrics-file': None,
+            'metrics-interval': 15,
+            'profile-dir': None,
+            'profile-setup': False,
+            'journal': None,
+            'journal-interval': 1.0,
+            'seed': None,
+            'shard': None,
+            'shard-ttl': 30,
+            'shard-refresh': 300,
+        }
+        for key, val in defaults.items():
+            self.config.setdefault(key, val)
+
+        self.profiler = Profiler(self.config['profile-dir'] or
+                                 os.path.join(self.config['cache-dir'],
+                                              'profiles'),
+                                 reactor)
+        if self.config['profile-setup']:
+            # Stops, and writes the profile, as soon as setup is done.
+            self.profiler.start(calls=1)
+        self.profiler.wrap(self.start_up)(loader)
+
+    def start_up(self, loader):
+        super(CardsAgainstHumanity, self).setup(loader)
+        self.db = loader.db
+        SQLAlchemyBase.metadata.create_all(self.db.engine)
+        add_missing_columns(self.db.engine)
+
+        # Anything slow the db does once the bot's going is done in here.
+        self.dbpool = DBPool(self.db, reactor, self.config['db-threads'])
+        self.dbpool.start()
+
+        if self.config['card-pack']:
+            # Card text stays on disk until it's needed.
+            self.cards = PackStore(PackFile(self.config['card-pack']))
+        elif self.config['card-cache']:
+            # Only ids are kept, and texts are read as they're shown.
+            self.cards = DBStore(self.db.session, self.config['card-cache'],
+                                 pool=self.dbpool)
+            self.cards.load()
+        else:
+            self.cards = CardStore()
+            # Read pack by pack, so each pack is as few ranges as it can be.
+            query = (self.db.session.query(CardTable.desc, CardTable.color,
+                                           CardTable.pack, CardTable.official)
+                     .order_by(CardTable.pack, CardTable.official,
+                               CardTable.color, CardTable.id))
+            for desc, color, pack, official in query:
+                self.cards.add(desc, color, pack_name(pack, official))
+
+        # Packs and cards read as needed are indexed in the pool instead, so
+        # they still start up instantly.
+        self.search = CardIndex(self.cards)
+        if type(self.cards) is CardStore:
+            self.search.build()
+        else:
+            self.search.build_in(self.dbpool)
+
+        # Decks shuffle as they're drawn from. Without a seed, it comes from
+        # the OS; the bench and simulator pass theirs so runs repeat.
+        random.seed(self.config['seed'])
+
+        # One game per channel, created the first time it is needed.
+        self.games = {}
+        # Channels playing in audience mode.
+        self.audience = set(self.config['audience-channels'])
+
+        # Scores are written to the db in batches, behind the games' backs.
+        spool = (self.config['score-spool'] or
+                 os.path.join(self.config['cache-dir'], 'scores.spool'))
+
+        # With a shard name, channels are split between every process
+        # sharing the db, so ids the processes make up come from the db.
+        sessions = rounds = None
+        if self.config['shard']:
+            sessions = IdBlock(self.dbpool, SessionTable.id)
+            rounds = IdBlock(self.dbpool, RoundTable.id, 1000)
+
+        self.scores = ScoreLedger(self.dbpool, spool, ids=sessions,
+                                  clock=reactor)
+        self.scores.start()
+
+        # Rounds are archived in batches too, and cards' stats kept in memory.
+        self.history = History(self.dbpool, ids=rounds, clock=reactor)
+        self.history.start()
+
+        # Totals are read once, after the spool's been replayed, then kept
+        # up to date as points change.
+        self.leaderboard = Leaderboard()
+        self.leaderboard.load(self.db.session)
+
+        # Games that were going when the bot stopped carry on where they were.
+        journal = (self.config['journal'] or
+                   os.path.join(self.config['cache-dir'], 'games.journal'))
+        self.journal = Journal(journal, self.config['journal-interval'],
+                               clock=reactor)
+        self.recovered = {}
+        for channel, record in self.journal.recover().iteritems():
+            game = self.games[channel] = Game(self, channel)
+            game.restore(record)
+            self.recovered[channel] = game
+
+        self.leases = None
+        if self.config['shard']:
+            self.start_shard()
+
+        if self.recovered:
+            print "Recovered {0} games.".format(len(self.recovered))
+
+        # Everything the games say is queued, so they can't flood anyone.
+        self.outbox = Outbox(reactor, rate=self.config['send-rate'],
+                             burst=self.config['send-burst'],
+                             total_rate=self.config['send-total-rate'],
+                             total_burst=self.config['send-total-burst'],
+                             line_bytes=self.config['line-bytes'])
+
+        # Every command is timed, and every db statement counted.
+        self.metrics = Metrics(self.gauges, clock=reactor)
+        self.metrics.watch_engine(self.db.engine)
+        for cmd in self.commands:
+            cmd.command = self.metrics.timed(cmd.name,
+                                             self.profiler.wrap(cmd.command))
+        if self.config['metrics-file']:
+            self.metrics.start(self.config['metrics-file'],
+                               self.config['metrics-interval'])
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.shutdown)
+
+        # Official cards are brought up to date in the background.
+        self.card_sync = CardSync(self.config['cards-url'],
+                                  self.config['cache-dir'])
+        if self.config['sync-cards']:
+            self.sync_cards()
+
+    def start_shard(self):
+        """
+        Run only the channels this process holds the lease for. Recovered
+        games are kept if their lease is still to be had, and replaced by the
+        game saved with it if another process has had it since.
         """
-        Clear out old cards, and bring in new ones.
+        self.leases = Leases(self.dbpool, self.config['shard'],
+                             self.config['shard-ttl'],
+                             states=lambda: self.journal.latest,
+                             claimed=self.claimed, lost=self.lost,
+                             clock=reactor)
+        for channel in list(self.games):
+            if not self.leases.claim_now(channel):
+                self.lost(channel)
+        self.leases.start()
+
+        # Other processes' points only reach this one through the db.
+        self.refresh = task.LoopingCall(self.refresh_leaderboard)
+        self.refresh.clock = reactor
+        self.refresh.start(self.config['shard-refresh'], now=False)
+
+    def claimed(self, channel, previous, record):
+        """ This process has taken a channel's lease. """
+        term = self.leases.terms[channel]
+        if previous in (None, self.config['shard']) and channel in self.games:
+            # Nobody else has had it, so the game here is the latest.
+            session = self.games[channel].session
+            if session is not None:
+                self.scores.fence(session, channel, term)
+            return
+        self.lost(channel)
+        self.history.recent.pop(channel, None)
+        if record is None:
+            return
+
+        record = json.loads(record)
+        game = self.games[channel] = Game(self, channel)
+        game.restore(record)
+        if game.session is not None:
+            # The scores go back to how they were when the game was saved,
+            # same as the game.
+            self.scores.adopt(game.session, channel,
+                              record.get('scores', {}), term)
+        self.recovered[channel] = game
+        self.journal.touch(game)
+
+    def term(self, channel):
+        """ The term this process holds a channel's lease under, if sharded """
+        if self.leases is None:
+            return None
+        return self.leases.terms.get(channel)
+
+    def lost(self, channel):
+        """ Another process has a channel's lease, so stop playing there. """
+        game = self.games.pop(channel, None)
+        self.recovered.pop(channel, None)
+        self.journal.forget(channel)
+        if game is not None:
+            game.timers.cancel_all()
+            self.scores.close(game.session)
+
+    def refresh_leaderboard(self):
+        def load(session):
+            leaderboard = Leaderboard()
+            leaderboard.load(session)
+            return leaderboard
+
+        def loaded(leaderboard):
+            # Points given here since the last batch aren't in the db yet.
+            for (channel, nick), points in self.scores.unwritten().iteritems():
+                leaderboard.add(channel, nick, points)
+            self.leaderboard = leaderboard
+
+        d = self.scores.between_batches(load)
+        d.addCallback(loaded)
+        d.addErrback(lambda failure: failure.printTraceback())
+        return d
+
+    def message(self, bot, comm):
+        if (self.leases is not None and not comm['pm'] and
+                comm['channel'] not in self.leases.owned):
+            # Handled here only once the channel's lease has been claimed.
+            d = self.leases.claim(comm['channel'])
+            d.addCallback(lambda got: got and self.message(bot, comm))
+            return
+
+        bot = self.outbox.wrap(bot)
+        if self.recovered and not comm['pm']:
+            # Timers don't survive a restart, so they wait for a bot to use.
+            game = self.recovered.pop(comm['channel'], None)
+            if game is not None:
+                game.resume(bot, comm)
+        return super(CardsAgainstHumanity, self).message(bot, comm)
+
+    def shutdown(self):
+        self.profiler.stop()
+        self.metrics.stop()
+        self.journal.stop()
+        # The reactor waits for the last batch of scores, if one's in flight.
+        d = defer.maybeDeferred(self.scores.stop)
+        d.addBoth(lambda _: self.history.stop())
+        if self.leases is not None:
+            # Leases go last, so whoever takes over finds everything written.
+            self.refresh.stop()
+            d.addBoth(lambda _: self.leases.stop())
+        d.addBoth(lambda _: self.dbpool.stop())
+        return d
+
+    def gauges(self):
+        """ The plugin's current state, for Metrics """
+        gauges = [
+            ('cah_games', {}, len(self.games)),
+            ('cah_cards', {}, len(self.cards)),
+            ('cah_timers_pending', {}, len(reactor.getDelayedCalls())),
+            ('cah_scores_pending', {}, len(self.scores.pending)),
+            ('cah_rounds_pending', {}, len(self.history.pending)),
+            ('cah_db_jobs', {}, self.dbpool.jobs),
+            ('cah_lines_queued', {}, len(self.outbox)),
+            ('cah_lines_sent_total', {}, self.outbox.sent),
+            ('cah_lines_merged_total', {}, self.outbox.merged),
+        ]
+        if self.leases is not None:
+            gauges.append(('cah_channels_leased', {}, len(self.leases.owned)))
+        for channel, game in self.games.iteritems():
+            labels = {'channel': channel}
+            gauges.append(('cah_players', labels, len(game.players)))
+            gauges.append(('cah_game_timers', labels, len(game.timers)))
+            for color in ('white', 'black'):
+                labels = {'channel': channel, 'color': color}
+                deck = game.deck(color)
+                gauges.append(('cah_deck_cards', labels, len(deck)))
+                gauges.append(('cah_discards', labels, len(deck.discards)))
+        return gauges
+
+    def get_game(self, comm):
         """
-        self.db.session.query(CardTable).filter_by(official=True).delete()
+        Look up the game for the channel a message came from. Private messages
+        go to whichever game the user is playing in.
+        """
+        if comm['pm']:
+            user = comm['user']
+            for game in self.games.itervalues():
+                if user in game.players or user in game.player_queue:
+                    return game
+            channel = user
+        else:
+            channel = comm['channel']
 
-        url = "http://web.engr.oregonstate.edu/~johnsdea/"
+        game = self.games.get(channel)
+        if game is None:
+            game = self.games[channel] = Game(self, channel)
+        return game
 
-        whites_txt = urllib2.urlopen(url + "whites.txt").read().split("\n")
-        blacks_txt = urllib2.urlopen(url + "blacks.txt").read().split("\n")
-        new_whites = map(self.format_white, whites_txt)
-        for white in new_whites:
-            if white:
-                self.db.session.add(CardTable(ude(white), "white"))
-        new_blacks = map(self.init_black, blacks_txt)
-        for black in new_blacks:
-            if black:
-                self.db.session.add(CardTable(ude(black), "black"))
+    def colorize(self, txt):
+        if txt == BLANK:
+            # Returns the light cyan color code
+            return "\x0311" + txt + "\x03"
+        # Returns the light green color code
+        return "\x0309" + txt + "\x03"
 
-        self.db.session.commit()
+    def sync_cards(self):
+        """
+        Bring the official cards up to date, without blocking the reactor.
+        """
+        d = self.card_sync.fetch()
+        d.addCallback(self.apply_card_sync)
+        d.addErrback(lambda failure: failure.printTraceback())
+        return d
+
+    def apply_card_sync(self, changed):
+        """
+        Write only the difference between the fetched card lists and the
+        official cards in the db, in the db pool. Cards that were removed stay
+        in the decks of running games until the next restart.
+        """
+        formatters = {'white': self.format_white, 'black': self.init_black}
+        ds = []
+        for color, (lines, digest) in changed.items():
+            fetched = set(ude(card) for card in map(formatters[color], lines)
+                          if card)
+            d = self.dbpool.run(write_changes, color, fetched)
+            d.addCallback(self.card_sync_written, color, digest)
+            ds.append(d)
+        return defer.gatherResults(ds, consumeErrors=True)
+
+    def card_sync_written(self, result, color, digest):
+        added, removed = result
+        self.card_sync.applied(color, digest)
+        for desc in added:
+            self.add_card(desc, color, BASE)
+        print "Synced {0} cards: {1} added, {2} removed.".format(
+            color, len(added), removed)
+
+    def add_card(self, desc, color, pack):
+        """
+        Make a card that's just been put in the db playable, in every game
+        playing with its pack.
+        """
+        new = len(self.cards)
+        card = self.cards.add(desc, color, pack)
+        if card < new:
+            # Already a card, and already in the decks or someone's hand.
+            return card
+        self.search.add(card, desc, color)
+        for game in self.games.itervalues():
+            if game.plays(pack):
+                game.deck(color).discard(card)
+        return card
+
+    def import_pack(self, path, color=None):
+        """
+        Import a pack of cards, named after its file, parsing it in a thread
+        so the reactor keeps going. Fires with (cards added, duplicates
+        skipped, rejects).
+        """
+        formatters = {'white': self.format_white, 'black': self.init_black}
+
+        def parse():
+            with open(path, 'rb') as f:
+                return importer.parse(f, importer.guess_format(path),
+                                      formatters, color)
+
+        pack = importer.pack_for(path)
+
+        def insert(parsed):
+            return self.search.when_built().addCallback(dedupe, parsed)
+
+        def dedupe(indexed, parsed):
+            if not indexed:
+                raise ValueError("the cards couldn't be indexed to check "
+                                 "for duplicates")
+            cards, rejects = parsed
+            # The index lives on the reactor thread; only the insert doesn't.
+            added, duplicates = importer.dedupe(cards, self.search)
+            # Held until they're in, so a card added meanwhile can't double up.
+            reserved = [card for card in added if self.search.reserve(*card)]
+            duplicates += len(added) - len(reserved)
+            d = self.dbpool.run(importer.write, reserved, pack)
+            d.addCallback(inserted, reserved, duplicates, rejects)
+            d.addBoth(release, reserved)
+            return d
+
+        def release(result, added):
+            for desc, card_color in added:
+                self.search.release(desc, card_color)
+            return result
+
+        def inserted(result, added, duplicates, rejects):
+            for desc, card_color in added:
+                self.add_card(desc, card_color, pack)
+            print "Imported {0}: {1} added, {2} duplicates, {3} rejected.".format(
+                path, len(added), duplicates, len(rejects))
+            return len(added), duplicates, rejects
+
+        return threads.deferToThread(parse).addCallback(insert)
 
     def format_white(self, card):
         card = card.strip("\n")
@@ -333,38 +1050,8 @@ class CardsAgainstHumanity(ChatCommandPlugin):
         if card:
             if "__________" not in card:
                 card += " __________."
-            return ''.join(map(self.colorize, re.split("(" + '_'*10 + ")", card)))
-
-    def format_black(self, card):
-        for x in xrange(card.count("__________")):
-            card = card.replace("__________", "{" + str(x) + "}", 1)
-        return card
-
-    def show_hand(self, bot, name):
-        print "Showing hand for: " + name
-        cards = '. '.join((str(x + 1) + ": " + self.players[name][x]
-                            for x in xrange(len(self.players[name]))))
-
-        bot.notice(name, "Your hand is: [{0}]".format(cards))
-
-    def show_answers(self, bot, comm):
-        for i, player in enumerate(self.avail_players):
-            prompt = self.format_black(self.prompt)
-            cards = prompt.format(*self.answers[player])
-            text = ("[*] [Answer #{0}]: {1}".format(i + 1, cards))
-            bot.reply(comm, text)
-
-        bot.reply(comm, "[*] {0}, please choose a winner with "
-                    "\"!winner <answer #>\".".format(self.dealer))
-
-
-    def current_players(self):
-        players = ', '.join(p for p in self.players) + '.'
-        return "[*] Current players: " + players
-
-    def queued_players(self):
-        players = ', '.join(p for p in self.player_queue) + '.'
-        return "[*] Queued Players: " + players
+            blank = self.colorize(BLANK)
+            return blank.join(map(self.colorize, card.split(BLANK)))
 
     class Join(Command):
         """ Join/Queue up for a game """
@@ -377,27 +1064,32 @@ class CardsAgainstHumanity(ChatCommandPlugin):
 
         def command(self, bot, comm, groups):
             print "intercepted join command!"
+            game = self.plugin.get_game(comm)
             user = comm['user']
-            if user in self.plugin.players:
+            if user in game.players:
                 return bot.reply(comm, self.plugin.already_in.format(user))
-            elif user in self.plugin.player_queue:
+            elif user in game.player_queue:
                 return bot.reply(comm, '[*] {0}, you are already in the queue!'.format(user))
+            elif not game.has_cards():
+                return bot.reply(comm, '[*] The cards are still being loaded, '
+                                 'try again in a moment.')
 
             # This is only when the game is first starting.
-            if self.plugin.state == "join":
-                self.plugin.deal(user)
-                if len(self.plugin.players) > 2:
+            if game.state == "join":
+                game.deal(user)
+                if len(game.players) > 2:
                     bot.reply(comm, "[*] {0} has joined the game! There are "
                                 "now enough players to play!".format(user))
-                    self.plugin.prep_play(bot, comm)
+                    game.prep_play(bot, comm)
                 else:
                     bot.reply(comm, "[*] {0} has joined the game! Waiting for "
                                 "{1} more player(s).".format(
-                                    user, 3 - len(self.plugin.players)))
+                                    user, 3 - len(game.players)))
             else:
                 bot.reply(comm, "[*] {0} has joined the queue!".format(user))
-                self.plugin.player_queue.append(user)
-            bot.reply(comm, self.plugin.current_players())
+                game.player_queue.add(user)
+                game.plugin.journal.touch(game)
+            bot.reply(comm, game.current_players())
 
     class Leave(Command):
         name = 'leave'
@@ -408,14 +1100,15 @@ class CardsAgainstHumanity(ChatCommandPlugin):
 
         def command(self, bot, comm, groups):
             print "intercepted leave command!"
+            game = self.plugin.get_game(comm)
             user = comm['user']
 
-            if (user not in self.plugin.players and
-                    user not in self.plugin.player_queue):
+            if (user not in game.players and
+                    user not in game.player_queue):
                 return bot.reply(comm, self.plugin.not_in.format(user))
 
             bot.reply(comm, "[*] {0} has left the game!".format(user))
-            self.plugin.remove_player(bot, comm, user)
+            game.remove_player(bot, comm, user)
 
     class Play(Command):
         name = 'play'
@@ -429,50 +1122,48 @@ class CardsAgainstHumanity(ChatCommandPlugin):
 
         def command(self, bot, comm, groups):
             print "intercepted play command!"
+            game = self.plugin.get_game(comm)
 
             user = comm['user']
-            if user not in self.plugin.players:
-                return self.plugin.not_in.format(user)
-            elif user == self.plugin.dealer:
+            if user not in game.players:
+                return bot.reply(comm, self.plugin.not_in.format(user))
+            elif game.state != 'play':
+                return bot.reply(comm, "[*] {0}, it is not time to play cards!"
+                                 .format(user))
+            elif user == game.dealer:
                 return bot.reply(comm, "[*] {0}, you are the dealer!".format(user))
 
-            try:
-                indices = map(int, groups[1].split(" "))
-            except:
-                indices = []
-                num = random.randint(0, len(self.plugin.players[user]))
-                while (num not in indices and
-                    groups[1] == 'random' and
-                    len(indices) < self.plugin.prompt.count("_" * 10)):
-
-                    indices += [num]
-                    num = random.randint(0, len(self.plugin.players[user]))
-
-                if not indices:
-                    return bot.reply(comm, "[*] {0}, you didn't provide hand index(s) for cards!"
-                                .format(user))
+            hand = len(game.players[user])
+            if groups[1].strip() == 'random':
+                indices = random.sample(xrange(1, hand + 1),
+                                        min(game.blanks(), hand))
+            else:
+                indices = game.hand_indices(user, groups[1])
+            if not indices:
+                return bot.reply(comm, "[*] {0}, those aren't cards in your "
+                                 "hand!".format(user))
 
-            if len(indices) != self.plugin.prompt.count("__________"):
-                return ("[*] {0}, you didn't provide the correct amount"
-                            "of cards!".format(user))
+            if len(indices) != game.blanks():
+                return bot.reply(comm, "[*] {0}, you didn't provide the "
+                                 "correct amount of cards!".format(user))
 
-            if user in self.plugin.answers:
-                self.plugin.players[user] += self.plugin.answers[user]
-                del(self.plugin.answers[user])
+            if user in game.answers:
+                game.players[user] += game.answers[user]
+                del(game.answers[user])
 
-            self.plugin.answers[user] = [self.plugin.players[user][i - 1]
-                                    for i in indices]
+            game.answers[user] = [game.players[user][i - 1]
+                                  for i in indices]
+            game.plugin.journal.touch(game)
 
             # Don't change index of cards that are being removed..
             for index in reversed(sorted(indices, key=lambda x: x)):
-                self.plugin.players[user].pop(index - 1)
+                game.players[user].pop(index - 1)
 
 
-            if len(self.plugin.answers) == len(self.plugin.avail_players):
-                bot.reply(comm, "[*] All players have turned in their cards.")
-                random.shuffle(self.plugin.avail_players)
-                self.plugin.show_answers(bot, comm)
-                self.plugin.change_state(bot, comm, 'winner')
+            if len(game.answers) == len(game.avail_players):
+                bot.reply(comm, "[*] All players have turned in their cards.",
+                          urgent=True)
+                game.start_judging(bot, comm)
 
     class Winner(Command):
         name = 'winner'
@@ -484,11 +1175,15 @@ class CardsAgainstHumanity(ChatCommandPlugin):
 
         def command(self, bot, comm, groups):
             print "intercepted winner command!"
+            game = self.plugin.get_game(comm)
             user = comm['user']
-            if self.plugin.state != "winner":
+            if game.audience:
+                return bot.reply(comm, "[*] The audience picks the winner "
+                                 "here, with \"!vote <answer #>\".")
+            elif game.state != "winner":
                 return bot.reply(comm, "[*] {0}, it is not time to choose a "
                             "winner!".format(user))
-            elif user != self.plugin.dealer:
+            elif user != game.dealer:
                 return bot.reply(comm, "[*] {0}, you may not choose the winner! "
                                     .format(user))
 
@@ -497,17 +1192,57 @@ class CardsAgainstHumanity(ChatCommandPlugin):
             except ValueError:
                 return bot.reply(comm, "[*] {0}, that is not a valid winner!".format(user))
 
-            if winner_ind < 1 or winner_ind > len(self.plugin.answers):
+            if winner_ind < 1 or winner_ind > len(game.shown):
                 return bot.reply(comm, "[*] {0}, that answer doesn't exist!"
                             .format(user))
 
-            winner = ""
-            winner = self.plugin.avail_players[winner_ind - 1]
-            bot.reply(comm, "[*] {0}, you won this round! Congrats!".format(winner))
+            winner = game.shown[winner_ind - 1]
+            if winner is None:
+                return bot.reply(comm, "[*] {0}, that answer was withdrawn!"
+                            .format(user))
+            bot.reply(comm, "[*] {0}, you won this round! Congrats!".format(winner),
+                      urgent=True)
+
+            game.win(bot, comm, winner)
+
+    class Vote(Command):
+        name = 'vote'
+        regex = r'^vote (\d+) ?$'
 
-            self.plugin.give_point(winner)
-            self.plugin.show_top_scores(bot, comm)
-            self.plugin.reset(bot, comm)
+        short_desc = '!vote <answer #> - Votes for the best answer.'
+        long_desc = ('In audience mode, anyone in the channel can vote for the '
+                     'answer they like best, once per round. Voting again '
+                     'changes your vote.')
+
+        def command(self, bot, comm, groups):
+            print "intercepted vote command!"
+            game = self.plugin.get_game(comm)
+            user = comm['user']
+            if not game.audience:
+                return bot.reply(comm, "[*] {0}, there's no voting here, the "
+                                 "dealer picks the winner.".format(user))
+            elif game.state != "winner":
+                return bot.reply(comm, "[*] {0}, it is not time to vote!"
+                                 .format(user))
+
+            answer = int(groups[0])
+            if answer < 1 or answer > len(game.shown):
+                return bot.reply(comm, "[*] {0}, that answer doesn't exist!"
+                                 .format(user))
+            if game.shown[answer - 1] is None:
+                return bot.reply(comm, "[*] {0}, that answer was withdrawn!"
+                                 .format(user))
+            if game.shown[answer - 1] == user:
+                return bot.reply(comm, "[*] {0}, you can't vote for your own "
+                                 "answer!".format(user))
+
+            game.vote(user, answer - 1)
+            bot.notice(user, "[*] You voted for answer {0}.".format(answer))
+
+            # Everyone playing has had their say, no need to wait. There's no
+            # knowing who else is watching, so the audience alone can't end it.
+            if all(p in game.votes for p in game.players):
+                game.close_votes(bot, comm)
 
     class MyStatus(Command):
         name = 'mystatus'
@@ -518,28 +1253,25 @@ class CardsAgainstHumanity(ChatCommandPlugin):
 
         def command(self, bot, comm, groups):
             print "intercepted mystatus command!"
+            game = self.plugin.get_game(comm)
             user = comm['user']
-            msg = ["{0}", "Score: {0}", "Playing: {0}", "Dealer: {0}",
-                    "Hand: [{0}]"]
-
-            score = 0
-            player = self.plugin.db.session.query(CAHTable).filter_by(user=user
-                        ).first()
-            if player:
-                score = player.score
-
-            playing = "Yes" if user in self.plugin.players else "No"
-            dealer = "Yes" if user == self.plugin.dealer else "No"
-            hand = "None"
-            if user in self.plugin.players:
-                hand = '. '.join((str(x + 1) + ": " + self.plugin.players[user][x]
-                    for x in xrange(len(self.plugin.players[user]))))
+            msg = ["{0}", "Score: {0}", "Playing: {0}", "Dealer: {0}"]
+
+            score = game.get_score(user)
+            playing = "Yes" if user in game.players else "No"
+            dealer = "Yes" if user == game.dealer else "No"
 
             # Since we can't print new lines...
-            msgs = zip(msg, [user, score, playing, dealer, hand])
+            msgs = zip(msg, [user, score, playing, dealer])
             for msg, value in msgs:
                 bot.notice(user, msg.format(value))
 
+            if user in game.players:
+                for line in game.hand_lines(user, "Hand: "):
+                    bot.notice(user, line)
+            else:
+                bot.notice(user, "Hand: [None]")
+
     class Players(Command):
         name = 'players'
         regex = r'^players'
@@ -549,9 +1281,10 @@ class CardsAgainstHumanity(ChatCommandPlugin):
 
         def command(self, bot, comm, groups):
             print "intercepted players command"
+            game = self.plugin.get_game(comm)
 
-            bot.reply(comm, self.plugin.current_players())
-            bot.reply(comm, self.plugin.queued_players())
+            bot.reply(comm, game.current_players())
+            bot.reply(comm, game.queued_players())
 
     class Kick(Command):
         name = 'kick'
@@ -563,26 +1296,27 @@ class CardsAgainstHumanity(ChatCommandPlugin):
 
         def command(self, bot, comm, groups):
             print "intercepted kick command"
+            game = self.plugin.get_game(comm)
             user = comm['user']
             target = groups[0]
             print target
 
-            if not self.plugin.players.get(target):
+            if not game.players.get(target):
                 return bot.reply(comm, "[*] Player '{0}' doesn't exist...".format(target))
-            elif user in self.plugin.kick_votes[target]:
+            elif user in game.kick_votes[target]:
                 return bot.reply(comm, "[*] You already voted to kick this player!")
             elif user == target:
                 return bot.reply(comm, "[*] You can't kick yourself!")
 
-            self.plugin.kick_votes[target].append(user)
-            num_votes = len(self.plugin.kick_votes[target])
-            num_voters = len(self.plugin.players) - 1
+            game.kick_votes[target].add(user)
+            num_votes = len(game.kick_votes[target])
+            num_voters = len(game.players) - 1
 
             # if 70% or more of voting players want to kick a player, they are
             # kicked
             if ((num_votes/float(num_voters)) * 100 ) > 70:
                 bot.reply(comm, "{0} has been kicked from the game!".format(target))
-                self.plugin.remove_player(bot, comm, target)
+                game.remove_player(bot, comm, target)
 
 
     class Hand(Command):
@@ -593,7 +1327,8 @@ class CardsAgainstHumanity(ChatCommandPlugin):
 
         def command(self, bot, comm, groups):
             print "intercepted hand command"
-            self.plugin.show_hand(bot, comm['user'])
+            game = self.plugin.get_game(comm)
+            game.show_hand(bot, comm['user'])
 
     class AddCard(Command):
         name = 'addcard'
@@ -620,18 +1355,197 @@ class CardsAgainstHumanity(ChatCommandPlugin):
                     return bot.reply(comm, "[*] You provided too few or many blanks!")
 
                 desc = ude(self.plugin.init_black(formatted))
-                self.plugin.black_discard.append(desc)
 
             elif color == 'white':
                 desc = ude(self.plugin.format_white(desc))
-                self.plugin.white_discard.append(desc)
 
-            new_card = CardTable(desc=desc, color=color, official=False)
-            self.plugin.db.session.add(new_card)
-            self.plugin.db.session.commit()
+            search = self.plugin.search
+            if not search.built:
+                return bot.reply(comm, "[*] Still reading the cards, try again "
+                                 "in a moment.")
+            if not search.reserve(desc, color):
+                duplicate = search.duplicate(desc, color)
+                if duplicate is None:
+                    return bot.reply(comm, "[*] That card is already being "
+                                     "added!")
+                return bot.reply(comm, "[*] That card is already in the deck: "
+                                 "{0}".format(self.plugin.cards[duplicate]))
+
+            def insert(session):
+                session.add(CardTable(desc=desc, color=color, official=False,
+                                      pack=CUSTOM))
+
+            def added(result):
+                self.plugin.add_card(desc, color, CUSTOM)
+                search.release(desc, color)
+                bot.reply(comm, '[*] Card: {0} Color: {1} added to db!'.format(
+                          desc, color))
+
+            def failed(failure):
+                search.release(desc, color)
+                bot.reply(comm, "[*] Couldn't add that card: {0}".format(
+                          failure.getErrorMessage()))
+
+            self.plugin.dbpool.run(insert).addCallbacks(added, failed)
+
+    class ImportCards(Command):
+        name = 'importcards'
+        regex = r'^importcards (\S+)(?: (white|black))? ?$'
+
+        short_desc = ('!importcards <path> [white|black] - Imports a text, csv '
+                      'or json lines file of cards. Admin only.')
+
+        def command(self, bot, comm, groups):
+            print "intercepted importcards command"
+            user = comm['user']
+            if not bot.acl.has_permission(comm, 'cah.admin'):
+                return bot.reply(comm, "[*] {0}, you can't do that!".format(user))
+
+            path, color = groups
+            bot.reply(comm, "[*] Importing {0}...".format(path))
+
+            def done(result):
+                added, duplicates, rejects = result
+                bot.reply(comm, "[*] Added {0} cards from {1} to the {2} pack, "
+                          "skipped {3} already in the deck and rejected "
+                          "{4}.".format(added, path, importer.pack_for(path),
+                                        duplicates, len(rejects)))
+                if rejects:
+                    bot.notice(user, "[*] Rejected lines: {0}".format(
+                        ', '.join('{0} ({1})'.format(n, why)
+                                  for n, why in rejects[:10])))
+
+            def failed(failure):
+                bot.reply(comm, "[*] Couldn't import {0}: {1}".format(
+                    path, failure.getErrorMessage()))
+
+            self.plugin.import_pack(path, color).addCallbacks(done, failed)
+
+    class SearchCard(Command):
+        name = 'searchcard'
+        regex = r'^searchcard (.+)'
 
-            return bot.reply(comm, '[*] Card: {0} Color: {1} added to db!'.format(
-                        desc, color))
+        short_desc = '!searchcard <words> - Finds cards containing every word.'
+
+        def command(self, bot, comm, groups):
+            print "intercepted searchcard command"
+            cards = self.plugin.cards
+            if not self.plugin.search.built:
+                return bot.reply(comm, "[*] Still reading the cards, try again "
+                                 "in a moment.")
+            found = self.plugin.search.search(groups[0])
+
+            if not found:
+                return bot.reply(comm, "[*] No cards match that.")
+
+            shown = found[:5]
+            cards.fetch(shown)
+            more = ''
+            if len(found) > len(shown):
+                more = ", here are the first {0}".format(len(shown))
+            bot.reply(comm, "[*] {0} card{1} found{2}.".format(
+                len(found), (len(found) > 1) * 's', more))
+            for card in shown:
+                bot.reply(comm, "[*] ({0}) {1}".format(cards.color(card),
+                                                       cards[card]))
+
+    class Top(Command):
+        name = 'top'
+        regex = r'^top(?: (\S+))? ?$'
+
+        short_desc = ('!top [all|#channel] - Shows the best players in this '
+                      'channel, or of all time.')
+
+        def command(self, bot, comm, groups):
+            print "intercepted top command"
+            channel = groups[0]
+            if channel == 'all' or (channel is None and comm['pm']):
+                channel = None
+            elif channel is None:
+                channel = comm['channel']
+
+            top = self.plugin.leaderboard.top(5, channel)
+            where = 'in ' + channel if channel else 'of all time'
+            if not top:
+                return bot.reply(comm, "[*] Nobody has any points {0} yet."
+                                 .format(where))
+            bot.reply(comm, "[*] Top players {0}:".format(where))
+            for i, (nick, total) in enumerate(top):
+                bot.reply(comm, u"{0}. {1} ({2})".format(i + 1, nick, total))
+
+    class Rank(Command):
+        name = 'rank'
+        regex = r'^rank(?: (\S+))? ?$'
+
+        short_desc = "!rank [nick] - Shows where you, or nick, rank."
+
+        def command(self, bot, comm, groups):
+            print "intercepted rank command"
+            nick = groups[0] or comm['user']
+            leaderboard = self.plugin.leaderboard
+
+            ranks = []
+            if not comm['pm']:
+                ranks.append((comm['channel'], 'in ' + comm['channel']))
+            ranks.append((None, 'of all time'))
+
+            found = []
+            for channel, where in ranks:
+                rank = leaderboard.rank(nick, channel)
+                if rank is not None:
+                    found.append("#{0} of {1} {2} with {3} points".format(
+                        rank[0], len(leaderboard.board(channel)), where,
+                        rank[1]))
+
+            if not found:
+                return bot.reply(comm, "[*] {0} doesn't have any points yet."
+                                 .format(nick))
+            bot.reply(comm, "[*] {0} is {1}.".format(nick, ', and '.join(found)))
+
+    class TopCards(Command):
+        name = 'topcards'
+        regex = r'^topcards ?$'
+
+        short_desc = '!topcards - Shows the white cards that have won the most.'
+
+        def command(self, bot, comm, groups):
+            print "intercepted topcards command"
+            top = self.plugin.history.top(5)
+            if not top:
+                return bot.reply(comm, "[*] No rounds have been won yet.")
+            for i, (text, played, won) in enumerate(top):
+                bot.reply(comm, u"[*] {0}. {1} - won {2} of {3} ({4:.0%})".format(
+                    i + 1, text, won, played, float(won) / played))
+
+    class History(Command):
+        name = 'history'
+        regex = r'^history(?: (\d+))? ?$'
+
+        short_desc = '!history [n] - Shows the last few rounds in this channel.'
+
+        def command(self, bot, comm, groups):
+            print "intercepted history command"
+            game = self.plugin.get_game(comm)
+            count = min(int(groups[0] or 3), self.plugin.history.keep)
+
+            def show(rounds):
+                if not rounds:
+                    return bot.reply(comm, "[*] No rounds have been won here "
+                                     "yet.")
+                now = time.time()
+                for record in rounds:
+                    won = dict(json.loads(record['answers'])).get(
+                        record['winner'], [])
+                    bot.reply(comm, u"[*] {0}: {1} won with {2}".format(
+                        ago(now - record['finished']), record['winner'],
+                        Template(record['prompt']).fill(won)))
+
+            def failed(failure):
+                bot.reply(comm, "[*] Couldn't read the history: {0}".format(
+                    failure.getErrorMessage()))
+
+            self.plugin.history.last(game.channel, count).addCallbacks(
+                show, failed)
 
     class Poke(Command):
         name = 'poke'
@@ -641,24 +1555,25 @@ class CardsAgainstHumanity(ChatCommandPlugin):
 
         def command(self, bot, comm, groups):
             print "intercepted poke command"
+            game = self.plugin.get_game(comm)
 
             # Get rid of trailing whitespace.
             target = groups[0].strip()
 
-            if target not in self.plugin.players:
+            if target not in game.players:
                 return bot.reply(comm, '[*] That player is not playing right now!')
             elif target == comm['user']:
                 return bot.reply(comm, '[&] Why are you poking yourself?')
-            if target == self.plugin.dealer:
-                if self.plugin.state != 'winner':
+            if target == game.dealer:
+                if game.state != 'winner':
                     return bot.reply(comm, '[*] The dealer doesn\'t need to do '
                                      'anything right now.')
-                self.plugin.show_answers(bot, comm)
+                game.show_answers(bot, comm)
             else:
-                if self.plugin.state == 'play':
-                    if target not in self.plugin.answers:
+                if game.state == 'play':
+                    if target not in game.answers:
                         bot.notice(target, '[*] Please play a card.')
-                        self.plugin.show_hand(bot, target)
+                        game.show_hand(bot, target)
                     else:
                         return bot.reply(comm, '[*] {0} has already played their '
                                          'cards!'.format(target))
@@ -674,25 +1589,112 @@ class CardsAgainstHumanity(ChatCommandPlugin):
 
         def command(self, bot, comm, groups):
             print 'intercepted redraw command'
+            game = self.plugin.get_game(comm)
 
             user = comm['user']
-            if user not in self.plugin.players:
-                return self.plugin.not_in.format(user)
+            if user not in game.players:
+                return bot.reply(comm, self.plugin.not_in.format(user))
 
-            if not self.plugin.take_point(user):
-                return bot.notice(user, "You don't have enough points to do that.")
+            indices = game.hand_indices(user, groups[0])
+            if not indices:
+                return bot.notice(user, "Those aren't cards in your hand.")
 
-            indices = set(map(int, groups[0].split(" ")))
+            if not game.take_point(user):
+                return bot.notice(user, "You don't have enough points to do that.")
 
             # Don't change index of cards that are being removed..
             for index in reversed(sorted(indices, key=lambda x: x)):
-                exchange = self.plugin.players[user].pop(index - 1)
-                self.plugin.white_discard.append(exchange)
+                exchange = game.players[user].pop(index - 1)
+                game.discard(game.whites, [exchange])
 
-            self.plugin.deal(user)
+            game.deal(user)
             bot.notice(user, 'Exchanged {0} card{1}.'.format(len(indices),
                         (len(indices) > 1) * 's'))
-            self.plugin.show_hand(bot, user)
+            game.show_hand(bot, user)
+
+    class Packs(Command):
+        name = 'packs'
+        regex = r'^packs((?: \S+)*) ?$'
+
+        short_desc = ('!packs [+pack] [-pack] [all] - Shows or changes the '
+                      'packs this channel plays with.')
+
+        def command(self, bot, comm, groups):
+            print 'intercepted packs command'
+            game = self.plugin.get_game(comm)
+            user = comm['user']
+            cards = self.plugin.cards
+            available = cards.packs()
+
+            changes = groups[0].split()
+            if changes:
+                if game.players and user not in game.players:
+                    return bot.reply(comm, self.plugin.not_in.format(user))
+
+                packs = set(available if game.packs is None else game.packs)
+                for change in changes:
+                    if change == 'all':
+                        packs = set(available)
+                        continue
+                    name = change.lstrip('+-')
+                    if name not in available:
+                        return bot.reply(comm, "[*] There's no {0} pack.".format(
+                                         name))
+                    if change.startswith('-'):
+                        packs.discard(name)
+                    else:
+                        packs.add(name)
+
+                if not (cards.pack_ranges('white', packs) and
+                        cards.pack_ranges('black', packs)):
+                    return bot.reply(comm, "[*] Those packs don't have both "
+                                     "white and black cards.")
+
+                game.packs = None if packs == set(available) else packs
+                game.build_decks()
+                self.plugin.journal.touch(game)
+
+            playing = sorted(available if game.packs is None else game.packs)
+            others = sorted(set(available) - set(playing))
+            reply = "[*] Playing with {0}.".format(', '.join(
+                '{0} ({1})'.format(p, available.get(p, 0)) for p in playing))
+            if others:
+                reply += " Also available: {0}.".format(', '.join(
+                    '{0} ({1})'.format(p, available[p]) for p in others))
+            bot.reply(comm, reply)
+
+    class Audience(Command):
+        name = 'audience'
+        regex = r'^audience(?: (on|off))? ?$'
+
+        short_desc = ('!audience [on|off] - Shows or changes whether the '
+                      'audience votes for the winner.')
+
+        def command(self, bot, comm, groups):
+            print 'intercepted audience command'
+            channel = comm['channel']
+            user = comm['user']
+            audience = self.plugin.audience
+            if comm['pm']:
+                return bot.reply(comm, "[*] {0}, say that in the channel it's "
+                                 "for.".format(user))
+
+            if groups[0]:
+                if not bot.acl.has_permission(comm, 'cah.admin'):
+                    return bot.reply(comm, "[*] {0}, you can't do that!".format(user))
+                if groups[0] == 'on':
+                    audience.add(channel)
+                else:
+                    audience.discard(channel)
+                game = self.plugin.games.get(channel)
+                if game is not None:
+                    self.plugin.journal.touch(game)
+                if game is not None and game.state in ('play', 'winner'):
+                    return bot.reply(comm, "[*] Audience mode is {0} from the "
+                                     "next round.".format(groups[0]))
+
+            bot.reply(comm, "[*] Audience mode is {0}.".format(
+                'on' if channel in audience else 'off'))
 
     class GameStatus(Command):
         name = 'gamestatus'
@@ -702,67 +1704,99 @@ class CardsAgainstHumanity(ChatCommandPlugin):
 
         def command(self, bot, comm, groups):
             print 'intercepted GameStatus command'
+            game = self.plugin.get_game(comm)
 
             responses = []
             responses.append('    Player    |    Played    |    Dealer    |    Score')
             responses.append('______________|______________|______________|____________')
             stats = '{:^14} {:^14} {:^14} {:^14}'
-            player_scores = [(self.plugin.get_score(p), p) for p in self.plugin.players]
+            player_scores = [(game.get_score(p), p) for p in game.players]
             player_scores.sort(reverse=True)
             for score, player in player_scores:
                 # The str(bool) is a hack around formating in python kinda sucking.
                 resp = stats.format(player,
-                                    str(bool(self.plugin.answers.get(player))),
-                                    str(player == self.plugin.dealer),
+                                    str(bool(game.answers.get(player))),
+                                    str(player == game.dealer),
                                     score)
                 responses.append(resp)
 
+            # Merging lines would break up the table.
             for resp in responses:
-                bot.notice(comm['user'], resp)
-
-
-class CardTable(SQLAlchemyBase):
-    """
-    This is only for persistant storage of all cards. More can also be
-    added through commands in this manner.
-    """
-
-    __tablename__ = 'cah_cards'
-
-    id = Column(Integer, primary_key=True)
-    desc = Column(String)
-    color = Column(String)
-    official = Column(Boolean)
-
-    def __init__(self, desc, color, official=True):
-        self.desc = desc
-        self.color = color
-        self.official = official
-
-    def __repr__(self):
-        print self.desc
-        return self.desc
+                bot.notice(comm['user'], resp, merge=False)
 
+    class Stats(Command):
+        name = 'cahstats'
+        regex = r'^cahstats ?$'
 
-class CAHTable(SQLAlchemyBase):
-    """
-    For storing scores on a per player per game basis.
-    """
+        short_desc = '!cahstats - Shows how the bot is performing. Admin only.'
 
-    __tablename__ = 'cah'
-
-    id = Column(Integer, primary_key=True)
-    game = Column(String)
-    user = Column(String)
-    score = Column(Integer)
-
-    def __init__(self, user, game, score=0):
-        self.user = user
-        self.game = game
-        self.score = score
+        def command(self, bot, comm, groups):
+            print 'intercepted cahstats command'
+            user = comm['user']
+            if not bot.acl.has_permission(comm, 'cah.admin'):
+                return bot.reply(comm, "[*] {0}, you can't do that!".format(user))
+
+            plugin = self.plugin
+            metrics = plugin.metrics
+            outbox = plugin.outbox
+            bot.notice(user, "[*] Up {0:.0f}s, {1} games, {2} db queries, "
+                       "{3} commits, {4} timers pending.".format(
+                           time.time() - metrics.started, len(plugin.games),
+                           metrics.queries, metrics.commits,
+                           len(reactor.getDelayedCalls())))
+            bot.notice(user, "[*] Sent {0} lines, {1} merged in, {2} "
+                       "queued.".format(outbox.sent, outbox.merged,
+                                        len(outbox)))
+
+            for name, histogram in sorted(metrics.commands.items()):
+                if not histogram.count:
+                    continue
+                bot.notice(user, "[*] !{0}: {1} calls, avg {2:.1f}ms, "
+                           "p50 <= {3}s, p99 <= {4}s".format(
+                               name, histogram.count,
+                               1000 * histogram.sum / histogram.count,
+                               histogram.quantile(0.5),
+                               histogram.quantile(0.99)))
+
+            for channel, game in sorted(plugin.games.items()):
+                bot.notice(user, "[*] {0}: {1} players, {2} white cards ({3} "
+                           "discarded), {4} black ({5} discarded)".format(
+                               channel, len(game.players), len(game.whites),
+                               len(game.whites.discards), len(game.blacks),
+                               len(game.blacks.discards)))
+
+    class Profile(Command):
+        name = 'cahprofile'
+        regex = r'^cahprofile(?: (\d+)(s?)| (stop))? ?$'
+
+        short_desc = ('!cahprofile [<n> | <n>s | stop] - Profiles the next n '
+                      'commands, or n seconds. Admin only.')
 
-    def __repr__(self):
-        return "%s: %d" % self.user, self.score
+        def command(self, bot, comm, groups):
+            print 'intercepted cahprofile command'
+            user = comm['user']
+            if not bot.acl.has_permission(comm, 'cah.admin'):
+                return bot.reply(comm, "[*] {0}, you can't do that!".format(user))
+
+            profiler = self.plugin.profiler
+            number, seconds, stop = groups
+            if stop:
+                written = profiler.stop()
+                if not written:
+                    return bot.notice(user, "[*] Nothing is being profiled.")
+                return bot.notice(user, "[*] Profile written to {0}".format(
+                    ', '.join(written)))
+
+            # However many commands are asked for, stop after 10 minutes.
+            if seconds:
+                started = profiler.start(seconds=max(1, min(int(number), 600)))
+            else:
+                started = profiler.start(calls=int(number or 100),
+                                         seconds=600)
+            if not started:
+                return bot.notice(user, "[*] Already profiling.")
+            bot.notice(user, "[*] Profiling to {0}, stop with "
+                       "\"!cahprofile stop\".".format(profiler.directory))
 
 
 cah = CardsAgainstHumanity()
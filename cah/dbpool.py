@@ -0,0 +1,82 @@
+"""
+Running db work off the reactor thread.
+"""
+from sqlalchemy import orm
+from twisted.internet import defer, threads
+from twisted.python import threadpool
+
+
+class DBPool(object):
+    """
+    A bounded pool of threads for talking to the db, each with a session of
+    its own, so a slow commit only holds up whatever was waiting on it.
+
+    `run` hands back a Deferred that fires, on the reactor thread, with the
+    result of calling `f(session, *args, **kwargs)` in a pool thread. The
+    session is committed if `f` returns and rolled back if it raises.
+
+    SQLite only lets one writer in at a time, so it gets one thread by
+    default. An in-memory SQLite db is a different db on every connection,
+    so work for one is done straight away on the reactor thread instead.
+    """
+
+    def __init__(self, db, clock, size=None):
+        self.db = db
+        self.clock = clock
+
+        url = db.engine.url
+        sqlite = url.drivername.startswith('sqlite')
+        self.inline = sqlite and url.database in (None, '', ':memory:')
+        if size is None:
+            size = 1 if sqlite else 4
+
+        self.sessions = orm.scoped_session(orm.sessionmaker(bind=db.engine))
+        self.pool = threadpool.ThreadPool(minthreads=0, maxthreads=size,
+                                          name='cah-db')
+        self.jobs = 0
+
+    def start(self):
+        if not self.inline:
+            self.pool.start()
+
+    def stop(self):
+        if not self.inline:
+            self.pool.stop()
+
+    def run(self, f, *args, **kwargs):
+        """ Call `f(session, ...)` in the pool, returning a Deferred. """
+        if self.inline:
+            return defer.maybeDeferred(self.call, self.db.session, f, args,
+                                       kwargs)
+        self.jobs += 1
+        d = threads.deferToThreadPool(self.clock, self.pool, self.in_thread,
+                                      f, args, kwargs)
+        d.addBoth(self.finished)
+        return d
+
+    def run_now(self, f, *args, **kwargs):
+        """
+        Call `f(session, ...)` on this thread, blocking until it's done. Only
+        for start up and shut down, or things that can't wait.
+        """
+        return self.call(self.db.session, f, args, kwargs)
+
+    def in_thread(self, f, args, kwargs):
+        try:
+            return self.call(self.sessions(), f, args, kwargs)
+        finally:
+            # Hand the connection back, and don't hang on to any rows.
+            self.sessions.remove()
+
+    def call(self, session, f, args, kwargs):
+        try:
+            result = f(session, *args, **kwargs)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return result
+
+    def finished(self, result):
+        self.jobs -= 1
+        return result
@@ -0,0 +1,178 @@
+"""
+Cards read from the db as they're needed.
+
+Only each card's db id, color and pack are kept in memory. Texts are
+read in batches the first time they're shown, and kept in an LRU cache, so
+memory stays flat however big the card table gets. Games read the texts of
+the cards they're about to deal ahead of time, in the db pool, so reading
+on the reactor thread is only a fallback.
+"""
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from .deck import CardStore, Template, pack_name
+from .models import CardTable
+
+
+COLORS = ('white', 'black')
+
+# Shown for a card that's been deleted from the db since start up. Running
+# games keep removed cards until the next restart.
+GONE = u'(a card that has since been removed)'
+
+
+class DBStore(CardStore):
+    """
+    A CardStore that only holds ids, reading texts from the db as they're
+    needed and keeping the `cache_size` most recently used. Cards added after
+    start up (by !addcard, a card sync or an import) are kept in memory, with
+    ids following on from the db's, like a PackStore's.
+
+    `prefetch` reads texts in `pool`; `fetch` reads whatever's still missing
+    with `session`, on the calling thread.
+    """
+
+    def __init__(self, session, cache_size=5000, chunk=500, pool=None):
+        super(DBStore, self).__init__()
+        self.session = session
+        self.pool = pool
+        self.cache_size = cache_size
+        self.chunk = chunk
+        # Card id -> db id, in db id order so they can be binary searched.
+        self.db_ids = array('l')
+        # Card id -> index into COLORS.
+        self.db_colors = bytearray()
+        self.db_by_color = {'white': array('i'), 'black': array('i')}
+        # {card: text}, least recently used first.
+        self.cache = OrderedDict()
+        # Cards being read in the pool.
+        self.reading = set()
+        # Texts read on the calling thread, for want of a prefetch.
+        self.misses = 0
+
+    def load(self):
+        """ Read every card's id, color and pack, but none of their texts. """
+        query = (self.session.query(CardTable.id, CardTable.color,
+                                    CardTable.pack, CardTable.official)
+                 .order_by(CardTable.id))
+        for db_id, color, pack, official in query.yield_per(10000):
+            if color not in self.db_by_color:
+                continue
+            card = len(self.db_ids)
+            self.db_by_color[color].append(card)
+            self.db_ids.append(db_id)
+            self.db_colors.append(COLORS.index(color))
+            self.note(card, color, pack_name(pack, official))
+
+    def __len__(self):
+        return len(self.db_ids) + len(self.texts)
+
+    def __getitem__(self, card):
+        if card >= len(self.db_ids):
+            return self.texts[card - len(self.db_ids)]
+        text = self.cache.pop(card, None)
+        if text is None:
+            self.fetch([card])
+            text = self.cache.pop(card)
+        self.cache[card] = text
+        return text
+
+    def missing(self, cards):
+        n = len(self.db_ids)
+        return sorted(set(c for c in cards if c < n and c not in self.cache))
+
+    def fetch(self, cards):
+        """ Read the texts of any of `cards` that aren't cached, in batches. """
+        missing = self.missing(cards)
+        if missing:
+            self.misses += len(missing)
+            ids = dict((self.db_ids[c], c) for c in missing)
+            self.fetched(read_texts(self.session, list(ids), self.chunk), ids)
+
+    def prefetch(self, cards):
+        """ Read the texts of any of `cards` that aren't cached, in the pool. """
+        missing = [c for c in self.missing(cards) if c not in self.reading]
+        if not missing or self.pool is None:
+            return
+        self.reading.update(missing)
+        ids = dict((self.db_ids[c], c) for c in missing)
+        d = self.pool.run(read_texts, list(ids), self.chunk)
+        d.addCallback(self.fetched, ids)
+        d.addErrback(self.prefetch_failed)
+        d.addBoth(lambda _: self.reading.difference_update(missing))
+
+    def fetched(self, texts, ids):
+        for db_id, card in ids.iteritems():
+            # Not if it was read while this was in flight, and maybe used.
+            if card not in self.cache:
+                self.remember(card, texts.get(db_id, GONE))
+
+    def prefetch_failed(self, failure):
+        # They'll be read as they're shown instead.
+        print "Couldn't read cards ahead: {0}".format(failure.getErrorMessage())
+
+    def remember(self, card, text):
+        self.cache[card] = text
+        while len(self.cache) > self.cache_size:
+            old, _ = self.cache.popitem(last=False)
+            self.templates.pop(old, None)
+
+    def color(self, card):
+        if card < len(self.db_ids):
+            return COLORS[self.db_colors[card]]
+        return self.colors[card - len(self.db_ids)]
+
+    def find(self, text, color):
+        db_id = (self.session.query(CardTable.id)
+                 .filter_by(desc=text, color=color)
+                 .order_by(CardTable.id).limit(1).scalar())
+        if db_id is not None:
+            card = self.card_for(db_id)
+            if card is not None:
+                return card
+        return super(DBStore, self).find(text, color)
+
+    def card_for(self, db_id):
+        """ The card id for a db id, or None if it was added since loading """
+        card = bisect_left(self.db_ids, db_id)
+        if card < len(self.db_ids) and self.db_ids[card] == db_id:
+            return card
+        return None
+
+    def template(self, card):
+        # Dropped along with the text when it falls out of the cache.
+        template = self.templates.get(card)
+        if template is None:
+            template = Template(self[card])
+            if card in self.cache or card >= len(self.db_ids):
+                self.templates[card] = template
+        return template
+
+    def ids(self, color):
+        ids = array('i', self.db_by_color[color])
+        ids.extend(super(DBStore, self).ids(color))
+        return ids
+
+    def each(self, color, session=None):
+        # Read straight through, so indexing doesn't churn the cache.
+        session = session or self.session
+        query = (session.query(CardTable.id, CardTable.desc)
+                 .filter_by(color=color).order_by(CardTable.id))
+        for db_id, text in query.yield_per(1000):
+            card = self.card_for(db_id)
+            if card is not None:
+                yield card, text
+        n = len(self.db_ids)
+        for card in super(DBStore, self).ids(color):
+            yield card, self.texts[card - n]
+
+
+def read_texts(session, db_ids, chunk=500):
+    """ {db id: text} for `db_ids`, `chunk` at a time """
+    texts = {}
+    for i in xrange(0, len(db_ids), chunk):
+        query = (session.query(CardTable.id, CardTable.desc)
+                 .filter(CardTable.id.in_(db_ids[i:i + chunk])))
+        texts.update(query)
+    return texts
@@ -0,0 +1,271 @@
+"""
+Card storage and decks.
+
+Card text is stored once, in a CardStore. Decks, hands, answers and discard
+piles only ever hold the integer ids handed out by the store.
+
+Every card belongs to a pack. The store keeps each pack as ranges of ids, and
+a game's decks are views over the ranges of the packs it plays with.
+"""
+import random
+from array import array
+from bisect import bisect_right
+
+
+# A blank on a black card.
+BLANK = '_' * 10
+
+# The official cards, and cards added with !addcard.
+BASE = 'base'
+CUSTOM = 'custom'
+
+
+def pack_name(pack, official):
+    """ The pack a card's in, for cards from before packs were recorded """
+    return pack or (BASE if official else CUSTOM)
+
+
+class Template(object):
+    """
+    A black card split around its blanks, so answers can be filled in
+    without searching the text for blanks every time.
+    """
+
+    __slots__ = ('text', 'segments', 'blanks')
+
+    def __init__(self, text):
+        # The card's colours are kept: each blank's colour code ends one
+        # segment, and its closing code starts the next.
+        self.text = text
+        self.segments = tuple(text.split(BLANK))
+        self.blanks = len(self.segments) - 1
+
+    def fill(self, answers):
+        """ The card with `answers` in its blanks, in order. """
+        parts = [self.segments[0]]
+        for answer, segment in zip(answers, self.segments[1:]):
+            parts.append(answer)
+            parts.append(segment)
+        return ''.join(parts)
+
+
+class CardStore(object):
+    """ Every card's text, stored once and addressed by integer id """
+
+    def __init__(self):
+        self.texts = []
+        self.colors = []
+        self.lookup = {}
+        self.by_color = {'white': array('i'), 'black': array('i')}
+        # {card: Template} for black cards.
+        self.templates = {}
+        # {(pack, color): [[start, stop]]}, the ids in each pack.
+        self.ranges = {}
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, card):
+        return self.texts[card]
+
+    def add(self, text, color, pack=CUSTOM):
+        """
+        Add a card, returning its id. Adding the same card twice returns the
+        id it already has, in whichever pack it was first added to.
+        """
+        key = (color, text)
+        card = self.lookup.get(key)
+        if card is None:
+            card = len(self)
+            self.texts.append(text)
+            self.colors.append(color)
+            self.lookup[key] = card
+            self.by_color[color].append(card)
+            self.note(card, color, pack)
+            if color == 'black':
+                self.templates[card] = Template(text)
+        return card
+
+    def note(self, card, color, pack):
+        """ Put `card` in a pack, growing the pack's last range if it can. """
+        ranges = self.ranges.setdefault((pack, color), [])
+        if ranges and ranges[-1][1] == card:
+            ranges[-1][1] = card + 1
+        else:
+            ranges.append([card, card + 1])
+
+    def packs(self):
+        """ {pack: number of cards} """
+        counts = {}
+        for (pack, color), ranges in self.ranges.iteritems():
+            counts[pack] = (counts.get(pack, 0) +
+                            sum(stop - start for start, stop in ranges))
+        return counts
+
+    def pack_ranges(self, color, packs=None):
+        """ The ranges of `color` cards in any of `packs` (or all), in order """
+        return sorted(tuple(r) for (pack, c), ranges in self.ranges.iteritems()
+                      if c == color and (packs is None or pack in packs)
+                      for r in ranges)
+
+    def pack(self, card):
+        """ The pack `card` is in, or None if it's in none """
+        color = self.color(card)
+        for (pack, c), ranges in self.ranges.iteritems():
+            if c != color:
+                continue
+            r = bisect_right(ranges, [card, float('inf')]) - 1
+            if r >= 0 and card < ranges[r][1]:
+                return pack
+        return None
+
+    def color(self, card):
+        return self.colors[card]
+
+    def find(self, text, color):
+        """ The id of a card, or None if there's no such card. """
+        return self.lookup.get((color, text))
+
+    def ids(self, color):
+        return self.by_color[color]
+
+    def each(self, color, session=None):
+        """
+        (id, text) for every card of a color. Stores that read from the db
+        use `session`, if given, so this can run in a db thread.
+        """
+        for card in self.ids(color):
+            yield card, self[card]
+
+    def fetch(self, cards):
+        """
+        Make sure the texts of `cards` are at hand, before they're shown. Only
+        stores that read texts as they go need to do anything.
+        """
+
+    def prefetch(self, cards):
+        """
+        Start reading the texts of `cards` in the background, so `fetch` has
+        nothing left to do by the time they're shown.
+        """
+
+    def template(self, card):
+        return self.templates[card]
+
+    def blanks(self, card):
+        return self.template(card).blanks
+
+
+class Deck(object):
+    """
+    A pile of card ids to draw from, with its discard pile.
+
+    The pile starts out as a view over ranges of ids in the card store, so
+    games playing with different packs share the store without copying it.
+    Drawing is a Fisher-Yates shuffle done a card at a time: the chosen card
+    is swapped with the last one and the pile shrinks by one. Only positions
+    whose card has moved are stored, so a deck costs memory for the cards
+    drawn from it, not the cards in it.
+
+    The next few draws can be chosen early with `peek`, so their texts can
+    be read before they're dealt.
+    """
+
+    __slots__ = ('ranges', 'starts', 'size', 'moved', 'discards', 'upcoming')
+
+    def __init__(self, ranges):
+        self.ranges = [tuple(r) for r in ranges]
+        # Where each range starts in the pile.
+        self.starts = []
+        self.size = 0
+        for start, stop in self.ranges:
+            self.starts.append(self.size)
+            self.size += stop - start
+        # {position: card} for positions no longer holding the range's card.
+        self.moved = {}
+        self.discards = array('i')
+        # Cards already drawn by `peek`, next first.
+        self.upcoming = []
+
+    def __len__(self):
+        return self.size + len(self.upcoming)
+
+    def __iter__(self):
+        for card in self.upcoming:
+            yield card
+        for i in xrange(self.size):
+            yield self.at(i)
+
+    def at(self, i):
+        card = self.moved.get(i)
+        if card is None:
+            r = bisect_right(self.starts, i) - 1
+            card = self.ranges[r][0] + i - self.starts[r]
+        return card
+
+    def draw(self):
+        """ Draw a random card, in O(1) and without shuffling up front. """
+        if self.upcoming:
+            return self.upcoming.pop(0)
+        return self._draw()
+
+    def peek(self, n):
+        """ The next `n` cards to be drawn, or as many as there are. """
+        while len(self.upcoming) < n and (self.size or self.discards):
+            self.upcoming.append(self._draw())
+        return self.upcoming[:n]
+
+    def _draw(self):
+        # Feed discards back in a card at a time, once they outnumber the
+        # deck. Draws are random, so they don't need shuffling in.
+        while self.discards and (not self.size or
+                                 len(self.discards) > self.size * 2):
+            self.put(self._take(self.discards))
+
+        if not self.size:
+            raise IndexError("draw from an empty deck")
+        i = random.randrange(self.size)
+        card = self.at(i)
+        self.drop(i)
+        return card
+
+    def put(self, card):
+        self.moved[self.size] = card
+        self.size += 1
+
+    def drop(self, i):
+        """ Fill position `i` with the last card, and shrink the pile. """
+        last = self.size - 1
+        if i != last:
+            self.moved[i] = self.at(last)
+        self.moved.pop(last, None)
+        self.size = last
+
+    def remove(self, card):
+        """
+        Take a particular card out of the pile, if it's there. Only meant for
+        a deck that's just been made, like when a game is restored.
+        """
+        if card in self.upcoming:
+            return self.upcoming.remove(card)
+        for i, moved in self.moved.iteritems():
+            if moved == card:
+                return self.drop(i)
+        r = bisect_right(self.ranges, (card, float('inf'))) - 1
+        if r >= 0 and card < self.ranges[r][1]:
+            i = self.starts[r] + card - self.ranges[r][0]
+            if i < self.size and i not in self.moved:
+                self.drop(i)
+
+    def discard(self, card):
+        self.discards.append(card)
+
+    def discard_all(self, cards):
+        self.discards.extend(cards)
+
+    def _take(self, pile):
+        i = random.randrange(len(pile))
+        card = pile[i]
+        pile[i] = pile[-1]
+        pile.pop()
+        return card
@@ -0,0 +1,255 @@
+"""
+Every round that's been won, and how well each card does.
+"""
+import json
+import time
+from collections import deque
+
+from sqlalchemy import and_, bindparam, func
+from twisted.internet import defer, task
+
+from .leaderboard import Board, as_unicode
+from .models import RoundTable, CardStatTable
+
+
+class History(object):
+    """
+    Rounds are archived as they're won, in batches through a DBPool, the
+    same way the ScoreLedger writes scores: every `interval` seconds, once
+    `max_pending` rounds have built up, and at shutdown. Only one batch is
+    ever in flight. Rounds still waiting when the bot crashes are lost.
+
+    How often each card has been played and won is read once at start up
+    and counted in memory from then on, with the white cards' wins kept
+    ranked, so !topcards never reads cah_rounds. The db's counts are only
+    ever added to, so processes sharing the db don't undo each other's.
+    The last `keep` rounds of each channel are kept for !history, read back
+    from the db the first time a channel asks.
+
+    Round ids are made up like the ScoreLedger's session ids, from `ids` if
+    it's given.
+    """
+
+    def __init__(self, pool, interval=30, max_pending=100, keep=10,
+                 ids=None, clock=None):
+        self.pool = pool
+        self.ids = ids
+        self.interval = interval
+        self.max_pending = max_pending
+        self.keep = keep
+
+        # {(color, text): [played, won]}
+        self.stats = {}
+        # White cards by how many rounds they've won.
+        self.wins = Board()
+        # {channel: deque of round dicts}, newest last.
+        self.recent = {}
+        # Rounds, and what they added to each card's stats, not yet in the db.
+        self.pending = []
+        self.changed = {}
+        # The batch being written, and the Deferred for it.
+        self.in_flight = []
+        self.flushing = None
+        self.next_round = None
+
+        self.loop = task.LoopingCall(self.flush)
+        if clock is not None:
+            self.loop.clock = clock
+
+    def start(self):
+        self.next_round = self.pool.run_now(
+            lambda s: s.query(func.max(RoundTable.id)).scalar() or 0) + 1
+        for desc, color, played, won in self.pool.run_now(read_stats):
+            self.stats[(color, desc)] = [played, won]
+        self.wins = Board((desc, won) for (color, desc), (played, won)
+                          in self.stats.iteritems()
+                          if color == 'white' and won)
+        self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        """
+        Stop flushing and write whatever's pending. If a batch is still in
+        flight, that happens once it's done, and a Deferred is returned.
+        """
+        if self.loop.running:
+            self.loop.stop()
+        if self.flushing is not None:
+            return self.flushing.addBoth(lambda _: self.flush_now())
+        self.flush_now()
+
+    def add(self, channel, session, prompt, answers, winner):
+        """
+        Archive a round. `answers` is [(nick, [card text])] in the order they
+        were shown.
+        """
+        winner = as_unicode(winner)
+        answers = [(as_unicode(nick), cards) for nick, cards in answers]
+        if self.ids is not None:
+            id = self.ids.next()
+        else:
+            id = self.next_round
+            self.next_round += 1
+        record = {
+            'id': id,
+            'session_id': session,
+            'channel': channel,
+            'finished': int(time.time()),
+            'prompt': prompt,
+            'winner': winner,
+            'answers': json.dumps(answers),
+        }
+        self.pending.append(record)
+        if channel in self.recent:
+            self.recent[channel].append(record)
+
+        self.count('black', prompt, 0)
+        for nick, cards in answers:
+            for card in cards:
+                self.count('white', card, nick == winner)
+                if nick == winner:
+                    self.wins.add(card, 1)
+
+        if len(self.pending) >= self.max_pending:
+            self.flush()
+
+    def count(self, color, text, won):
+        for stats in (self.stats.setdefault((color, text), [0, 0]),
+                      self.changed.setdefault((color, text), [0, 0])):
+            stats[0] += 1
+            stats[1] += won
+
+    def top(self, k):
+        """ The `k` white cards that have won most, [(text, played, won)] """
+        return [(text, self.stats[('white', text)][0], won)
+                for text, won in self.wins.top(k)]
+
+    def last(self, channel, k):
+        """
+        A Deferred firing with a channel's last `k` rounds, newest first.
+        Only the first ask for each channel goes to the db.
+        """
+        rounds = self.recent.get(channel)
+        if rounds is not None:
+            return defer.succeed(list(reversed(rounds))[:k])
+
+        def loaded(rows):
+            rounds = self.recent.get(channel)
+            if rounds is None:
+                # Rounds won since are in the db or pending, not both.
+                ids = set(r['id'] for r in rows)
+                rows += [r for r in self.in_flight + self.pending
+                         if r['channel'] == channel and r['id'] not in ids]
+                rows.sort(key=lambda r: r['id'])
+                rounds = self.recent[channel] = deque(rows, self.keep)
+            return list(reversed(rounds))[:k]
+
+        return self.pool.run(read_rounds, channel, self.keep).addCallback(
+            loaded)
+
+    def take_batch(self):
+        rounds, self.pending = self.pending, []
+        stats, self.changed = self.changed, {}
+        return rounds, stats
+
+    def flush(self):
+        """ Write every pending round to the db, in the pool. """
+        if self.flushing is not None or not (self.pending or self.changed):
+            return self.flushing
+
+        rounds, stats = self.take_batch()
+        self.in_flight = rounds
+        d = self.flushing = self.pool.run(write, rounds, stats)
+        d.addCallbacks(self.written, self.failed, errbackArgs=(rounds, stats))
+        return d
+
+    def flush_now(self):
+        """ Write every pending round to the db, blocking until it's done. """
+        if not (self.pending or self.changed):
+            return
+        rounds, stats = self.take_batch()
+        try:
+            self.pool.run_now(write, rounds, stats)
+        except Exception as e:
+            self.failed(e, rounds, stats)
+
+    def written(self, result):
+        self.flushing = None
+        self.in_flight = []
+
+    def failed(self, error, rounds, stats):
+        self.flushing = None
+        self.in_flight = []
+        print "Couldn't write round history, will retry: {0}".format(
+            getattr(error, 'value', error))
+        self.pending = rounds + self.pending
+        # A failed batch was rolled back, so its counts go in the next one.
+        for key, (played, won) in stats.iteritems():
+            changed = self.changed.setdefault(key, [0, 0])
+            changed[0] += played
+            changed[1] += won
+
+
+def ago(seconds):
+    """ A rough, short description of how long ago something was """
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= size:
+            return '{0}{1} ago'.format(int(seconds // size), unit)
+    return 'just now'
+
+
+def read_stats(session):
+    return session.query(CardStatTable.desc, CardStatTable.color,
+                         CardStatTable.played, CardStatTable.won).all()
+
+
+def read_rounds(session, channel, k):
+    query = (session.query(RoundTable)
+             .filter_by(channel=channel)
+             .order_by(RoundTable.id.desc())
+             .limit(k))
+    return [{'id': r.id, 'session_id': r.session_id, 'channel': r.channel,
+             'finished': r.finished, 'prompt': r.prompt, 'winner': r.winner,
+             'answers': r.answers} for r in reversed(query.all())]
+
+
+def write(session, rounds, stats):
+    """ Insert a batch of rounds and add to the stats of the cards in them. """
+    if rounds:
+        # After a failed batch, some of it may have made it in after all.
+        ids = [r['id'] for r in rounds]
+        known = set()
+        for i in xrange(0, len(ids), 500):
+            query = (session.query(RoundTable.id)
+                     .filter(RoundTable.id.in_(ids[i:i + 500])))
+            known.update(id for id, in query)
+        rounds = [r for r in rounds if r['id'] not in known]
+        if rounds:
+            session.execute(RoundTable.__table__.insert(), rounds)
+
+    known = set()
+    texts = list(set(text for color, text in stats))
+    for i in xrange(0, len(texts), 500):
+        query = (session.query(CardStatTable.color, CardStatTable.desc)
+                 .filter(CardStatTable.desc.in_(texts[i:i + 500])))
+        known.update(query)
+
+    new = []
+    changed = []
+    for (color, text), (played, won) in stats.iteritems():
+        if (color, text) in known:
+            changed.append({'b_color': color, 'b_desc': text,
+                            'b_played': played, 'b_won': won})
+        else:
+            new.append({'desc': text, 'color': color, 'played': played,
+                        'won': won})
+    if changed:
+        # Added to in the db, in case another process has just done the same.
+        table = CardStatTable.__table__
+        update = (table.update()
+                  .where(and_(table.c.color == bindparam('b_color'),
+                              table.c.desc == bindparam('b_desc')))
+                  .values(played=table.c.played + bindparam('b_played'),
+                          won=table.c.won + bindparam('b_won')))
+        session.execute(update, changed)
+    if new:
+        session.execute(CardStatTable.__table__.insert(), new)
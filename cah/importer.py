@@ -0,0 +1,209 @@
+"""
+Importing packs of cards in bulk.
+
+A pack can be plain text (one card per line, all one color), CSV (text and
+color columns) or json lines ({"text": ..., "color": ...}). It's read a line
+at a time, each card is formatted the same way !addcard would, and whatever
+is new is inserted with bulk executemany calls, all in one transaction.
+
+    python -m cah.importer sqlite:///hamper.db community.csv
+    python -m cah.importer sqlite:///hamper.db whites.txt --color white
+
+Cards go into a pack named after the file (community, whites), unless
+--pack-name says otherwise.
+
+From IRC, admins can use "!importcards <path> [white|black]" with a path on
+the bot's machine.
+"""
+import argparse
+import csv
+import json
+import os
+import re
+
+from hamper.utils import ude
+
+from .deck import CardStore, BLANK
+from .models import CardTable, add_missing_columns
+from .search import CardIndex, normalize
+
+
+FORMATS = ('text', 'csv', 'jsonl')
+MAX_BLANKS = 3
+
+
+def guess_format(path):
+    if path.endswith('.csv'):
+        return 'csv'
+    if path.endswith(('.jsonl', '.json')):
+        return 'jsonl'
+    return 'text'
+
+
+def pack_for(path):
+    """ The pack cards imported from `path` go in """
+    return os.path.splitext(os.path.basename(path))[0].lower()
+
+
+def read_cards(f, fmt, color=None):
+    """
+    Yield (line number, text, color, problem) for each card in a pack file,
+    as it's read. A card's color is None if the file doesn't say and `color`
+    wasn't given. Problem is None unless the line couldn't be read.
+    """
+    if fmt == 'csv':
+        for n, row in enumerate(csv.reader(f), 1):
+            if not row or (n == 1 and row[0].strip().lower() in
+                           ('text', 'desc', 'card')):
+                continue
+            yield n, row[0], (row[1].strip() if len(row) > 1 else color), None
+
+    elif fmt == 'jsonl':
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                card = json.loads(line)
+            except ValueError:
+                yield n, None, None, "not json"
+                continue
+            if not isinstance(card, dict):
+                yield n, None, None, "not a json object"
+                continue
+            text = card.get('text', card.get('desc'))
+            yield n, text, card.get('color', color), None
+
+    else:
+        for n, line in enumerate(f, 1):
+            yield n, line.rstrip('\r\n'), color, None
+
+
+def parse(f, fmt, formatters, color=None):
+    """
+    Format every card in a pack file like !addcard does. Returns
+    ([(text, color)], [(line number, why it was rejected)]).
+    """
+    cards = []
+    rejects = []
+    for n, text, card_color, problem in read_cards(f, fmt, color):
+        if problem or not isinstance(text, basestring):
+            rejects.append((n, problem or "no text"))
+            continue
+        if card_color not in formatters:
+            rejects.append((n, "no color, or not white or black"))
+            continue
+        if isinstance(text, str):
+            try:
+                text = ude(text)
+            except UnicodeDecodeError:
+                rejects.append((n, "not utf-8"))
+                continue
+
+        if card_color == 'black':
+            text, blanks = re.subn(u'_+', BLANK, text)
+            if blanks > MAX_BLANKS:
+                rejects.append((n, "too many blanks"))
+                continue
+        text = formatters[card_color](text)
+        if not text:
+            rejects.append((n, "empty"))
+            continue
+        cards.append((text, card_color))
+    return cards, rejects
+
+
+def dedupe(cards, index):
+    """
+    Drop every card that `index` already has a duplicate of, or that came
+    earlier in `cards`. Returns ([(text, color)] that are new, number dropped).
+    """
+    seen = set()
+    new = []
+    duplicates = 0
+    for text, color in cards:
+        key = (color, normalize(text))
+        if key in seen or index.duplicate(text, color) is not None:
+            duplicates += 1
+            continue
+        seen.add(key)
+        new.append((text, color))
+    return new, duplicates
+
+
+def write(session, cards, pack, chunk=1000, progress=None):
+    """ Insert [(text, color)] with executemany calls, without committing. """
+    table = CardTable.__table__
+    for i in xrange(0, len(cards), chunk):
+        session.execute(table.insert(),
+                        [{'desc': text, 'color': color, 'official': False,
+                          'pack': pack}
+                         for text, color in cards[i:i + chunk]])
+        if progress:
+            progress(min(i + chunk, len(cards)), len(cards))
+
+
+def insert(session, cards, index, pack, chunk=1000, progress=None):
+    """
+    Insert every card that `index` doesn't already have a duplicate of, in
+    one transaction. Returns ([(text, color)] inserted, number of duplicates).
+    """
+    new, duplicates = dedupe(cards, index)
+    try:
+        write(session, new, pack, chunk, progress)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return new, duplicates
+
+
+def main():
+    from sqlalchemy import create_engine, orm
+    from .cah import cah as plugin
+
+    parser = argparse.ArgumentParser(description="Import a pack of cards.")
+    parser.add_argument('db', help="SQLAlchemy url of the db")
+    parser.add_argument('pack', help="text, csv or json lines file of cards")
+    parser.add_argument('--format', choices=FORMATS,
+                        help="format of the pack, by default from its name")
+    parser.add_argument('--color', choices=('white', 'black'),
+                        help="color of cards that don't say")
+    parser.add_argument('--pack-name', help="pack to put the cards in, by "
+                        "default the name of the file")
+    parser.add_argument('--chunk', type=int, default=1000,
+                        help="rows per insert")
+    args = parser.parse_args()
+
+    engine = create_engine(args.db)
+    session = orm.sessionmaker(engine)()
+    CardTable.__table__.create(engine, checkfirst=True)
+    add_missing_columns(engine)
+
+    cards = CardStore()
+    for desc, color in session.query(CardTable.desc, CardTable.color):
+        cards.add(desc, color)
+    index = CardIndex(cards)
+    index.build()
+
+    formatters = {'white': plugin.format_white, 'black': plugin.init_black}
+    with open(args.pack, 'rb') as f:
+        new, rejects = parse(f, args.format or guess_format(args.pack),
+                             formatters, args.color)
+    print "Read {0} cards, rejected {1}.".format(len(new), len(rejects))
+    for n, why in rejects[:20]:
+        print "  line {0}: {1}".format(n, why)
+    if len(rejects) > 20:
+        print "  ..."
+
+    def progress(done, total):
+        print "Inserted {0}/{1}".format(done, total)
+
+    pack = args.pack_name or pack_for(args.pack)
+    added, duplicates = insert(session, new, index, pack, args.chunk,
+                               progress)
+    print "Added {0} cards to {1}, skipped {2} already in the deck.".format(
+        len(added), pack, duplicates)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Journalling live games, so they survive a restart.
+"""
+import json
+import os
+
+from twisted.internet import task
+
+
+class Journal(object):
+    """
+    An append-only log of game states.
+
+    Games mark themselves dirty whenever they change, which is O(1). Every
+    `interval` seconds, each dirty game's whole state is appended as one json
+    line and the file is fsync'd, so however many transitions a game went
+    through it costs one line per batch. Each line holds absolute values, so
+    replaying the last line for a game is all recovery needs.
+
+    Once `snapshot_every` lines have been written, the latest line for every
+    game is written to a snapshot file and the journal is emptied. A restart
+    reads the snapshot plus the short tail of journal since.
+    """
+
+    def __init__(self, path, interval=1.0, snapshot_every=1000, clock=None):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self.interval = interval
+        self.snapshot_every = snapshot_every
+
+        # {channel: game} changed since the last flush.
+        self.dirty = {}
+        # {channel: json line} of the last state written for every game.
+        self.latest = {}
+        self.written = 0
+
+        self.file = None
+        self.loop = task.LoopingCall(self.flush)
+        if clock is not None:
+            self.loop.clock = clock
+
+    def recover(self):
+        """
+        Read back the last state of every game, as {channel: record}, and
+        start journalling.
+        """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        for path in (self.snapshot_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last line may be cut short by a crash.
+                        continue
+                    self.remember(record['channel'], record, line.rstrip('\n'))
+
+        # Start from a clean snapshot, so the journal only holds what's new.
+        self.snapshot()
+        self.file = open(self.path, 'a')
+        self.loop.start(self.interval, now=False)
+        return dict((channel, json.loads(line))
+                    for channel, line in self.latest.iteritems())
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+        self.flush()
+        self.snapshot()
+
+    def touch(self, game):
+        self.dirty[game.channel] = game
+
+    def forget(self, channel):
+        """ Stop journalling a game that's moved to another process. """
+        self.dirty.pop(channel, None)
+        self.latest.pop(channel, None)
+
+    def remember(self, channel, record, line):
+        if record.get('gone'):
+            self.latest.pop(channel, None)
+        else:
+            self.latest[channel] = line
+
+    def flush(self):
+        if not self.dirty:
+            return
+
+        dirty, self.dirty = self.dirty, {}
+        lines = []
+        for channel, game in dirty.iteritems():
+            record = game.dump()
+            line = json.dumps(record, separators=(',', ':'))
+            self.remember(channel, record, line)
+            lines.append(line + '\n')
+
+        if self.file is not None:
+            self.file.write(''.join(lines))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.written += len(lines)
+
+        if self.written >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        """ Write out every game's latest state and start a new journal. """
+        tmp = self.snapshot_path + '.tmp'
+        with open(tmp, 'w') as f:
+            for line in self.latest.itervalues():
+                f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.snapshot_path)
+
+        # A crash before this just means replaying lines already snapshotted.
+        if self.file is not None:
+            self.file.truncate(0)
+        else:
+            open(self.path, 'w').close()
+        self.written = 0
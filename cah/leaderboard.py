@@ -0,0 +1,98 @@
+"""
+All time and per channel leaderboards.
+"""
+from bisect import bisect_left, insort
+
+from sqlalchemy import func
+
+from .models import PlayerTable, SessionTable, ScoreTable
+
+
+class Board(object):
+    """
+    Every player's total, plus a list of (-total, nick) kept sorted best
+    first. Ranks are a binary search and the top k a slice; a point changing
+    hands moves one entry, found by binary search.
+    """
+
+    __slots__ = ('totals', 'ranked')
+
+    def __init__(self, totals=None):
+        self.totals = dict(totals or {})
+        self.ranked = sorted((-total, nick)
+                             for nick, total in self.totals.iteritems())
+
+    def __len__(self):
+        return len(self.ranked)
+
+    def add(self, nick, points):
+        old = self.totals.get(nick)
+        if old is not None:
+            del self.ranked[bisect_left(self.ranked, (-old, nick))]
+        total = self.totals[nick] = (old or 0) + points
+        insort(self.ranked, (-total, nick))
+
+    def rank(self, nick):
+        """ (rank, total) for `nick`, or None. Ties share a rank. """
+        total = self.totals.get(nick)
+        if total is None:
+            return None
+        # Everyone with a better total sorts before (-total,).
+        return bisect_left(self.ranked, (-total,)) + 1, total
+
+    def top(self, k):
+        """ The `k` best [(nick, total)] """
+        return [(nick, -total) for total, nick in self.ranked[:k]]
+
+
+class Leaderboard(object):
+    """
+    Boards for all time (under None) and for every channel, read from the db
+    once at start up and kept up to date as points are given and taken.
+    """
+
+    def __init__(self):
+        self.boards = {None: Board()}
+
+    def load(self, session):
+        """ Total everyone's scores, with one GROUP BY for each kind of board """
+        total = func.sum(ScoreTable.score)
+        query = (session.query(PlayerTable.nick, total)
+                 .join(ScoreTable, ScoreTable.player_id == PlayerTable.id)
+                 .group_by(PlayerTable.nick))
+        self.boards = {None: Board((nick, t) for nick, t in query if t)}
+
+        query = (session.query(SessionTable.channel, PlayerTable.nick, total)
+                 .join(ScoreTable, ScoreTable.session_id == SessionTable.id)
+                 .join(PlayerTable, ScoreTable.player_id == PlayerTable.id)
+                 .group_by(SessionTable.channel, PlayerTable.nick))
+        channels = {}
+        for channel, nick, t in query:
+            if channel and t:
+                channels.setdefault(channel, {})[nick] = t
+        for channel, totals in channels.iteritems():
+            self.boards[channel] = Board(totals)
+
+    def board(self, channel=None):
+        return self.boards.get(channel) or Board()
+
+    def add(self, channel, nick, points):
+        nick = as_unicode(nick)
+        self.boards[None].add(nick, points)
+        board = self.boards.get(channel)
+        if board is None:
+            board = self.boards[channel] = Board()
+        board.add(nick, points)
+
+    def rank(self, nick, channel=None):
+        return self.board(channel).rank(as_unicode(nick))
+
+    def top(self, k, channel=None):
+        return self.board(channel).top(k)
+
+
+def as_unicode(nick):
+    # Nicks come off the wire as bytes, but out of the db as unicode.
+    if isinstance(nick, str):
+        return nick.decode('utf-8', 'replace')
+    return nick
@@ -0,0 +1,156 @@
+"""
+Counters and timings for the running plugin.
+
+Everything here is cheap enough to leave on: a command costs two calls to
+time.time() and a bucket increment, and a db statement one increment. The
+expensive parts (walking every game for deck sizes, asking the reactor for
+its timers) only happen when the numbers are asked for, by !cahstats or when
+the Prometheus file is written.
+"""
+import bisect
+import os
+import time
+
+from sqlalchemy import event
+from twisted.internet import task
+
+
+# Upper bounds of the latency buckets, in seconds.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram(object):
+    """ Counts of observations falling into each of BUCKETS, and past them """
+
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def cumulative(self):
+        """ [(le, count)] in Prometheus' style, ending with +Inf """
+        total = 0
+        buckets = []
+        for le, count in zip(BUCKETS + ('+Inf',), self.counts):
+            total += count
+            buckets.append((le, total))
+        return buckets
+
+    def quantile(self, q):
+        """ The upper bound of the bucket the q'th observation fell into """
+        if not self.count:
+            return 0
+        rank = q * self.count
+        for le, total in self.cumulative():
+            if total >= rank:
+                return le
+        return '+Inf'
+
+
+class Metrics(object):
+    """
+    Command timings and db statement counts, plus gauges read from the plugin
+    whenever a snapshot is taken. `gauges` is called with no arguments and
+    returns [(name, labels, value)].
+    """
+
+    def __init__(self, gauges, clock=None):
+        self.gauges = gauges
+        self.commands = {}
+        self.queries = 0
+        self.commits = 0
+        self.started = time.time()
+        self.loop = None
+        self.clock = clock
+
+    def timed(self, name, f):
+        """ Wrap `f` so every call is timed under `name`. """
+        histogram = self.commands.setdefault(name, Histogram())
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                histogram.observe(time.time() - start)
+        return timed
+
+    def watch_engine(self, engine):
+        """ Count every statement and commit the engine runs. """
+        event.listen(engine, 'before_cursor_execute', self.count_query)
+        event.listen(engine, 'commit', self.count_commit)
+
+    def count_query(self, conn, cursor, statement, parameters, context,
+                    executemany):
+        self.queries += 1
+
+    def count_commit(self, conn):
+        self.commits += 1
+
+    def snapshot(self):
+        """ [(name, labels, value)] for every counter and gauge """
+        samples = [
+            ('cah_uptime_seconds', {}, time.time() - self.started),
+            ('cah_db_queries_total', {}, self.queries),
+            ('cah_db_commits_total', {}, self.commits),
+        ]
+        samples.extend(self.gauges())
+        return samples
+
+    def render(self):
+        """ Everything, in Prometheus' text format """
+        lines = []
+        for name, labels, value in self.snapshot():
+            lines.append(sample(name, labels, value))
+
+        if self.commands:
+            lines.append('# TYPE cah_command_seconds histogram')
+        for command, histogram in sorted(self.commands.items()):
+            for le, total in histogram.cumulative():
+                lines.append(sample('cah_command_seconds_bucket',
+                                    {'command': command, 'le': le}, total))
+            lines.append(sample('cah_command_seconds_sum',
+                                {'command': command}, histogram.sum))
+            lines.append(sample('cah_command_seconds_count',
+                                {'command': command}, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """ Write the text file, atomically, for a node exporter to pick up """
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp, path)
+
+    def start(self, path, interval):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.loop = task.LoopingCall(self.write, path)
+        if self.clock is not None:
+            self.loop.clock = self.clock
+        self.loop.start(interval)
+
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+
+
+def sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{0}="{1}"'.format(k, escape(v))
+                               for k, v in sorted(labels.items())) + '}'
+    return '{0} {1}'.format(name, value)
+
+
+def escape(value):
+    return (unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n').encode('utf-8'))
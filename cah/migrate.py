@@ -0,0 +1,108 @@
+"""
+Roll the old `cah` score table up into cah_players, cah_sessions and
+cah_scores.
+
+Every distinct player string in the old table becomes a session, and every
+row a score in it. Everything happens in one transaction with bulk inserts,
+and the old rows are deleted as part of it. Sessions made here start at 0,
+which no game's do, so if there are any already (the old rows were kept with
+--keep) nothing is done. Either way, running it again is harmless.
+
+    python -m cah.migrate sqlite:///hamper.db
+"""
+import argparse
+
+import sqlalchemy
+from sqlalchemy import func, select
+
+from .models import (SQLAlchemyBase, CAHTable, PlayerTable, SessionTable,
+                     ScoreTable)
+
+
+def old_channel(game):
+    # Player strings written since games went per channel start with it.
+    first = game.split(' ', 1)[0]
+    if first[:1] in ('#', '&'):
+        return first
+    return ''
+
+
+def next_id(conn, table):
+    return (conn.execute(select([func.max(table.c.id)])).scalar() or 0) + 1
+
+
+def insert(conn, table, rows, chunk):
+    for i in xrange(0, len(rows), chunk):
+        conn.execute(table.insert(), rows[i:i + chunk])
+
+
+def migrate(engine, keep=False, chunk=1000):
+    """ Returns the number of sessions, players and scores made. """
+    SQLAlchemyBase.metadata.create_all(engine)
+    old = CAHTable.__table__
+    players = PlayerTable.__table__
+    sessions = SessionTable.__table__
+    scores = ScoreTable.__table__
+
+    conn = engine.connect()
+    with conn.begin():
+        migrated = conn.execute(select([sessions.c.id])
+                                .where(sessions.c.started == 0)
+                                .limit(1)).first()
+        if migrated is not None:
+            return 0, 0, 0
+
+        # Ids are handed out here, so nothing needs reading back.
+        session_ids = {}
+        new_sessions = []
+        session_id = next_id(conn, sessions)
+        for (game,) in conn.execute(select([old.c.game]).distinct()):
+            session_ids[game] = session_id
+            new_sessions.append({'id': session_id, 'started': 0,
+                                 'channel': old_channel(game or '')})
+            session_id += 1
+
+        player_ids = dict(conn.execute(select([players.c.nick,
+                                               players.c.id])).fetchall())
+        new_players = []
+        player_id = next_id(conn, players)
+        for (nick,) in conn.execute(select([old.c.user]).distinct()):
+            if nick is not None and nick not in player_ids:
+                player_ids[nick] = player_id
+                new_players.append({'id': player_id, 'nick': nick})
+                player_id += 1
+
+        totals = {}
+        rows = conn.execution_options(stream_results=True).execute(
+            select([old.c.game, old.c.user, old.c.score]))
+        for game, nick, score in rows:
+            if nick is None:
+                continue
+            key = (session_ids[game], player_ids[nick])
+            totals[key] = totals.get(key, 0) + (score or 0)
+        new_scores = [{'session_id': s, 'player_id': p, 'score': score}
+                      for (s, p), score in totals.iteritems()]
+
+        insert(conn, sessions, new_sessions, chunk)
+        insert(conn, players, new_players, chunk)
+        insert(conn, scores, new_scores, chunk)
+        if not keep:
+            conn.execute(old.delete())
+
+    return len(new_sessions), len(new_players), len(new_scores)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Move old cah scores into the new score tables.")
+    parser.add_argument('db', help="SQLAlchemy url of the db")
+    parser.add_argument('--keep', action='store_true',
+                        help="don't delete the old rows afterwards")
+    args = parser.parse_args()
+
+    made = migrate(sqlalchemy.create_engine(args.db), keep=args.keep)
+    print "Made {0} sessions, {1} players and {2} scores.".format(*made)
+
+
+if __name__ == '__main__':
+    main()
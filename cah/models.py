@@ -0,0 +1,255 @@
+"""
+The db tables.
+"""
+import time
+
+from sqlalchemy import (Column, Integer, Float, String, Boolean, ForeignKey,
+                        Index, UniqueConstraint, inspect)
+from sqlalchemy.ext.declarative import declarative_base
+
+
+SQLAlchemyBase = declarative_base()
+
+
+class CardTable(SQLAlchemyBase):
+    """
+    This is only for persistant storage of all cards. More can also be
+    added through commands in this manner.
+    """
+
+    __tablename__ = 'cah_cards'
+
+    id = Column(Integer, primary_key=True)
+    desc = Column(String)
+    color = Column(String)
+    official = Column(Boolean)
+    # Cards from before packs were recorded have none; see deck.pack_name.
+    pack = Column(String)
+
+    def __init__(self, desc, color, official=True, pack=None):
+        self.desc = desc
+        self.color = color
+        self.official = official
+        self.pack = pack
+
+    def __repr__(self):
+        print self.desc
+        return self.desc
+
+
+class CAHTable(SQLAlchemyBase):
+    """
+    For storing scores on a per player per game basis.
+
+    This is the old score table, keyed on a string of every player's name.
+    Scores are kept in cah_scores now; see `python -m cah.migrate`.
+    """
+
+    __tablename__ = 'cah'
+
+    id = Column(Integer, primary_key=True)
+    game = Column(String)
+    user = Column(String)
+    score = Column(Integer)
+
+    def __init__(self, user, game, score=0):
+        self.user = user
+        self.game = game
+        self.score = score
+
+    def __repr__(self):
+        return "%s: %d" % self.user, self.score
+
+
+class PlayerTable(SQLAlchemyBase):
+    """
+    Everyone who has ever had a score.
+    """
+
+    __tablename__ = 'cah_players'
+
+    id = Column(Integer, primary_key=True)
+    nick = Column(String, nullable=False, unique=True)
+
+    def __init__(self, nick):
+        self.nick = nick
+
+    def __repr__(self):
+        return self.nick
+
+
+class SessionTable(SQLAlchemyBase):
+    """
+    One game in one channel, from when play starts until it stops for lack of
+    players. Players can come and go without starting a new session.
+    """
+
+    __tablename__ = 'cah_sessions'
+    __table_args__ = (
+        Index('ix_cah_sessions_channel_started', 'channel', 'started'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    channel = Column(String, nullable=False)
+    started = Column(Integer, nullable=False)
+    # The term of the channel's lease its scores were last written under, so
+    # a process that's lost the channel can't write over them. Null when
+    # channels aren't split between processes.
+    term = Column(Integer)
+
+    def __init__(self, channel, started=None):
+        self.channel = channel
+        self.started = int(time.time()) if started is None else started
+
+    def __repr__(self):
+        return "%s #%d" % (self.channel, self.id)
+
+
+class ScoreTable(SQLAlchemyBase):
+    """
+    A player's score in one session.
+    """
+
+    __tablename__ = 'cah_scores'
+    __table_args__ = (
+        UniqueConstraint('session_id', 'player_id'),
+        Index('ix_cah_scores_session_score', 'session_id', 'score'),
+        Index('ix_cah_scores_player_score', 'player_id', 'score'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    session_id = Column(Integer, ForeignKey('cah_sessions.id'), nullable=False)
+    player_id = Column(Integer, ForeignKey('cah_players.id'), nullable=False)
+    score = Column(Integer, nullable=False, default=0)
+
+    def __init__(self, session_id, player_id, score=0):
+        self.session_id = session_id
+        self.player_id = player_id
+        self.score = score
+
+    def __repr__(self):
+        return "%d/%d: %d" % (self.session_id, self.player_id, self.score)
+
+
+
+class RoundTable(SQLAlchemyBase):
+    """
+    A round that was won: its prompt, everyone's answers and the winner.
+    """
+
+    __tablename__ = 'cah_rounds'
+    __table_args__ = (
+        Index('ix_cah_rounds_channel_id', 'channel', 'id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    session_id = Column(Integer)
+    channel = Column(String, nullable=False)
+    finished = Column(Integer, nullable=False)
+    prompt = Column(String, nullable=False)
+    winner = Column(String, nullable=False)
+    # json: [[nick, [card, ...]], ...], in the order they were shown.
+    answers = Column(String, nullable=False)
+
+    def __init__(self, channel, prompt, winner, answers, session_id=None,
+                 finished=None):
+        self.channel = channel
+        self.prompt = prompt
+        self.winner = winner
+        self.answers = answers
+        self.session_id = session_id
+        self.finished = int(time.time()) if finished is None else finished
+
+    def __repr__(self):
+        return "%s #%d" % (self.channel, self.id)
+
+
+class CardStatTable(SQLAlchemyBase):
+    """
+    How often a card has been played, and how often it won. Kept up to date
+    as rounds are won, so nothing has to go through cah_rounds to answer.
+    """
+
+    __tablename__ = 'cah_card_stats'
+    __table_args__ = (
+        UniqueConstraint('color', 'desc'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    desc = Column(String, nullable=False)
+    color = Column(String, nullable=False)
+    played = Column(Integer, nullable=False, default=0)
+    won = Column(Integer, nullable=False, default=0)
+
+    def __init__(self, desc, color, played=0, won=0):
+        self.desc = desc
+        self.color = color
+        self.played = played
+        self.won = won
+
+    def __repr__(self):
+        return "%s: %d/%d" % (self.desc, self.won, self.played)
+
+
+class LeaseTable(SQLAlchemyBase):
+    """
+    Which bot process runs the game in a channel, and until when. The owner
+    saves its game here as it goes, for whoever takes the channel over.
+    """
+
+    __tablename__ = 'cah_leases'
+
+    channel = Column(String, primary_key=True)
+    owner = Column(String, nullable=False)
+    expires = Column(Float, nullable=False)
+    # json, as Game.dump makes it, or null if there's no game going.
+    game = Column(String)
+    # Goes up every time the lease changes hands.
+    term = Column(Integer)
+
+    def __init__(self, channel, owner, expires, game=None, term=1):
+        self.channel = channel
+        self.owner = owner
+        self.expires = expires
+        self.game = game
+        self.term = term
+
+    def __repr__(self):
+        return "%s: %s" % (self.channel, self.owner)
+
+
+class CounterTable(SQLAlchemyBase):
+    """
+    The next id to hand out for a table whose ids bot processes make up
+    themselves, reserved a block at a time.
+    """
+
+    __tablename__ = 'cah_counters'
+
+    name = Column(String, primary_key=True)
+    next = Column(Integer, nullable=False)
+
+    def __init__(self, name, next):
+        self.name = name
+        self.next = next
+
+    def __repr__(self):
+        return "%s: %d" % (self.name, self.next)
+
+
+def add_missing_columns(engine):
+    """
+    create_all only makes missing tables, so add any columns that have been
+    added to existing ones since. New columns have to be nullable.
+    """
+    existing = inspect(engine)
+    tables = set(existing.get_table_names())
+    for table in SQLAlchemyBase.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        have = set(c['name'] for c in existing.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in have:
+                engine.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+                    table.name, column.name,
+                    column.type.compile(dialect=engine.dialect)))
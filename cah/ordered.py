@@ -0,0 +1,63 @@
+"""
+An ordered set, for keeping track of players.
+"""
+import random
+from collections import OrderedDict
+
+
+class OrderedSet(object):
+    """
+    A set that remembers the order things were added in. Adding, removing,
+    membership and taking the first item are all O(1). Indexing makes a list
+    the first time it's needed after a change.
+    """
+
+    __slots__ = ('items', 'listed')
+
+    def __init__(self, items=()):
+        self.items = OrderedDict.fromkeys(items)
+        self.listed = None
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, i):
+        if self.listed is None:
+            self.listed = list(self.items)
+        return self.listed[i]
+
+    def add(self, item):
+        if item not in self.items:
+            self.items[item] = None
+            self.listed = None
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def discard(self, item):
+        if item in self.items:
+            del self.items[item]
+            self.listed = None
+
+    def pop(self):
+        """ Take the first item out, and return it. """
+        item, _ = self.items.popitem(last=False)
+        self.listed = None
+        return item
+
+    def clear(self):
+        self.items.clear()
+        self.listed = None
+
+    def shuffle(self):
+        listed = list(self.items)
+        random.shuffle(listed)
+        self.items = OrderedDict.fromkeys(listed)
+        self.listed = listed
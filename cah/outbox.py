@@ -0,0 +1,195 @@
+"""
+Rate limited, coalescing outbound messages.
+"""
+from collections import OrderedDict, deque
+
+
+class Outbox(object):
+    """
+    Messages on their way out to IRC.
+
+    The connection as a whole gets a token bucket, so the server never sees
+    more than `total_burst` lines at once or `total_rate` lines a second,
+    however many targets there are. Every target (a channel, or a user being
+    sent notices) also gets a bucket of its own: `burst` lines straight
+    away, then `rate` lines a second, so one busy channel can't use the
+    whole connection.
+
+    Urgent lines (prompts, calls to pick a winner) go before informational
+    ones, both across targets and within one. Otherwise lines go out in
+    order, taking turns between targets, and consecutive lines to the same
+    target are merged into one, up to `line_bytes`.
+
+    Nothing is sent until the reactor gets back round to the outbox, so
+    every line a command sends gets a chance to be merged.
+    """
+
+    URGENT = 0
+    NORMAL = 1
+
+    separator = ' | '
+
+    def __init__(self, clock, rate=0.5, burst=5, line_bytes=400,
+                 total_rate=1.0, total_burst=10):
+        self.clock = clock
+        self.rate = rate
+        self.burst = burst
+        self.line_bytes = line_bytes
+        self.total_rate = total_rate
+        self.total_burst = total_burst
+
+        # {target: (urgent deque, normal deque)} of [send, text, merge]
+        self.queues = {}
+        # Targets with lines of each priority waiting, in the order they'll
+        # be served: {priority: OrderedDict of target: None}.
+        self.ready = (OrderedDict(), OrderedDict())
+        # {target: (tokens, when)}, and the connection's under None.
+        self.buckets = {}
+        self.call = None
+        self.sent = 0
+        self.merged = 0
+
+    def __len__(self):
+        return sum(len(q) for queues in self.queues.itervalues()
+                   for q in queues)
+
+    def wrap(self, bot):
+        return QueuedBot(self, bot)
+
+    def put(self, target, send, text, urgent=False, merge=True):
+        """ Queue `text` to be sent to `target` by calling `send(text)`. """
+        if "\n" in text:
+            merge = False
+        priority = self.URGENT if urgent else self.NORMAL
+        queues = self.queues.get(target)
+        if queues is None:
+            queues = self.queues[target] = (deque(), deque())
+        queues[priority].append([send, text, merge])
+        if target not in self.ready[priority]:
+            self.ready[priority][target] = None
+
+        if self.call is None:
+            self.call = self.clock.callLater(0, self.pump)
+
+    def tokens(self, target, now):
+        if target is None:
+            rate, burst = self.total_rate, self.total_burst
+        else:
+            rate, burst = self.rate, self.burst
+        tokens, when = self.buckets.get(target, (burst, now))
+        return min(burst, tokens + (now - when) * rate)
+
+    def take(self, target, now):
+        self.buckets[target] = (self.tokens(target, now) - 1, now)
+
+    def pump(self):
+        self.call = None
+        now = self.clock.seconds()
+
+        while self.tokens(None, now) >= 1:
+            found = self.next_target(now)
+            if found is None:
+                break
+            priority, target = found
+            queue = self.queues[target][priority]
+            self.send_one(queue)
+            self.take(None, now)
+            self.take(target, now)
+
+            # To the back of the line, or out of it.
+            ready = self.ready[priority]
+            del ready[target]
+            if queue:
+                ready[target] = None
+            if not any(self.queues[target]):
+                del self.queues[target]
+
+        # Buckets that have filled back up don't need remembering.
+        if len(self.buckets) > 2 * len(self.queues) + 100:
+            for target in self.buckets.keys():
+                if (target is not None and target not in self.queues and
+                        self.tokens(target, now) >= self.burst):
+                    del self.buckets[target]
+
+        if self.queues:
+            total = self.tokens(None, now)
+            if total < 1:
+                wait = (1 - total) / self.total_rate
+            else:
+                wait = min((1 - self.tokens(target, now)) / self.rate
+                           for target in self.queues)
+            self.call = self.clock.callLater(max(0, wait), self.pump)
+
+    def next_target(self, now):
+        """ (priority, target) of the next line to send, if any can be """
+        for priority, ready in enumerate(self.ready):
+            for target in ready:
+                if self.tokens(target, now) >= 1:
+                    return priority, target
+        return None
+
+    def send_one(self, queue):
+        send, text, merge = queue.popleft()
+        size = len(self.encode(text))
+        while merge and queue:
+            nxt = queue[0]
+            if not nxt[2] or nxt[0] != send:
+                break
+            grown = size + len(self.separator) + len(self.encode(nxt[1]))
+            if grown > self.line_bytes:
+                break
+            text = text + self.separator + nxt[1]
+            size = grown
+            queue.popleft()
+            self.merged += 1
+        self.sent += 1
+        send(text)
+
+    def encode(self, text):
+        if isinstance(text, unicode):
+            return text.encode('utf-8')
+        return text
+
+
+class QueuedBot(object):
+    """
+    Stands in for hamper's bot, sending replies and notices through an
+    Outbox. Anything else goes straight to the bot.
+    """
+
+    def __init__(self, outbox, bot):
+        self.outbox = outbox
+        self.bot = bot
+
+    def __getattr__(self, name):
+        return getattr(self.bot, name)
+
+    def reply(self, comm, message, urgent=False, merge=True, **kwargs):
+        target = comm['user'] if comm['pm'] else comm['channel']
+        send = Sender(self.bot.reply, comm, kwargs)
+        self.outbox.put(target, send, message, urgent, merge)
+
+    def notice(self, user, message, urgent=False, merge=True):
+        send = Sender(self.bot.notice, user, {})
+        self.outbox.put(('notice', user), send, message, urgent, merge)
+
+
+class Sender(object):
+    """ How to send a queued line. Equal senders' lines can be merged. """
+
+    __slots__ = ('func', 'to', 'kwargs')
+
+    def __init__(self, func, to, kwargs):
+        self.func = func
+        self.to = to
+        self.kwargs = kwargs
+
+    def __eq__(self, other):
+        return (self.func == other.func and self.to == other.to and
+                self.kwargs == other.kwargs)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __call__(self, text):
+        self.func(self.to, text, **self.kwargs)
@@ -0,0 +1,202 @@
+"""
+Precompiled card packs.
+
+A pack is a single file holding every card, ready to be mmap'd at start up
+instead of pulling each card out of the db. Black cards are stored already
+coloured, and their blank counts are worked out ahead of time.
+
+The layout is a header, an index with one fixed size entry per card, then
+the utf-8 text of every card. White cards come first, so the cards of each
+color are one contiguous range of ids.
+
+    header: magic, number of white cards, number of black cards
+    entry:  offset of the text, length of the text, number of blanks
+
+Build one from the db or from text files with:
+
+    python -m cah.pack --db sqlite:///hamper.db cards.pack
+    python -m cah.pack --whites whites.txt --blacks blacks.txt cards.pack
+"""
+import argparse
+import mmap
+import struct
+from array import array
+
+from .deck import CardStore, Template, BLANK, BASE
+from .models import CardTable
+
+
+MAGIC = 'CAHPACK1'
+HEADER = struct.Struct('<8sII')
+ENTRY = struct.Struct('<IHB')
+
+
+def write_pack(path, cards):
+    """
+    Write a pack from an iterable of (text, color) pairs. Black cards should
+    already be formatted with `init_black`.
+    """
+    by_color = {'white': [], 'black': []}
+    for text, color in cards:
+        by_color[color].append(text.encode('utf-8'))
+    texts = by_color['white'] + by_color['black']
+
+    index = []
+    offset = 0
+    for text in texts:
+        if len(text) > 0xffff:
+            raise ValueError("Card is too long for a pack: {0!r}".format(text))
+        index.append(ENTRY.pack(offset, len(text), text.count(BLANK)))
+        offset += len(text)
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(by_color['white']),
+                            len(by_color['black'])))
+        f.write(''.join(index))
+        for text in texts:
+            f.write(text)
+
+
+class PackFile(object):
+    """ A read only, mmap'd pack. Nothing is read until it's asked for. """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.whites, self.blacks = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("{0} is not a card pack.".format(path))
+        self.data = HEADER.size + ENTRY.size * len(self)
+
+    def __len__(self):
+        return self.whites + self.blacks
+
+    def entry(self, card):
+        if not 0 <= card < len(self):
+            raise IndexError("card id out of range")
+        return ENTRY.unpack_from(self.map, HEADER.size + ENTRY.size * card)
+
+    def text(self, card):
+        offset, length, blanks = self.entry(card)
+        start = self.data + offset
+        return self.map[start:start + length].decode('utf-8')
+
+    def blanks(self, card):
+        return self.entry(card)[2]
+
+    def ids(self, color):
+        if color == 'white':
+            return xrange(0, self.whites)
+        return xrange(self.whites, len(self))
+
+
+class PackStore(CardStore):
+    """
+    A CardStore backed by a pack. Cards added after start up (by !addcard or
+    a card sync) get ids following on from the pack's.
+
+    Pack files don't record which pack each card came from, so they're all
+    counted as base cards.
+    """
+
+    def __init__(self, pack):
+        super(PackStore, self).__init__()
+        self.pack = pack
+        for color in ('white', 'black'):
+            ids = pack.ids(color)
+            if len(ids):
+                self.ranges[(BASE, color)] = [[ids[0], ids[-1] + 1]]
+        # {(color, text): id} for the pack, only built if something looks
+        # cards up by text.
+        self.pack_lookup = None
+
+    def __len__(self):
+        return len(self.pack) + len(self.texts)
+
+    def __getitem__(self, card):
+        if card < len(self.pack):
+            return self.pack.text(card)
+        return self.texts[card - len(self.pack)]
+
+    def color(self, card):
+        if card < len(self.pack):
+            return 'white' if card < self.pack.whites else 'black'
+        return self.colors[card - len(self.pack)]
+
+    def find(self, text, color):
+        if self.pack_lookup is None:
+            self.pack_lookup = {}
+            for c in ('white', 'black'):
+                for card in self.pack.ids(c):
+                    self.pack_lookup[(c, self.pack.text(card))] = card
+        card = self.pack_lookup.get((color, text))
+        if card is None:
+            card = super(PackStore, self).find(text, color)
+        return card
+
+    def template(self, card):
+        # Packed cards are only parsed once they're drawn.
+        template = self.templates.get(card)
+        if template is None:
+            template = self.templates[card] = Template(self[card])
+        return template
+
+    def blanks(self, card):
+        if card < len(self.pack):
+            return self.pack.blanks(card)
+        return super(PackStore, self).blanks(card)
+
+    def ids(self, color):
+        ids = array('i', self.pack.ids(color))
+        ids.extend(super(PackStore, self).ids(color))
+        return ids
+
+
+def cards_from_db(url):
+    import sqlalchemy
+    from sqlalchemy import orm
+
+    session = orm.sessionmaker(sqlalchemy.create_engine(url))()
+    for desc, color in session.query(CardTable.desc, CardTable.color):
+        yield desc, color
+
+
+def cards_from_files(whites, blacks):
+    from .cah import cah as plugin
+
+    formatters = [(whites, 'white', plugin.format_white),
+                  (blacks, 'black', plugin.init_black)]
+    for path, color, formatter in formatters:
+        if not path:
+            continue
+        with open(path) as f:
+            for line in f:
+                card = formatter(line.rstrip("\r\n"))
+                if card:
+                    yield card.decode('utf-8'), color
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a card pack.")
+    parser.add_argument('--db', help="SQLAlchemy url of a db to read from")
+    parser.add_argument('--whites', help="text file of white cards")
+    parser.add_argument('--blacks', help="text file of black cards")
+    parser.add_argument('pack', help="pack file to write")
+    args = parser.parse_args()
+
+    if args.db:
+        cards = cards_from_db(args.db)
+    elif args.whites or args.blacks:
+        cards = cards_from_files(args.whites, args.blacks)
+    else:
+        parser.error("Give either --db or --whites/--blacks.")
+
+    write_pack(args.pack, cards)
+    pack = PackFile(args.pack)
+    print "Wrote {0} white and {1} black cards to {2}.".format(
+        pack.whites, pack.blacks, args.pack)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Profiling a live bot, on demand.
+
+While a profile is running, every wrapped call (commands, AFK timer
+callbacks, and setup if asked for) is run under cProfile. When the window
+is over, the stats are written out and profiling turns itself off:
+
+    <dir>/cah-<time>.pstats   for pstats, snakeviz and friends
+    <dir>/cah-<time>.txt      the top calls, by cumulative time
+    <dir>/cah-<time>-mem.txt  the top allocations, if tracemalloc is around
+
+tracemalloc only comes with Python 3.4 and later, or a patched Python 2
+with pytracemalloc installed. Without it only time is profiled.
+"""
+import cProfile
+import os
+import pstats
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class Profiler(object):
+    """
+    Runs calls under cProfile between `start` and `stop`. The profile stops
+    itself after `calls` counted calls or `seconds` seconds, whichever comes
+    first.
+    """
+
+    def __init__(self, directory, clock, top=50):
+        self.directory = directory
+        self.clock = clock
+        self.top = top
+
+        self.profile = None
+        self.remaining = None
+        self.deadline = None
+        self.tracing = False
+
+    @property
+    def running(self):
+        return self.profile is not None
+
+    def start(self, calls=None, seconds=None):
+        if self.running:
+            return False
+
+        self.profile = cProfile.Profile()
+        self.remaining = calls
+        if seconds:
+            self.deadline = self.clock.callLater(seconds, self.stop)
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        return True
+
+    def stop(self):
+        """ Write out what was profiled, returning the files written. """
+        if not self.running:
+            return []
+
+        profile, self.profile = self.profile, None
+        if self.deadline is not None and self.deadline.active():
+            self.deadline.cancel()
+        self.deadline = None
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        stamp = os.path.join(self.directory, time.strftime('cah-%Y%m%d-%H%M%S'))
+        base, n = stamp, 1
+        while os.path.exists(base + '.pstats'):
+            n += 1
+            base = '{0}.{1}'.format(stamp, n)
+        written = []
+
+        profile.dump_stats(base + '.pstats')
+        written.append(base + '.pstats')
+        with open(base + '.txt', 'w') as f:
+            if profile.stats:
+                stats = pstats.Stats(profile, stream=f)
+                stats.sort_stats('cumulative').print_stats(self.top)
+            else:
+                f.write("Nothing was called while profiling.\n")
+        written.append(base + '.txt')
+
+        if self.tracing:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            self.tracing = False
+            with open(base + '-mem.txt', 'w') as f:
+                for stat in snapshot.statistics('lineno')[:self.top]:
+                    f.write(str(stat) + '\n')
+            written.append(base + '-mem.txt')
+
+        print "Profile written to {0}".format(', '.join(written))
+        return written
+
+    def wrap(self, f, counted=True):
+        """
+        Wrap `f` to be profiled whenever a profile is running. Counted calls
+        count towards the profile's limit.
+        """
+        def profiled(*args, **kwargs):
+            profile = self.profile
+            if profile is None:
+                return f(*args, **kwargs)
+            try:
+                return profile.runcall(f, *args, **kwargs)
+            finally:
+                # The call may have stopped this profile, or started another.
+                if (counted and profile is self.profile and
+                        self.remaining is not None):
+                    self.remaining -= 1
+                    if self.remaining <= 0:
+                        self.stop()
+        return profiled
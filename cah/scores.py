@@ -0,0 +1,439 @@
+"""
+Keeping score.
+"""
+import json
+import os
+import time
+from collections import OrderedDict
+
+from sqlalchemy import func, or_
+from twisted.internet import defer, task
+
+from .leaderboard import as_unicode
+from .models import PlayerTable, SessionTable, ScoreTable
+
+
+class ScoreLedger(object):
+    """
+    Scores are kept in memory and changed there straight away. Changes are
+    written to the db in batches, through a DBPool so the reactor never waits
+    on a commit: every `interval` seconds, once `max_pending` of them have
+    built up, and when `stop` is called at shutdown. Only one batch is ever in
+    flight; anything changed meanwhile waits for the next.
+
+    Sessions get their ids from the ledger rather than the db, so a game can
+    start without waiting for an insert. Their rows go in with the next batch.
+    When several processes share the db, ids come from `ids`, an IdBlock.
+
+    Until a batch is committed, every change is also appended to a spool file.
+    The spool holds absolute scores rather than increments, so replaying it
+    after a crash is safe even if some of it already made it to the db.
+
+    When channels are split between processes, each session is fenced with
+    the term of its channel's lease. A batch only writes a session's scores
+    if no later term has written it, so a process replaying its spool, or
+    flushing after it's lost a channel, can't write over the new owner. The
+    new owner picks up the session with `adopt`, from the scores handed over
+    with the game.
+
+    A session's scores are read from the db once, then answered from memory.
+    Only the `max_sessions` most recently used sessions are kept.
+    """
+
+    def __init__(self, pool, spool, interval=30, max_pending=200,
+                 max_sessions=1000, ids=None, clock=None):
+        self.pool = pool
+        self.ids = ids
+        self.spool_path = spool
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_sessions = max_sessions
+
+        # {session: {nick: score}}, least recently used first.
+        self.sessions = OrderedDict()
+        # {session: [(nick, score)]}, best first.
+        self.ranked = {}
+        # {(session, nick): score} not yet in the db.
+        self.pending = {}
+        # {(session, nick): score} the db has, for everything pending.
+        self.stored = {}
+        # Rows for sessions not yet in the db.
+        self.new_sessions = []
+        # The batch being written, what the db had before it, and the
+        # Deferred for it.
+        self.in_flight = {}
+        self.in_flight_stored = {}
+        self.flushing = None
+        # {nick: player id}, only touched by whichever thread is flushing.
+        self.player_ids = {}
+        self.next_session = None
+        # {session: lease term} its scores are written under, if fenced,
+        # and {session: channel} for the same sessions.
+        self.terms = {}
+        self.channels = {}
+        # Fenced sessions that are over, kept until their scores are written.
+        self.closing = set()
+
+        self.spool = None
+        self.loop = task.LoopingCall(self.flush)
+        if clock is not None:
+            self.loop.clock = clock
+
+    def start(self):
+        """ Replay whatever a crash left in the spool, then start flushing. """
+        spool_dir = os.path.dirname(self.spool_path)
+        if spool_dir and not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+
+        if os.path.exists(self.spool_path):
+            with open(self.spool_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last line may be cut short by a crash.
+                        continue
+                    if isinstance(record, dict):
+                        record.setdefault('term', None)
+                        self.new_sessions.append(record)
+                    else:
+                        session, nick, score = record[:3]
+                        self.pending[(session, nick)] = score
+                        if len(record) > 3:
+                            self.terms[session] = record[3]
+        self.flush_now()
+
+        # Sessions still waiting to be written have ids too.
+        last = self.pool.run_now(
+            lambda s: s.query(func.max(SessionTable.id)).scalar())
+        waiting = [row['id'] for row in self.new_sessions]
+        self.next_session = max([last or 0] + waiting) + 1
+
+        self.spool = open(self.spool_path, 'a')
+        self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        """
+        Stop flushing and write whatever's pending. If a batch is still in
+        flight, that happens once it's done, and a Deferred is returned.
+        """
+        if self.loop.running:
+            self.loop.stop()
+        if self.flushing is not None:
+            return self.flushing.addBoth(lambda _: self.flush_now())
+        self.flush_now()
+
+    def new_session(self, channel, term=None):
+        """ Start a session for a game, returning its id. """
+        if self.ids is not None:
+            session = self.ids.next()
+        else:
+            session = self.next_session
+            self.next_session += 1
+        self.start_session(session, channel, term)
+        self.remember(session, {})
+        return session
+
+    def start_session(self, session, channel, term):
+        row = {'id': session, 'channel': channel, 'started': int(time.time()),
+               'term': term}
+        self.new_sessions.append(row)
+        self.write_spool(row)
+        if term is not None:
+            self.fence(session, channel, term)
+
+    def fence(self, session, channel, term):
+        """ Write a session's scores under a lease term from now on. """
+        self.terms[session] = term
+        self.channels[session] = channel
+        self.closing.discard(session)
+
+    def adopt(self, session, channel, scores, term):
+        """
+        Take over a session another process was running, with its scores as
+        they were handed over. They're all written again under `term`, and
+        whatever the last owner still has to write is turned away.
+        """
+        # In case the last owner never got to write the session.
+        self.start_session(session, channel, term)
+        self.ranked.pop(session, None)
+        self.remember(session, {})
+        for nick, score in scores.iteritems():
+            self.set(session, nick, score)
+            # Likely in the db already, and anyway no points given here.
+            self.stored[(session, nick)] = score
+
+    def close(self, session):
+        """ Forget a session that's over. """
+        self.sessions.pop(session, None)
+        self.ranked.pop(session, None)
+        if session in self.terms:
+            self.closing.add(session)
+
+    def load(self, session):
+        scores = self.sessions.pop(session, None)
+        if scores is None:
+            # Only sessions not used in a long while are read back, and the
+            # answer is needed now.
+            scores = dict(self.pool.run_now(read_scores, session))
+            # Scores that haven't been written yet are newer than the db's.
+            for batch in (self.in_flight, self.pending):
+                for (s, nick), score in batch.iteritems():
+                    if s == session:
+                        scores[nick] = score
+        self.remember(session, scores)
+        return scores
+
+    def remember(self, session, scores):
+        self.sessions[session] = scores
+        while len(self.sessions) > self.max_sessions:
+            old, _ = self.sessions.popitem(last=False)
+            self.ranked.pop(old, None)
+
+    def get(self, session, nick):
+        if session is None:
+            return 0
+        return self.load(session).get(as_unicode(nick), 0)
+
+    def scores(self, session):
+        """ Every (nick, score) in a session, best first. """
+        if session is None:
+            return []
+        scores = self.load(session)
+        ranked = self.ranked.get(session)
+        if ranked is None:
+            ranked = self.ranked[session] = sorted(scores.items(),
+                                                   key=lambda s: -s[1])
+        return ranked
+
+    def add(self, session, nick, points, players=()):
+        """
+        Give `nick` some points (or take them away), making sure everyone in
+        `players` has a score for the session too.
+        """
+        nick = as_unicode(nick)
+        scores = self.load(session)
+        for player in map(as_unicode, players):
+            if player not in scores:
+                self.set(session, player, 0)
+        self.set(session, nick, scores.get(nick, 0) + points)
+
+        if len(self.pending) >= self.max_pending:
+            self.flush()
+
+    def set(self, session, nick, score):
+        scores = self.load(session)
+        if (session, nick) not in self.pending:
+            self.stored[(session, nick)] = scores.get(nick, 0)
+        scores[nick] = score
+        self.ranked.pop(session, None)
+        self.pending[(session, nick)] = score
+        self.spool_score(session, nick, score)
+
+    def spool_score(self, session, nick, score):
+        term = self.terms.get(session)
+        if term is None:
+            self.write_spool([session, nick, score])
+        else:
+            self.write_spool([session, nick, score, term])
+
+    def write_spool(self, record):
+        if self.spool:
+            self.spool.write(json.dumps(record) + "\n")
+            self.spool.flush()
+
+    def unwritten(self):
+        """
+        {(channel, nick): points} given or taken here that aren't in the db
+        yet, for fenced sessions.
+        """
+        points = {}
+        for (session, nick), score in self.pending.iteritems():
+            channel = self.channels.get(session)
+            change = score - self.stored.get((session, nick), 0)
+            if channel is not None and change:
+                key = (channel, nick)
+                points[key] = points.get(key, 0) + change
+        return points
+
+    def between_batches(self, f, *args):
+        """
+        Call `f(session, ...)` in the pool once no batch is being written,
+        and hold the next one back until it's done, so every score is either
+        in the db `f` reads or still pending. Returns a Deferred.
+        """
+        done = defer.Deferred()
+
+        def run():
+            if self.flushing is not None:
+                self.flushing.addBoth(retry)
+                return
+            d = self.flushing = self.pool.run(f, *args)
+            d.addBoth(finished)
+
+        def retry(result):
+            run()
+            return result
+
+        def finished(result):
+            self.flushing = None
+            done.callback(result)
+
+        run()
+        return done
+
+    def take_batch(self):
+        pending, self.pending = self.pending, {}
+        self.in_flight_stored, self.stored = self.stored, {}
+        sessions, self.new_sessions = self.new_sessions, []
+        terms = dict((s, self.terms[s]) for s in set(s for s, nick in pending)
+                     if s in self.terms)
+        return pending, sessions, terms
+
+    def flush(self):
+        """ Write every pending change to the db, in the pool. """
+        if self.flushing is not None or not (self.pending or self.new_sessions):
+            return self.flushing
+
+        pending, sessions, terms = self.take_batch()
+        self.in_flight = pending
+        d = self.flushing = self.pool.run(self.write, pending, sessions, terms)
+        d.addCallbacks(self.written, self.failed,
+                       errbackArgs=(pending, sessions))
+        return d
+
+    def flush_now(self):
+        """ Write every pending change to the db, blocking until it's done. """
+        if not (self.pending or self.new_sessions):
+            return
+        pending, sessions, terms = self.take_batch()
+        try:
+            stale = self.pool.run_now(self.write, pending, sessions, terms)
+        except Exception as e:
+            self.failed(e, pending, sessions)
+        else:
+            self.written(stale)
+
+    def written(self, stale):
+        self.flushing = None
+        self.in_flight = {}
+        self.in_flight_stored = {}
+        for session in stale:
+            print "Session {0} has moved to another process, dropping its " \
+                  "scores here.".format(session)
+            self.close(session)
+            self.pending = dict(item for item in self.pending.iteritems()
+                                if item[0][0] != session)
+            self.stored = dict(item for item in self.stored.iteritems()
+                               if item[0][0] != session)
+        waiting = set(s for s, nick in self.pending)
+        for session in self.closing - waiting:
+            self.terms.pop(session, None)
+            self.channels.pop(session, None)
+        self.closing &= waiting
+
+        # The spool only needs what's changed since the batch was taken.
+        if self.spool:
+            self.spool.truncate(0)
+            for row in self.new_sessions:
+                self.write_spool(row)
+            for (session, nick), score in self.pending.iteritems():
+                self.spool_score(session, nick, score)
+        else:
+            open(self.spool_path, 'w').close()
+
+    def failed(self, error, pending, sessions):
+        self.flushing = None
+        self.in_flight = {}
+        # Players made in the failed transaction are gone again.
+        self.player_ids.clear()
+        # Keep anything changed since, and try again next time.
+        print "Couldn't write scores, will retry: {0}".format(
+            getattr(error, 'value', error))
+        pending.update(self.pending)
+        self.pending = pending
+        # What the db has is still from before the batch.
+        self.in_flight_stored.update(
+            (key, score) for key, score in self.stored.iteritems()
+            if key not in self.in_flight_stored)
+        self.stored, self.in_flight_stored = self.in_flight_stored, {}
+        self.new_sessions = sessions + self.new_sessions
+
+    def get_player_ids(self, session, nicks):
+        """ Look up, or make, the player ids for some nicks in bulk. """
+        missing = [n for n in set(nicks) if n not in self.player_ids]
+
+        for i in xrange(0, len(missing), 500):
+            query = (session.query(PlayerTable.nick, PlayerTable.id)
+                     .filter(PlayerTable.nick.in_(missing[i:i + 500])))
+            self.player_ids.update(query)
+
+        new = [n for n in missing if n not in self.player_ids]
+        if new:
+            session.execute(PlayerTable.__table__.insert(),
+                            [{'nick': n} for n in new])
+            for i in xrange(0, len(new), 500):
+                query = (session.query(PlayerTable.nick, PlayerTable.id)
+                         .filter(PlayerTable.nick.in_(new[i:i + 500])))
+                self.player_ids.update(query)
+
+        return self.player_ids
+
+    def write(self, session, pending, sessions, terms):
+        """
+        Upsert a batch in one transaction. The pool commits it. Returns the
+        sessions whose scores were turned away, as a later term has them.
+        """
+        if sessions:
+            # After a crash, the spool can replay sessions already written.
+            ids = [row['id'] for row in sessions]
+            known = set()
+            for i in xrange(0, len(ids), 500):
+                query = (session.query(SessionTable.id)
+                         .filter(SessionTable.id.in_(ids[i:i + 500])))
+                known.update(id for id, in query)
+            sessions = [row for row in sessions if row['id'] not in known]
+            if sessions:
+                session.execute(SessionTable.__table__.insert(), sessions)
+
+        stale = set()
+        for s, term in terms.iteritems():
+            fenced = (session.query(SessionTable)
+                      .filter(SessionTable.id == s,
+                              or_(SessionTable.term.is_(None),
+                                  SessionTable.term <= term))
+                      .update({'term': term}, synchronize_session=False))
+            if not fenced:
+                stale.add(s)
+        if stale:
+            pending = dict(item for item in pending.iteritems()
+                           if item[0][0] not in stale)
+
+        ids = self.get_player_ids(session, (nick for s, nick in pending))
+        session_ids = list(set(s for s, nick in pending))
+        rows = {}
+        for i in xrange(0, len(session_ids), 500):
+            query = (session.query(ScoreTable)
+                     .filter(ScoreTable.session_id.in_(
+                         session_ids[i:i + 500])))
+            for row in query:
+                rows[(row.session_id, row.player_id)] = row
+
+        new = []
+        for (s, nick), score in pending.items():
+            row = rows.get((s, ids[nick]))
+            if row is None:
+                new.append({'session_id': s, 'player_id': ids[nick],
+                            'score': score})
+            else:
+                row.score = score
+        if new:
+            session.execute(ScoreTable.__table__.insert(), new)
+        return stale
+
+
+def read_scores(session, id):
+    query = (session.query(PlayerTable.nick, ScoreTable.score)
+             .join(ScoreTable, ScoreTable.player_id == PlayerTable.id)
+             .filter(ScoreTable.session_id == id))
+    return query.all()
@@ -0,0 +1,167 @@
+"""
+Finding cards by their words, and spotting duplicates.
+"""
+import hashlib
+import re
+import struct
+
+from twisted.internet import defer
+
+
+# IRC colour, bold, underline, reverse and reset codes.
+FORMATTING = re.compile(u'\x03(?:\\d{1,2}(?:,\\d{1,2})?)?|[\x02\x0f\x16\x1d\x1f]')
+BLANKS = re.compile(u'_+')
+PUNCTUATION = re.compile(u'[^\\w\\s]', re.UNICODE)
+WORD = re.compile(u'[^\\W_]+', re.UNICODE)
+
+
+def normalize(text):
+    """
+    A card's text with formatting, punctuation, case and spacing taken out,
+    so cards that only differ by those compare equal.
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    text = FORMATTING.sub(u'', text)
+    text = BLANKS.sub(u' _ ', text)
+    text = PUNCTUATION.sub(u'', text.lower())
+    return u' '.join(text.split())
+
+
+def words(text):
+    return WORD.findall(normalize(text))
+
+
+def digest(text):
+    """ 64 bits of a hash of a card's normalized text, to stand in for it """
+    return struct.unpack('<q', hashlib.md5(
+        normalize(text).encode('utf-8')).digest()[:8])[0]
+
+
+class CardIndex(object):
+    """
+    An inverted index from words to the ids of cards containing them, and a
+    hash of every card's normalized text. Only the words' postings and the
+    hashes are kept, never the texts.
+
+    Stores that hold every text are indexed straight away with `build`.
+    Stores that read texts from disk or the db are indexed with `build_in`,
+    reading every card in the db pool; cards added meanwhile are indexed
+    as they come. Nothing can be looked up until it's `built`.
+
+    Cards on their way into the db are reserved, so two adds of the same
+    text can't both pass the duplicate check before either is indexed.
+    """
+
+    def __init__(self, cards):
+        self.cards = cards
+        # {word: set(card ids)}
+        self.postings = {}
+        # {(color, digest of normalized text): card id}
+        self.normalized = {}
+        # {(color, digest)} reserved but not added yet.
+        self.pending = set()
+        self.built = False
+        # [Deferred] waiting on a build in the pool, or None.
+        self.waiting = None
+
+    def build(self):
+        self.postings, self.normalized = collect(None, self.cards)
+        self.built = True
+
+    def build_in(self, pool):
+        """ Index every card in `pool`, off the reactor thread. """
+        self.waiting = []
+        d = pool.run(collect, self.cards)
+        d.addCallbacks(self.collected, self.build_failed)
+        return d
+
+    def collected(self, result):
+        # Cards indexed while the build was going go on top.
+        added, self.postings = self.postings, result[0]
+        for word, cards in added.iteritems():
+            self.postings.setdefault(word, set()).update(cards)
+        added, self.normalized = self.normalized, result[1]
+        for key, card in added.iteritems():
+            self.normalized.setdefault(key, card)
+        self.built = True
+        print "Indexed {0} cards.".format(len(self.normalized))
+        self.answer()
+
+    def build_failed(self, failure):
+        print "Couldn't index the cards: {0}".format(failure.getErrorMessage())
+        self.answer()
+
+    def answer(self):
+        waiting, self.waiting = self.waiting, None
+        for d in waiting:
+            d.callback(self.built)
+
+    def when_built(self):
+        """ A Deferred firing with whether the cards got indexed. """
+        if self.waiting is None:
+            return defer.succeed(self.built)
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+    def add(self, card, text, color):
+        if self.built or self.waiting is not None:
+            self.index(card, text, color)
+
+    def index(self, card, text, color):
+        index(self.postings, self.normalized, card, text, color)
+
+    def duplicate(self, text, color):
+        """ The id of a card that's the same as `text`, or None """
+        return self.normalized.get((color, digest(text)))
+
+    def reserve(self, text, color):
+        """
+        Hold `text` for a card about to be added. False if there's already a
+        card like it, or one reserved.
+        """
+        key = (color, digest(text))
+        if key in self.pending or key in self.normalized:
+            return False
+        self.pending.add(key)
+        return True
+
+    def release(self, text, color):
+        """ Let go of a reservation, once the card's added or couldn't be """
+        self.pending.discard((color, digest(text)))
+
+    def search(self, terms):
+        """ The ids of every card containing all the words in `terms` """
+        terms = set(words(terms))
+        if not terms:
+            return []
+
+        # Intersect starting from the rarest word, so it stays small.
+        postings = sorted((self.postings.get(t, set()) for t in terms),
+                          key=len)
+        found = set(postings[0])
+        for ids in postings[1:]:
+            found &= ids
+            if not found:
+                break
+        return sorted(found)
+
+
+def index(postings, normalized, card, text, color):
+    normalized.setdefault((color, digest(text)), card)
+    for word in set(words(text)):
+        postings.setdefault(word, set()).add(card)
+
+
+def collect(session, cards):
+    """
+    (postings, normalized) for every card in `cards`, reading the db with
+    `session` if it's given.
+    """
+    postings = {}
+    normalized = {}
+    for color in ('white', 'black'):
+        for card, text in cards.each(color, session):
+            index(postings, normalized, card, text, color)
+    return postings, normalized
@@ -0,0 +1,319 @@
+"""
+Splitting channels between several bot processes sharing one db.
+"""
+import time
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from twisted.internet import defer, task
+
+from .models import LeaseTable, CounterTable
+
+
+class Leases(object):
+    """
+    Each channel's game is run by whichever process holds its lease, a row in
+    cah_leases naming the owner and when the lease runs out. Every process
+    sees every message, and ignores channels it doesn't hold.
+
+    A process claims a channel the first time it hears from it, unless
+    another process is known to hold it. Messages that arrive while a claim
+    is in flight wait for it, and are handled if it succeeds. Leases last
+    `ttl` seconds and are renewed every third of that, along with the state
+    of every game that's changed since the last renewal (`states` returns
+    {channel: json}). The renewal also reads back every lease, so a process
+    finds out when it's lost a channel, and takes over the channels it's
+    heard from whose owner has stopped renewing.
+
+    A lease's term goes up every time it changes hands, and `terms` has the
+    term each owned channel is held under. Anything written on a channel's
+    behalf can be fenced with it, so a process that's lost the channel and
+    doesn't know yet can't write over its new owner.
+
+    `claimed(channel, previous owner, game json)` is called whenever a lease
+    is taken, and `lost(channel)` whenever one is lost. `stop` saves every
+    game and gives up every lease, so other processes can take over straight
+    away rather than once the leases run out.
+
+    Leases go by each host's clock, so the hosts need to agree on the time to
+    well within `ttl`.
+    """
+
+    def __init__(self, pool, owner, ttl=30, states=dict, claimed=None,
+                 lost=None, clock=None):
+        self.pool = pool
+        self.owner = owner
+        self.ttl = ttl
+        self.states = states
+        self.claimed = claimed
+        self.lost = lost
+
+        # Channels this process runs.
+        self.owned = set()
+        # {channel: (owner, expires)} held by others, as of the last renewal.
+        self.held = {}
+        # Every channel heard from, to take over if its owner goes away.
+        self.wanted = set()
+        # {channel: [Deferred]} waiting on a claim in flight.
+        self.claiming = {}
+        # {channel: json} of each owned game as it was last saved.
+        self.saved = {}
+        # {channel: term} of each owned lease.
+        self.terms = {}
+        self.renewing = None
+
+        self.loop = task.LoopingCall(self.renew)
+        if clock is not None:
+            self.loop.clock = clock
+
+    def start(self):
+        self.loop.start(self.ttl / 3.0, now=False)
+
+    def stop(self):
+        """
+        Save every game and give up every lease. If a renewal is in flight,
+        that happens once it's done, and a Deferred is returned.
+        """
+        if self.loop.running:
+            self.loop.stop()
+        if self.renewing is not None:
+            return self.renewing.addBoth(lambda _: self.release())
+        self.release()
+
+    def release(self):
+        if not self.owned:
+            return
+        try:
+            self.pool.run_now(renew, self.owner, list(self.owned),
+                              self.changed_states(), 0)
+        except Exception as e:
+            print "Couldn't give up leases: {0}".format(e)
+        self.owned.clear()
+        self.terms.clear()
+
+    def claim_now(self, channel):
+        """ Try to take a channel, blocking until it's done. Only for start up. """
+        self.wanted.add(channel)
+        return self.took(channel, self.pool.run_now(
+            claim, channel, self.owner, time.time(), self.ttl))
+
+    def claim(self, channel):
+        """ Try to take a channel, returning a Deferred firing with whether it was. """
+        self.wanted.add(channel)
+        if channel in self.owned:
+            return defer.succeed(True)
+        held = self.held.get(channel)
+        if held is not None and held[1] >= time.time():
+            return defer.succeed(False)
+
+        d = defer.Deferred()
+        waiting = self.claiming.get(channel)
+        if waiting is not None:
+            waiting.append(d)
+            return d
+
+        # Waiting before the claim goes out, as it can be answered at once.
+        self.claiming[channel] = [d]
+        claimed = self.pool.run(claim, channel, self.owner, time.time(),
+                                self.ttl)
+        claimed.addCallback(lambda row: self.took(channel, row))
+        claimed.addErrback(self.claim_failed, channel)
+        claimed.addCallback(self.answer, channel)
+        return d
+
+    def took(self, channel, row):
+        got, owner, expires, game, term = row
+        if not got:
+            self.held[channel] = (owner, expires)
+            return False
+        self.held.pop(channel, None)
+        self.owned.add(channel)
+        self.saved[channel] = game
+        self.terms[channel] = term
+        if self.claimed is not None:
+            self.claimed(channel, owner, game)
+        return True
+
+    def claim_failed(self, failure, channel):
+        print "Couldn't claim {0}: {1}".format(channel, failure.value)
+        return False
+
+    def answer(self, got, channel):
+        for d in self.claiming.pop(channel, []):
+            d.callback(got)
+
+    def changed_states(self):
+        """ {channel: json} for every owned game that's changed since it was saved """
+        latest = self.states()
+        return dict((channel, latest.get(channel)) for channel in self.owned
+                    if latest.get(channel) != self.saved.get(channel))
+
+    def renew(self):
+        """ Renew every lease held, in the pool. """
+        if self.renewing is not None:
+            return self.renewing
+
+        channels = list(self.owned)
+        states = self.changed_states()
+        d = self.renewing = self.pool.run(renew, self.owner, channels, states,
+                                          time.time() + self.ttl)
+        d.addCallbacks(self.renewed, self.failed,
+                       callbackArgs=(channels, states))
+        return d
+
+    def renewed(self, leases, channels, states):
+        self.renewing = None
+        self.saved.update(states)
+
+        mine = set()
+        self.held = {}
+        for channel, owner, expires in leases:
+            if owner == self.owner:
+                mine.add(channel)
+            else:
+                self.held[channel] = (owner, expires)
+
+        for channel in set(channels) - mine:
+            self.owned.discard(channel)
+            self.saved.pop(channel, None)
+            self.terms.pop(channel, None)
+            if self.lost is not None:
+                self.lost(channel)
+
+        # Take over wherever the owner has stopped renewing.
+        now = time.time()
+        for channel in self.wanted - self.owned:
+            held = self.held.get(channel)
+            if held is None or held[1] < now:
+                self.claim(channel)
+
+    def failed(self, error, channels, states):
+        self.renewing = None
+        print "Couldn't renew leases, will retry: {0}".format(
+            getattr(error, 'value', error))
+
+
+class IdBlock(object):
+    """
+    Ids for a table's rows, from blocks of `size` reserved in cah_counters,
+    so several processes can make up ids for the same table without
+    colliding. Only reserving a block touches the db.
+
+    Once half of a block's used, the next is reserved in the pool, so it's
+    there by the time it's needed. Only the first block, or one needed
+    before its reservation's come back, is reserved on the spot.
+    """
+
+    def __init__(self, pool, column, size=100):
+        self.pool = pool
+        self.column = column
+        self.size = size
+        self.next_id = self.stop = 0
+        # The first id of the block reserved ahead, once it's come back.
+        self.spare = None
+        self.reserving = False
+
+    def next(self):
+        if self.next_id >= self.stop:
+            if self.spare is not None:
+                self.next_id, self.spare = self.spare, None
+            else:
+                self.next_id = self.pool.run_now(reserve, self.column,
+                                                 self.size)
+            self.stop = self.next_id + self.size
+        id = self.next_id
+        self.next_id += 1
+        if (self.stop - self.next_id <= self.size // 2 and
+                self.spare is None and not self.reserving):
+            self.reserve_ahead()
+        return id
+
+    def reserve_ahead(self):
+        self.reserving = True
+        d = self.pool.run(reserve, self.column, self.size)
+        d.addCallbacks(self.reserved, self.reserve_failed)
+
+    def reserved(self, first):
+        self.reserving = False
+        self.spare = first
+
+    def reserve_failed(self, failure):
+        # The next block's reserved on the spot instead.
+        self.reserving = False
+        print "Couldn't reserve {0} ids: {1}".format(
+            self.column.table.name, failure.value)
+
+
+def claim(session, channel, owner, now, ttl):
+    """
+    Take a channel's lease if it's free, expired or already ours. Returns
+    (whether it was taken, owner, expires, game) as the row was before, and
+    the lease's term if it was taken.
+    """
+    lease = session.query(LeaseTable).filter_by(channel=channel).first()
+    if lease is None:
+        session.add(LeaseTable(channel, owner, now + ttl))
+        try:
+            session.flush()
+        except IntegrityError:
+            # Someone else got there first.
+            session.rollback()
+            return False, None, 0, None, None
+        return True, None, 0, None, 1
+
+    row = lease.owner, lease.expires, lease.game
+    if lease.owner != owner and lease.expires >= now:
+        return (False,) + row + (None,)
+    term = lease.term or 0
+    if lease.owner != owner:
+        term += 1
+    # Only if nobody's taken it since it was read.
+    taken = (session.query(LeaseTable)
+             .filter_by(channel=channel, owner=lease.owner,
+                        expires=lease.expires)
+             .update({'owner': owner, 'expires': now + ttl, 'term': term},
+                     synchronize_session=False))
+    return (bool(taken),) + row + (term if taken else None,)
+
+
+def renew(session, owner, channels, states, expires):
+    """
+    Move the leases on `channels` that are still ours to `expires`, saving
+    the games in `states` with them, and return every lease there is as
+    (channel, owner, expires).
+    """
+    for i in xrange(0, len(channels), 500):
+        (session.query(LeaseTable)
+         .filter(LeaseTable.owner == owner,
+                 LeaseTable.channel.in_(channels[i:i + 500]))
+         .update({'expires': expires}, synchronize_session=False))
+    for channel, game in states.iteritems():
+        (session.query(LeaseTable)
+         .filter_by(channel=channel, owner=owner)
+         .update({'game': game}, synchronize_session=False))
+    return session.query(LeaseTable.channel, LeaseTable.owner,
+                         LeaseTable.expires).all()
+
+
+def reserve(session, column, size):
+    """ Reserve `size` ids for the table `column` is the primary key of. """
+    name = column.table.name
+    while True:
+        # Never behind the table, even if rows were made without the counter.
+        first = (session.query(func.max(column)).scalar() or 0) + 1
+        counter = session.query(CounterTable.next).filter_by(name=name).scalar()
+        if counter is None:
+            session.add(CounterTable(name, first + size))
+            try:
+                session.flush()
+            except IntegrityError:
+                session.rollback()
+                continue
+            return first
+
+        first = max(first, counter)
+        taken = (session.query(CounterTable)
+                 .filter_by(name=name, next=counter)
+                 .update({'next': first + size}, synchronize_session=False))
+        if taken:
+            return first
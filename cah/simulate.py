@@ -0,0 +1,317 @@
+"""
+Soak testing with scripted players.
+
+The plugin is set up as in cah.bench, with a fake bot, an in-memory db and a
+virtual clock, and left to scripted players in every channel. Each tick they
+join, play (mostly sensible cards, sometimes nonsense), pick winners, vote to
+kick each other, redraw, leave and go AFK long enough to be kicked, and then
+the clock jumps forward so the AFK timers fire. Hours of play take minutes.
+
+After every command and tick each game is checked against the invariants of
+the state machine: no card lost or duplicated, nobody both queued and
+playing, rounds always having a dealer, a prompt and a running AFK timer,
+and so on. Exceptions out of commands or timers are caught and counted.
+Memory is sampled as it goes, to show up leaks.
+
+    python -m cah.simulate --channels 4 --players 8 --hours 24
+
+It exits non-zero if any invariant was broken or anything raised.
+"""
+import argparse
+import gc
+import os
+import random
+import resource
+import sys
+import time
+import traceback
+from collections import OrderedDict
+
+from .bench import Bench, Timings, quiet
+
+
+# Errors are put down to the last line of the plugin they went through.
+PACKAGE = os.path.dirname(os.path.abspath(__file__))
+HARNESS = ('simulate.py', 'bench.py')
+
+def current_memory():
+    """ Resident memory of the process right now, in MB. """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / (1024.0 * 1024)
+    except IOError:
+        # Only the peak is available elsewhere.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class Counts(Timings):
+    """ Counts calls, without keeping every time, which would look a leak """
+
+    def add(self, name, seconds):
+        self.times[name] = self.times.get(name, 0) + 1
+
+
+class Player(object):
+    """ A scripted player, with a rough idea of how often to do what """
+
+    def __init__(self, nick, channel):
+        self.nick = nick
+        self.channel = channel
+        self.afk_until = 0
+
+    def act(self, sim, game, now):
+        """ The command this player says this tick, or None """
+        if self.afk_until > now:
+            return None
+        roll = random.random()
+        nick = self.nick
+
+        if nick not in game.players:
+            if nick not in game.player_queue and roll < 0.3:
+                return 'join'
+            return None
+
+        if roll < 0.003:
+            return 'leave'
+        if roll < 0.01:
+            # Long enough to be reminded, and then kicked.
+            self.afk_until = now + random.uniform(30, 400)
+            return None
+        if roll < 0.015:
+            target = random.choice(game.players.keys() + ['nobody'])
+            return 'kick ' + target
+        if roll < 0.03:
+            return 'redraw {0}'.format(random.randint(1, 8))
+        if roll < 0.04:
+            return random.choice(['hand', 'mystatus', 'gamestatus',
+                                  'players', 'poke ' + game.dealer])
+
+        if game.state == 'play' and nick != game.dealer:
+            if nick in game.answers and roll > 0.05:
+                return None
+            return 'play ' + self.cards(game)
+        if game.state == 'winner' and nick == game.dealer:
+            if roll < 0.1:
+                return random.choice(['winner 0', 'winner 99', 'winner x'])
+            return 'winner {0}'.format(random.randint(1, len(game.shown)))
+        return None
+
+    def cards(self, game):
+        blanks = game.blanks()
+        hand = len(game.players[self.nick])
+        roll = random.random()
+        if roll < 0.05:
+            return 'random'
+        if roll < 0.1:
+            # The wrong number of cards, or cards they don't have.
+            count = random.choice([max(blanks - 1, 1), blanks + 1])
+            return ' '.join(str(random.randint(0, hand + 2))
+                            for _ in xrange(count))
+        return ' '.join(str(i) for i in
+                        random.sample(xrange(1, hand + 1), min(blanks, hand)))
+
+
+def invariants(game, whites, blacks):
+    """ Everything wrong with a game's state, as a list of descriptions """
+    problems = []
+    plugin = game.plugin
+
+    held = [c for hand in game.players.itervalues() for c in hand]
+    held.extend(c for hand in game.answers.itervalues() for c in hand)
+    white = list(game.whites) + list(game.whites.discards) + held
+    if len(white) != whites:
+        problems.append("white cards lost or made up")
+    elif len(set(white)) != whites:
+        problems.append("white card held twice")
+
+    black = list(game.blacks) + list(game.blacks.discards)
+    if game.prompt is not None:
+        black.append(game.prompt)
+    if len(black) != blacks or len(set(black)) != blacks:
+        problems.append("black cards lost, made up or held twice")
+
+    if any(len(hand) > plugin.NUM_CARDS
+           for hand in game.players.itervalues()):
+        problems.append("hand bigger than NUM_CARDS")
+    if set(game.player_queue) & set(game.players):
+        problems.append("player both queued and playing")
+
+    if game.state in ('play', 'winner'):
+        if game.dealer not in game.players:
+            problems.append("round dealt by someone not playing")
+        if game.prompt is None:
+            problems.append("round with no prompt")
+        if len(game.players) < 3:
+            problems.append("round going with fewer than 3 players")
+        if not set(game.avail_players) <= set(game.players):
+            problems.append("round waiting on someone not playing")
+        if not set(game.answers) <= set(game.avail_players):
+            problems.append("answer from someone not in the round")
+        if not len(game.timers):
+            problems.append("round with no AFK timer")
+    if game.state == 'winner' and len(game.answers) != len(game.avail_players):
+        problems.append("picking a winner before everyone played")
+    if game.state == 'join' and len(game.timers):
+        problems.append("AFK timer left running between rounds")
+    return problems
+
+
+def in_plugin(path):
+    """ Whether `path` is the plugin's code, rather than this harness's """
+    path = os.path.abspath(path)
+    return (os.path.dirname(path) == PACKAGE and
+            os.path.basename(path) not in HARNESS)
+
+
+class Simulation(object):
+    def __init__(self, channels, players, cards, seed=None):
+        self.bench = Bench(0, cards, max(cards // 5, 1), channels, Counts(),
+                           seed)
+        self.plugin = self.bench.plugin
+        self.reactor = self.bench.reactor
+        self.whites = len(self.plugin.cards.ids('white'))
+        self.blacks = len(self.plugin.cards.ids('black'))
+
+        self.players = [Player('p{0}_{1}'.format(c, n), channel)
+                        for c, channel in enumerate(self.bench.channels)
+                        for n in xrange(players)]
+        self.rounds = 0
+        self.commands = 0
+        # {description: [count, first seen at]}
+        self.problems = OrderedDict()
+        self.errors = OrderedDict()
+        self.samples = []
+
+    def close(self):
+        self.bench.close()
+
+    def problem(self, table, what, now):
+        seen = table.get(what)
+        if seen is None:
+            table[what] = [1, now]
+        else:
+            seen[0] += 1
+
+    def error(self, now):
+        # Where in the plugin it went wrong is what tells errors apart.
+        kind, value, tb = sys.exc_info()
+        frames = [f for f in traceback.extract_tb(tb)
+                  if in_plugin(f[0])] or traceback.extract_tb(tb)
+        path, line, func, text = frames[-1]
+        what = "{0}: {1} in {2} ({3}:{4})".format(
+            kind.__name__, value, func, os.path.basename(path), line)
+        self.problem(self.errors, what, now)
+
+    def check(self, game, now):
+        for what in invariants(game, self.whites, self.blacks):
+            self.problem(self.problems, what, now)
+
+    def tick(self, now):
+        random.shuffle(self.players)
+        for player in self.players:
+            game = self.plugin.get_game({'pm': False,
+                                         'channel': player.channel})
+            message = player.act(self, game, now)
+            if message is None:
+                continue
+
+            picking = game.state == 'winner' and message.startswith('winner')
+            self.commands += 1
+            try:
+                self.bench.say(player.nick, message, player.channel)
+            except Exception:
+                self.error(now)
+            if picking and game.state != 'winner':
+                self.rounds += 1
+            self.check(game, now)
+
+    def advance(self, seconds, now):
+        try:
+            self.reactor.advance(seconds)
+        except Exception:
+            self.error(now)
+        for game in self.plugin.games.values():
+            self.check(game, now)
+
+    def sample(self, now, started):
+        gc.collect()
+        self.samples.append((now, time.time() - started, self.rounds,
+                             current_memory(), len(gc.get_objects())))
+
+    def run(self, seconds, step, every):
+        started = time.time()
+        now = 0
+        self.sample(now, started)
+        while now < seconds:
+            self.tick(now)
+            self.advance(step, now)
+            now += step
+            if now % every < step:
+                self.sample(now, started)
+        return time.time() - started
+
+
+def hours(seconds):
+    return "{0:.1f}h".format(seconds / 3600.0)
+
+
+def report(sim, simulated, elapsed):
+    print "Simulated {0} in {1:.1f}s: {2} rounds, {3} commands, " \
+          "{4:.1f} rounds/s.".format(hours(simulated), elapsed, sim.rounds,
+                                     sim.commands, sim.rounds / elapsed)
+
+    print
+    print "{0:>8} {1:>9} {2:>8} {3:>9} {4:>10}".format(
+        'sim', 'wall', 'rounds', 'rss MB', 'objects')
+    for now, wall, rounds, rss, objects in sim.samples:
+        print "{0:>8} {1:>8.1f}s {2:>8} {3:>9.1f} {4:>10}".format(
+            hours(now), wall, rounds, rss, objects)
+    first, last = sim.samples[0], sim.samples[-1]
+    print "Growth: {0:+.1f} MB, {1:+d} objects.".format(last[3] - first[3],
+                                                       last[4] - first[4])
+
+    for title, table in (("Broken invariants", sim.problems),
+                         ("Errors", sim.errors)):
+        print
+        if not table:
+            print "{0}: none.".format(title)
+            continue
+        print "{0}:".format(title)
+        for what, (count, when) in table.iteritems():
+            print "  {0}x {1} (first at {2})".format(count, what, hours(when))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Soak test the plugin with scripted players.")
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--players', type=int, default=8,
+                        help="scripted players in each channel")
+    parser.add_argument('--cards', type=int, default=2000,
+                        help="white cards in the deck")
+    parser.add_argument('--hours', type=float, default=6,
+                        help="how long to simulate")
+    parser.add_argument('--step', type=float, default=5,
+                        help="simulated seconds between ticks")
+    parser.add_argument('--sample', type=float, default=3600,
+                        help="simulated seconds between memory samples")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    simulated = args.hours * 3600
+    with quiet():
+        sim = Simulation(args.channels, args.players, args.cards, args.seed)
+        try:
+            elapsed = sim.run(simulated, args.step, args.sample)
+        finally:
+            sim.close()
+    report(sim, simulated, elapsed)
+
+    if sim.problems or sim.errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
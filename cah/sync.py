@@ -0,0 +1,139 @@
+"""
+Keeping the official cards in step with the published card lists.
+"""
+import hashlib
+import json
+import os
+import socket
+import urllib2
+
+from twisted.internet import threads
+
+from .deck import BASE
+from .models import CardTable
+
+
+class CardSync(object):
+    """
+    Fetches the official white and black card lists.
+
+    Fetching happens in a thread so the reactor never waits on the network.
+    Requests are conditional (ETag/Last-Modified), and every list that comes
+    back is kept in an on-disk cache, which is used instead whenever the
+    server can't be reached.
+    """
+
+    lists = {
+        'white': 'whites.txt',
+        'black': 'blacks.txt',
+    }
+
+    def __init__(self, url, cache_dir, timeout=30):
+        self.url = url
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+
+    def fetch(self):
+        """
+        Returns a Deferred that fires with {color: (lines, digest)} for every
+        list that differs from the last one applied with `applied()`.
+        """
+        return threads.deferToThread(self.fetch_all)
+
+    def fetch_all(self):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        changed = {}
+        for color, name in self.lists.items():
+            body = self.fetch_list(name)
+            if body is None:
+                continue
+
+            digest = hashlib.sha1(body).hexdigest()
+            if digest != self.load_meta(name).get('applied'):
+                changed[color] = (body.split("\n"), digest)
+        return changed
+
+    def fetch_list(self, name):
+        """
+        Get the body of a card list, from the server if it has changed and
+        from the cache otherwise. Returns None if neither has it.
+        """
+        meta = self.load_meta(name)
+        request = urllib2.Request(self.url + name)
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last-modified'):
+            request.add_header('If-Modified-Since', meta['last-modified'])
+
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+            body = response.read()
+        except urllib2.HTTPError as e:
+            if e.code != 304:
+                print "Couldn't fetch {0} ({1}), using cache.".format(name, e)
+            return self.read_cache(name)
+        except (urllib2.URLError, socket.error) as e:
+            print "Couldn't fetch {0} ({1}), using cache.".format(name, e)
+            return self.read_cache(name)
+
+        meta['etag'] = response.info().getheader('ETag')
+        meta['last-modified'] = response.info().getheader('Last-Modified')
+        self.write_file(name, body)
+        self.save_meta(name, meta)
+        return body
+
+    def applied(self, color, digest):
+        """ Record that a list has made it into the database. """
+        name = self.lists[color]
+        meta = self.load_meta(name)
+        meta['applied'] = digest
+        self.save_meta(name, meta)
+
+    def read_cache(self, name):
+        try:
+            with open(os.path.join(self.cache_dir, name), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def load_meta(self, name):
+        try:
+            with open(os.path.join(self.cache_dir, name + '.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save_meta(self, name, meta):
+        self.write_file(name + '.json', json.dumps(meta))
+
+    def write_file(self, name, data):
+        # Write then rename, so a crash never leaves a half written cache.
+        path = os.path.join(self.cache_dir, name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(path + '.tmp', path)
+
+
+def write_changes(session, color, fetched):
+    """
+    Make the official cards of one color in the db match `fetched`, a set of
+    card texts. Returns ([texts added], number removed). Doesn't commit.
+    """
+    existing = dict(session.query(CardTable.desc, CardTable.id)
+                    .filter_by(color=color, official=True))
+
+    removed = [existing[desc] for desc in existing if desc not in fetched]
+    added = [desc for desc in fetched if desc not in existing]
+
+    # Chunked to stay under SQLite's limit on bound parameters.
+    for i in xrange(0, len(removed), 500):
+        (session.query(CardTable)
+            .filter(CardTable.id.in_(removed[i:i + 500]))
+            .delete(synchronize_session=False))
+    if added:
+        session.execute(CardTable.__table__.insert(),
+                        [{'desc': desc, 'color': color, 'official': True,
+                          'pack': BASE} for desc in added])
+    return added, len(removed)
@@ -0,0 +1,61 @@
+"""
+Timers for games.
+"""
+import math
+
+
+class TimerWheel(object):
+    """
+    A game's deadlines, bucketed into slots `resolution` seconds wide.
+
+    However many deadlines are pending, the wheel only ever has one delayed
+    call in the reactor: the one for its earliest slot. Everything can be
+    cancelled at once, in O(1), when a round ends.
+    """
+
+    __slots__ = ('clock', 'resolution', 'slots', 'call')
+
+    def __init__(self, clock, resolution=1.0):
+        self.clock = clock
+        self.resolution = resolution
+        self.slots = {}
+        self.call = None
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots.itervalues())
+
+    def schedule(self, delay, f, *args, **kwargs):
+        when = self.clock.seconds() + delay
+        slot = int(math.ceil(when / self.resolution))
+        self.slots.setdefault(slot, []).append((f, args, kwargs))
+        self.arm()
+
+    def cancel_all(self):
+        self.slots = {}
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def arm(self):
+        if not self.slots:
+            return
+
+        when = min(self.slots) * self.resolution
+        if self.call is not None and self.call.active():
+            if self.call.getTime() <= when:
+                return
+            self.call.cancel()
+
+        delay = max(0, when - self.clock.seconds())
+        self.call = self.clock.callLater(delay, self.run)
+
+    def run(self):
+        self.call = None
+        now = self.clock.seconds()
+        for slot in sorted(self.slots):
+            if slot * self.resolution > now:
+                break
+            # A callback may cancel everything, so look the slot up each time.
+            for f, args, kwargs in self.slots.pop(slot, ()):
+                f(*args, **kwargs)
+        self.arm()
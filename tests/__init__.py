@@ -0,0 +1,26 @@
+"""
+Tests, run with Twisted's trial from the top of the repo:
+
+    PYTHONPATH=. trial tests
+"""
+from collections import namedtuple
+
+import sqlalchemy
+from sqlalchemy import orm
+from twisted.internet import task
+
+from cah.dbpool import DBPool
+from cah.models import SQLAlchemyBase
+
+
+DB = namedtuple('DB', 'engine session')
+
+
+def make_pool():
+    """
+    A DBPool over a fresh in-memory SQLite db, which does its work straight
+    away on the calling thread.
+    """
+    engine = sqlalchemy.create_engine('sqlite://')
+    SQLAlchemyBase.metadata.create_all(engine)
+    return DBPool(DB(engine, orm.sessionmaker(bind=engine)()), task.Clock())
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from cah.models import PlayerTable, SessionTable, ScoreTable
+from cah.scores import ScoreLedger
+from tests import make_pool
+
+
+class LedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = make_pool()
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def ledger(self, name='a'):
+        # Nothing's written until it's flushed, as the clock never moves.
+        ledger = ScoreLedger(self.pool, os.path.join(self.dir, name),
+                             clock=task.Clock())
+        ledger.start()
+        return ledger
+
+    def crash(self, ledger):
+        ledger.loop.stop()
+        ledger.spool.close()
+
+    def stored(self):
+        """ {(session, nick): score} in the db """
+        query = lambda s: (s.query(ScoreTable.session_id, PlayerTable.nick,
+                                   ScoreTable.score)
+                           .join(PlayerTable,
+                                 PlayerTable.id == ScoreTable.player_id)
+                           .all())
+        return dict(((session, nick), score)
+                    for session, nick, score in self.pool.run_now(query))
+
+    def test_flush(self):
+        ledger = self.ledger()
+        session = ledger.new_session('#a')
+        ledger.add(session, 'al', 1, ['al', 'bo'])
+        ledger.add(session, 'al', 1)
+        self.assertEqual(self.stored(), {})
+        ledger.flush()
+        self.assertEqual(self.stored(),
+                         {(session, u'al'): 2, (session, u'bo'): 0})
+        self.assertEqual(ledger.pending, {})
+        self.assertEqual(os.path.getsize(ledger.spool_path), 0)
+
+    def test_replay(self):
+        ledger = self.ledger()
+        session = ledger.new_session('#a')
+        ledger.add(session, 'al', 1)
+        self.crash(ledger)
+
+        self.ledger()
+        self.assertEqual(self.stored(), {(session, u'al'): 1})
+        sessions = self.pool.run_now(
+            lambda s: s.query(SessionTable.id, SessionTable.channel).all())
+        self.assertEqual(sessions, [(session, u'#a')])
+
+    def test_failover(self):
+        # A gives al a point, and the game is saved with the scores so far.
+        a = self.ledger('a')
+        session = a.new_session('#a', term=1)
+        a.add(session, 'al', 1, ['al', 'bo'])
+        handed_over = dict(a.scores(session))
+        self.crash(a)
+
+        # B takes the channel over, and gives bo two points.
+        b = self.ledger('b')
+        b.adopt(session, '#a', handed_over, 2)
+        b.add(session, 'bo', 2)
+        b.flush()
+        expected = {(session, u'al'): 1, (session, u'bo'): 2}
+        self.assertEqual(self.stored(), expected)
+
+        # A comes back, and can't write its spool over what B wrote.
+        a = self.ledger('a')
+        self.assertEqual(self.stored(), expected)
+        self.assertEqual(a.pending, {})
+
+    def test_lost_channel(self):
+        a = self.ledger('a')
+        session = a.new_session('#a', term=1)
+        a.add(session, 'al', 1)
+        a.flush()
+
+        b = self.ledger('b')
+        b.adopt(session, '#a', dict(a.scores(session)), 2)
+        b.add(session, 'bo', 1)
+        b.flush()
+
+        # A hasn't heard it's lost the channel yet.
+        a.add(session, 'al', 5)
+        a.flush()
+        self.assertEqual(self.stored(),
+                         {(session, u'al'): 1, (session, u'bo'): 1})
+        self.assertNotIn(session, a.sessions)
+
+    def test_unwritten(self):
+        ledger = self.ledger()
+        session = ledger.new_session('#a', term=1)
+        ledger.add(session, 'al', 2)
+        ledger.flush()
+        ledger.add(session, 'al', 1)
+        ledger.add(session, 'bo', -1)
+        self.assertEqual(ledger.unwritten(),
+                         {('#a', u'al'): 1, ('#a', u'bo'): -1})
+
+    def test_between_batches(self):
+        ledger = self.ledger()
+
+        # A batch in flight, which clears `flushing` once it's written.
+        batch = defer.Deferred()
+        batch.addBoth(lambda _: setattr(ledger, 'flushing', None))
+        ledger.flushing = batch
+        read = []
+        ledger.between_batches(lambda s: 'read').addCallback(read.append)
+        self.assertEqual(read, [])
+
+        batch.callback(None)
+        self.assertEqual(read, ['read'])
+        self.assertEqual(ledger.flushing, None)
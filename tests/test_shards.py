@@ -0,0 +1,146 @@
+import time
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from cah import shards
+from cah.models import LeaseTable, SessionTable
+from tests import make_pool
+
+
+class ClaimTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = make_pool()
+
+    def claim(self, channel, owner, now, ttl=30):
+        return self.pool.run_now(shards.claim, channel, owner, now, ttl)
+
+    def test_free(self):
+        self.assertEqual(self.claim('#a', 'A', 100), (True, None, 0, None, 1))
+
+    def test_held(self):
+        self.claim('#a', 'A', 100)
+        self.assertEqual(self.claim('#a', 'B', 110),
+                         (False, 'A', 130, None, None))
+
+    def test_expired(self):
+        self.claim('#a', 'A', 100)
+        got, owner, expires, game, term = self.claim('#a', 'B', 131)
+        self.assertTrue(got)
+        self.assertEqual((owner, expires, term), ('A', 130, 2))
+
+    def test_own(self):
+        # Picking up a lease of its own, say after a restart, keeps the term.
+        self.claim('#a', 'A', 100)
+        self.assertEqual(self.claim('#a', 'A', 140)[::4], (True, 1))
+
+    def test_renew(self):
+        self.claim('#a', 'A', 100)
+        self.claim('#b', 'B', 100)
+        leases = self.pool.run_now(shards.renew, 'A', ['#a', '#b'],
+                                   {'#a': '{}', '#b': '{}'}, 200)
+        self.assertEqual(sorted(leases), [('#a', 'A', 200), ('#b', 'B', 130)])
+        games = dict(self.pool.run_now(
+            lambda s: s.query(LeaseTable.channel, LeaseTable.game).all()))
+        # Only leases still held are renewed, or saved to.
+        self.assertEqual(games, {'#a': '{}', '#b': None})
+
+
+class LeasesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = make_pool()
+        self.clock = task.Clock()
+        self.claimed = []
+        self.lost = []
+
+    def leases(self, owner, states=dict):
+        return shards.Leases(
+            self.pool, owner, 30, states=states, clock=self.clock,
+            claimed=lambda *args: self.claimed.append((owner,) + args),
+            lost=lambda channel: self.lost.append((owner, channel)))
+
+    def test_claim(self):
+        a = self.leases('A')
+        got = []
+        a.claim('#a').addCallback(got.append)
+        # The pool answers straight away, and the claim still gets it.
+        self.assertEqual(got, [True])
+        self.assertEqual(a.owned, set(['#a']))
+        self.assertEqual(a.terms, {'#a': 1})
+        self.assertEqual(self.claimed, [('A', '#a', None, None)])
+
+    def test_held_elsewhere(self):
+        a, b = self.leases('A'), self.leases('B')
+        a.claim('#a')
+        got = []
+        b.claim('#a').addCallback(got.append)
+        self.assertEqual(got, [False])
+        self.assertEqual(b.held['#a'][0], 'A')
+
+    def test_renew_loses(self):
+        a, b = self.leases('A'), self.leases('B')
+        a.claim('#a')
+        self.expire('#a')
+        b.claim('#a')
+        a.renew()
+        self.assertEqual(a.owned, set())
+        self.assertEqual(self.lost, [('A', '#a')])
+
+    def test_takeover(self):
+        game = '{"session": 1}'
+        a = self.leases('A', states=lambda: {'#a': game})
+        b = self.leases('B')
+        a.claim('#a')
+        a.renew()
+        b.claim('#a')
+        self.assertEqual(b.owned, set())
+
+        # A stops renewing, and B takes over once it's seen the lease run out.
+        self.expire('#a')
+        b.renew()
+        self.assertEqual(b.owned, set(['#a']))
+        self.assertEqual(b.terms, {'#a': 2})
+        self.assertEqual(self.claimed[-1], ('B', '#a', 'A', game))
+
+    def test_release(self):
+        a, b = self.leases('A'), self.leases('B')
+        a.claim('#a')
+        a.stop()
+        got = []
+        b.claim('#a').addCallback(got.append)
+        self.assertEqual(got, [True])
+
+    def expire(self, channel):
+        self.pool.run_now(lambda s: s.query(LeaseTable)
+                          .filter_by(channel=channel)
+                          .update({'expires': time.time() - 1}))
+
+
+class IdBlockTest(unittest.TestCase):
+
+    def test_blocks(self):
+        pool = make_pool()
+        a = shards.IdBlock(pool, SessionTable.id, 10)
+        b = shards.IdBlock(pool, SessionTable.id, 10)
+        first = [a.next() for _ in xrange(15)]
+        second = [b.next() for _ in xrange(15)]
+        self.assertEqual(first[:10], range(1, 11))
+        self.assertEqual(len(set(first + second)), 30)
+
+    def test_behind_the_table(self):
+        pool = make_pool()
+        pool.run_now(lambda s: s.add(SessionTable('#a')))
+        self.assertEqual(shards.IdBlock(pool, SessionTable.id).next(), 2)
+
+    def test_reserved_ahead(self):
+        pool = make_pool()
+        block = shards.IdBlock(pool, SessionTable.id, 10)
+        ids = [block.next() for _ in xrange(5)]
+        self.assertEqual(block.spare, 11)
+
+        # Running out of the first block doesn't wait on the db.
+        pool.run_now = lambda *args: self.fail("reserved on the spot")
+        ids.extend(block.next() for _ in xrange(10))
+        self.assertEqual(ids, range(1, 16))